@@ -182,12 +182,38 @@ CELERYBEAT_SCHEDULE = {
         'task': 'posts.tasks.clear_expired_posts',
         'schedule': timedelta(seconds=60*5),
     },
+    'delete-media-files': {
+        'task': 'posts.tasks.delete_media_files',
+        'schedule': timedelta(seconds=60),
+    },
+    'clear-stale-uploads': {
+        'task': 'posts.tasks.clear_stale_uploads',
+        'schedule': timedelta(hours=1),
+    },
+    'purge-seen-notifications': {
+        'task': 'notifications.tasks.purge_seen_notifications',
+        'schedule': timedelta(minutes=10),
+    },
+    'flush-tag-counters': {
+        'task': 'tags.tasks.flush_tag_counters',
+        'schedule': timedelta(seconds=60),
+    },
+    'reconcile-tag-counters': {
+        'task': 'tags.tasks.reconcile_tag_counters',
+        'schedule': timedelta(hours=1),
+    },
     'send-notifications': {
         'task': 'posts.tasks.send_expire_notifications',
         'schedule': timedelta(seconds=60)  # Should to use redis notification
     }
 }
 
+# REDIS SETTINGS
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+REDIS_MAX_CONNECTIONS = 50
+
 # CELERY SETTINGS
 BROKER_URL = 'redis://localhost:6379/1'
 CELERY_SEND_TASK_ERROR_EMAILS = True
@@ -224,6 +250,12 @@ STATIC_ROOT = os.path.join(PARENT_DIR, 'static/')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(PARENT_DIR, 'media/')
 
+# Chunked video uploads, see posts.views.VideoUploadViewSet
+VIDEO_UPLOAD_DIR = os.path.join(PARENT_DIR, 'uploads/')
+VIDEO_UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+VIDEO_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+FFMPEG_BINARY = 'ffmpeg'
+
 AUTH_USER_MODEL = 'users.User'
 
 ADMINS = [('vlmihnevich', 'vlmihnevich@gmail.com')]
@@ -14,6 +14,26 @@ CELERYBEAT_SCHEDULE = {
         'task': 'posts.tasks.clear_expired_posts',
         'schedule': timedelta(seconds=60*5),
     },
+    'delete-media-files': {
+        'task': 'posts.tasks.delete_media_files',
+        'schedule': timedelta(seconds=60),
+    },
+    'clear-stale-uploads': {
+        'task': 'posts.tasks.clear_stale_uploads',
+        'schedule': timedelta(hours=1),
+    },
+    'purge-seen-notifications': {
+        'task': 'notifications.tasks.purge_seen_notifications',
+        'schedule': timedelta(minutes=10),
+    },
+    'flush-tag-counters': {
+        'task': 'tags.tasks.flush_tag_counters',
+        'schedule': timedelta(seconds=60),
+    },
+    'reconcile-tag-counters': {
+        'task': 'tags.tasks.reconcile_tag_counters',
+        'schedule': timedelta(hours=1),
+    },
     'send-notifications': {
         'task': 'posts.tasks.send_expire_notifications',
         'schedule': timedelta(seconds=30)
@@ -37,7 +37,7 @@ from smsconfirmation.views import (PhoneConfirmView, ResetPasswordView, VerifyCr
 #from smsconfirmation import views, verify_create
 
 from posts.views import (PostsViewSet, CommentsViewSet, VotedPostsViewSet, VotersListViewSet,
-                         DonwvotedPostsViewSet, PinnedPostsViewSet, PostSearchViewSet)
+                         DonwvotedPostsViewSet, PinnedPostsViewSet, PostSearchViewSet, VideoUploadViewSet)
 
 from posts.feeds import MainFeedView, RecentFeedView
 
@@ -54,6 +54,7 @@ api_1.register(r'posts/downvoted', DonwvotedPostsViewSet, base_name='downvoted')
 api_1.register(r'posts/voted', VotedPostsViewSet, base_name='voted')
 api_1.register(r'users/voters', VotersListViewSet, base_name='voters')
 api_1.register(r'posts/search', PostSearchViewSet, base_name='post-search')
+api_1.register(r'posts/uploads', VideoUploadViewSet, base_name='video-upload')
 api_1.register(r'posts', PostsViewSet, base_name='post')
 api_1.register(r'comments', CommentsViewSet, base_name='comment')
 api_1.register(r'tags/search', TagExactSearchView, base_name='tag-exact-search')
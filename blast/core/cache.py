@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+pool = redis.ConnectionPool(host=settings.REDIS_HOST,
+                            port=settings.REDIS_PORT,
+                            db=settings.REDIS_DB,
+                            max_connections=settings.REDIS_MAX_CONNECTIONS)
+
+# Shared client. All modules should use it instead of own StrictRedis instances,
+# so connections are taken from the single pool.
+r = redis.StrictRedis(connection_pool=pool)
+
+_local = threading.local()
+
+CACHE_LOCK_KEY = '{}:lock'
+CACHE_LOCK_TIMEOUT = 5  # seconds
+CACHE_LOCK_POLL_INTERVAL = 0.05  # seconds
+
+# Marks that cache source is empty, because redis does not keep empty collections
+CACHE_EMPTY_KEY = '{}:empty'
+CACHE_EMPTY_TTL = 60  # seconds
+
+
+def pipeline():
+    """Returns non transactional pipeline for sending several commands in one round trip"""
+    return r.pipeline(transaction=False)
+
+
+@contextmanager
+def batch():
+    """
+    Collects write commands to a pipeline and sends them in one round trip on exit.
+    Nested batches join the outermost one, so a view can wrap its work to
+    flush redis writes of all signal handlers at once.
+
+        with batch() as pipe:
+            pipe.zadd(key, score, member)
+    """
+    pipe = getattr(_local, 'pipe', None)
+    if pipe is not None:
+        yield pipe
+        return
+
+    pipe = _local.pipe = pipeline()
+    try:
+        yield pipe
+    except:
+        pipe.reset()
+        raise
+    finally:
+        _local.pipe = None
+
+    pipe.execute()
+
+
+def empty_key(key: str) -> str:
+    return CACHE_EMPTY_KEY.format(key)
+
+
+def is_filled(key: str) -> bool:
+    """Checks if key is cached, including cached empty result"""
+    pipe = pipeline()
+    pipe.exists(key)
+    pipe.exists(empty_key(key))
+    return any(pipe.execute())
+
+
+def lock(*keys) -> list:
+    """Takes cache locks of keys in one round trip, returns keys locked by caller"""
+    pipe = pipeline()
+    for key in keys:
+        pipe.set(CACHE_LOCK_KEY.format(key), '1', nx=True, px=int(CACHE_LOCK_TIMEOUT * 1000))
+    return [key for key, locked in zip(keys, pipe.execute()) if locked]
+
+
+def unlock(*keys):
+    if keys:
+        r.delete(*[CACHE_LOCK_KEY.format(it) for it in keys])
+
+
+def write_absent(items: dict, write, ttl: int = None):
+    """
+    Writes loaded items to keys which are still absent in one transaction,
+    so readers never see partially filled key and items written by others after loading are not lost.
+    Empty items are remembered by empty_key(key) for CACHE_EMPTY_TTL seconds.
+
+    :param items: dict of key to loaded items
+    :param write: function (pipe, key, items), queues commands writing items to key
+    :param ttl: time to live of filled keys in seconds
+    """
+    keys = list(items)
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(*keys)
+            # Keys filled by other clients after expired lock are skipped
+            keys = [key for key in keys if not pipe.exists(key)]
+            if not keys:
+                return
+
+            pipe.multi()
+            for key in keys:
+                if items[key]:
+                    write(pipe, key, items[key])
+                    if ttl:
+                        pipe.expire(key, ttl)
+                else:
+                    logger.debug('Nothing to cache for %s key', key)
+                    pipe.set(empty_key(key), '1', ex=CACHE_EMPTY_TTL)
+            pipe.execute()
+        except redis.WatchError:
+            logger.debug('Cache keys %s are filled concurrently', keys)
+
+
+def warm_up(key: str, load, write, ttl: int = None):
+    """
+    Fills up cache key from source.
+    Only one client loads the key at a time, others wait for it up to CACHE_LOCK_TIMEOUT
+    and then load it by themselves.
+
+    :param load: function () -> items of source
+    :param write: function (pipe, items), queues commands writing items to key
+    :param ttl: time to live of filled key in seconds
+    """
+    deadline = time.time() + CACHE_LOCK_TIMEOUT
+
+    locked = lock(key)
+    while not locked:
+        if time.time() > deadline:
+            logger.warning('Cache lock of %s is expired, loading without lock', key)
+            break
+
+        time.sleep(CACHE_LOCK_POLL_INTERVAL)
+        if is_filled(key):  # Filled by lock owner
+            return
+
+        locked = lock(key)
+
+    try:
+        write_absent({key: load()}, lambda pipe, _, items: write(pipe, items), ttl)
+    finally:
+        unlock(*locked)
+
+
+def add_to_cached_set(key: str, *members):
+    """
+    Adds members to set if it is cached.
+    Cold set is not created, so it is fully loaded on next read.
+    """
+    pipe = pipeline()
+    pipe.exists(key)
+    pipe.delete(empty_key(key))  # Set is not empty anymore
+    exists, _ = pipe.execute()
+
+    if exists:
+        r.sadd(key, *members)
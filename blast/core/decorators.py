@@ -1,51 +1,111 @@
 import logging
-import redis
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+from typing import Iterable, Set
+
+from core.cache import r, pipeline, empty_key, warm_up
 
 logger = logging.getLogger(__name__)
 
 
 # FIXME: Rename to memoize_zset?
-def save_to_zset(key_pattern: str):
+def save_to_zset(key_pattern: str, ttl: int = None):
     def wrap(f):
         def wrapped_function(pk, start: int, end: int):
             key = key_pattern.format(pk)
-            if not r.exists(key):
-                logger.debug('Heat up cache for {}'.format(key))
-                result = f(pk, start, end)
 
-                if not result:
-                    logger.debug('Nothing to cache. Key is {}'.format(key))
-                    return []
+            # Checks and reads cache in one round trip
+            pipe = pipeline()
+            pipe.exists(key)
+            pipe.exists(empty_key(key))
+            pipe.zrevrange(key, start, end)
+            exists, is_empty, result = pipe.execute()
 
-                if len(result) % 2:
-                    logger.error('Invalid result size for {}. Size is {}'.format(key, len(result)))
+            if not exists:
+                if is_empty:
                     return []
 
-                r.zadd(key, *result)
-            result = r.zrevrange(key, start, end)
+                logger.debug('Heat up cache for {}'.format(key))
+
+                def load():
+                    result = f(pk, start, end)
+                    if len(result) % 2:
+                        logger.error('Invalid result size for {}. Size is {}'.format(key, len(result)))
+                        return []
+                    return result
+
+                warm_up(key, load, lambda pipe, items: pipe.zadd(key, *items), ttl)
+                result = r.zrevrange(key, start, end)
+
             return [int(it) for it in result]
         return wrapped_function
     return wrap
 
 
-def memoize_list(key_pattern: str):
+def memoize_list(key_pattern: str, ttl: int = None):
     def wrap(f):
         def wrapped_function(pk: int, start: int, end: int):
             key = key_pattern.format(pk)
-            if not r.exists(key):
-                logger.debug('Heat up cache for %s', key)
-                result = f(pk, start, end)
 
-                if not result:
-                    logger.debug('Nothing to cache for %s key', key)
+            pipe = pipeline()
+            pipe.exists(key)
+            pipe.exists(empty_key(key))
+            pipe.lrange(key, start, end)
+            exists, is_empty, cached = pipe.execute()
+
+            if not exists:
+                if is_empty:
                     return []
 
-                for it in result:
-                    r.lpush(key, it)
+                logger.debug('Heat up cache for %s', key)
+                warm_up(key, lambda: f(pk, start, end), lambda pipe, items: pipe.lpush(key, *items), ttl)
+                cached = r.lrange(key, start, end)
 
-            cached = r.lrange(key, start, end)
             return (int(it) for it in cached)
         return wrapped_function
     return wrap
+
+
+def memoize_set(key_pattern: str, ttl: int = None):
+    """
+    Caches result of f to redis set and filters given items by membership in it.
+    Decorated function should return all members of set for pk.
+    Cached set should be updated by core.cache.add_to_cached_set.
+    """
+    def wrap(f):
+        def filter_members(key: str, items: list):
+            pipe = pipeline()
+            pipe.exists(key)
+            pipe.exists(empty_key(key))
+            for it in items:
+                pipe.sismember(key, it)
+            exists, is_empty, *members = pipe.execute()
+
+            if not exists and not is_empty:
+                return None
+
+            return {it for it, is_member in zip(items, members) if is_member}
+
+        def wrapped_function(pk: int, items: Iterable[int]) -> Set[int]:
+            key = key_pattern.format(pk)
+            items = list(items)
+
+            result = filter_members(key, items)
+            if result is None:
+                logger.debug('Heat up cache for %s', key)
+                loaded = {}
+
+                def load():
+                    loaded['members'] = f(pk)
+                    return loaded['members']
+
+                warm_up(key, load, lambda pipe, members: pipe.sadd(key, *members), ttl)
+                result = filter_members(key, items)
+
+                if result is None:
+                    # Set is not confirmed in redis after warm up race, items are filtered by source
+                    members = set(loaded['members'] if 'members' in loaded else f(pk))
+                    result = {it for it in items if it in members}
+
+            return result
+        return wrapped_function
+    return wrap
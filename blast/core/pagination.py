@@ -1,10 +1,17 @@
+import base64
+import json
 from datetime import datetime
 
+from django.db.models import Q
 from django.template import loader
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework.compat import template_render
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination, _positive_int, BasePagination
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 from collections import OrderedDict
 
 
@@ -14,41 +21,182 @@ class StandardResultsSetPagination(PageNumberPagination):
     max_page_size = 250
 
 
-class DateTimePaginator(BasePagination):
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination by (ordering field, id).
+    Client gets opaque cursor in `next` and `previous` links and sends it back in `cursor` parameter,
+    so each page is fetched by index seek instead of OFFSET.
+    Ordering can be set by constructor or by `keyset_ordering` attribute of view.
+    """
     page_size = 50
     page_size_query_param = 'page_size'
-    max_page_size = 100
+    max_page_size = 250
 
-    page_parameter = 'date'
+    cursor_query_param = 'cursor'
+    ordering = '-created_at'
+
+    # Max count of db/cache queries for filling up page after filtering
+    max_fetch_rounds = 3
 
     template = 'rest_framework/pagination/numbers.html'
 
+    def __init__(self, ordering: str = None):
+        self.custom_ordering = ordering
+
+        self.request = None
+        self.next_cursor = None
+
+        # Previous page is the first one if it exists without cursor
+        self.has_previous = False
+        self.previous_cursor = None
+
     def get_page_size(self, request):
         if self.page_size_query_param:
             try:
-                value = int(request.query_params.get(self.page_size_query_param, self.max_page_size))
-                value = min(value, self.max_page_size)
-                return value
+                return _positive_int(request.query_params[self.page_size_query_param],
+                                     strict=True, cutoff=self.max_page_size)
             except (KeyError, ValueError):
                 pass
 
         return self.page_size
 
-    def get_page_parameter(self, request: Request):
-        return request.query_params.get(self.page_parameter, datetime.now())
+    def get_ordering(self, view=None) -> tuple:
+        """Returns ordering field and is descending flag, ordering of constructor has precedence over view one"""
+        ordering = self.custom_ordering or getattr(view, 'keyset_ordering', None) or self.ordering
+        return ordering.lstrip('-'), ordering.startswith('-')
+
+    @staticmethod
+    def encode_cursor(cursor: tuple) -> str:
+        value, pk = cursor
+        if isinstance(value, datetime):
+            value = value.isoformat()  # Keeps microseconds
+
+        data = json.dumps([value, pk])
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request: Request) -> tuple or None:
+        """Returns (ordering field value, id) from request or None for first page"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound('Invalid cursor')
+
+        return value, pk
+
+    @staticmethod
+    def get_value(instance, field: str):
+        for it in field.split('__'):
+            instance = getattr(instance, it)
+
+        return instance
+
+    @staticmethod
+    def keyset_filter(field: str, descending: bool, cursor: tuple) -> Q:
+        lookup = 'lt' if descending else 'gt'
+        value, pk = cursor
+
+        query = Q(**{'{}__{}'.format(field, lookup): value})
+        if pk is not None:
+            query |= Q(**{field: value, 'pk__{}'.format(lookup): pk})
+
+        return query
+
+    def paginate_queryset(self, queryset, request, view=None):
+        field, descending = self.get_ordering(view)
+        prefix = '-' if descending else ''
+        queryset = queryset.order_by(prefix + field, prefix + 'pk')
+
+        def fetch(cursor: tuple or None, count: int):
+            qs = queryset
+            if cursor is not None:
+                qs = qs.filter(self.keyset_filter(field, descending, cursor))
+
+            items = list(qs[:count])
+            if len(items) < count:
+                return items, None
+
+            return items, (self.get_value(items[-1], field), items[-1].pk)
+
+        page = self.collect_page(fetch, request, view)
+        if page and self.decode_cursor(request) is not None:
+            self.find_previous_cursor(queryset, field, descending, page[0])
+
+        return page
+
+    def find_previous_cursor(self, queryset, field: str, descending: bool, first):
+        """Finds cursor of previous page by reversed seek from first item of page"""
+        prefix = '' if descending else '-'
+        queryset = queryset.order_by(prefix + field, prefix + 'pk')
+        queryset = queryset.filter(self.keyset_filter(field, not descending, (self.get_value(first, field), first.pk)))
+
+        # Item before previous page is its cursor
+        page_size = self.get_page_size(self.request)
+        items = list(queryset[:page_size + 1])
+        if not items:
+            return
+
+        self.has_previous = True
+        if len(items) > page_size:
+            self.previous_cursor = (self.get_value(items[-1], field), items[-1].pk)
+
+    def collect_page(self, fetch, request, view=None):
+        """
+        Collects page from chunks of candidates.
+        If view has filter_page method, candidates are filtered by it
+        and next chunks are fetched to fill up the page.
+        :param fetch: function (cursor, count) -> (list of objects, cursor of next chunk or None)
+        """
+        self.request = request
 
-    def paginate_queryset(self, queryset, request, view=None):  # pragma: no cover
         page_size = self.get_page_size(request)
-        date = self.get_page_parameter(request)
+        cursor = self.decode_cursor(request)
+        filter_page = getattr(view, 'filter_page', None)
 
-        qs = queryset.filter(created_at__lt=date)
+        page = []
+        for _ in range(self.max_fetch_rounds):
+            items, cursor = fetch(cursor, page_size - len(page))
+            if filter_page:
+                items = filter_page(items)
 
-        return qs[:page_size]
+            page.extend(items)
 
-    def get_paginated_response(self, data):
-        return Response(OrderedDict([
-            ('results', data)
-        ]))
+            if len(page) >= page_size or cursor is None:
+                break
+
+        self.next_cursor = cursor
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_cursor))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+
+        url = self.request.build_absolute_uri()
+        if self.previous_cursor is None:
+            return remove_query_param(url, self.cursor_query_param)
+
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.previous_cursor))
+
+    def get_paginated_response(self, data, count: int = None):
+        result = OrderedDict()
+        if count is not None:
+            result['count'] = count
+
+        result['next'] = self.get_next_link()
+        result['previous'] = self.get_previous_link()
+        result['results'] = data
+
+        return Response(result)
 
     def to_html(self):
         template = loader.get_template(self.template)
@@ -57,3 +205,60 @@ class DateTimePaginator(BasePagination):
 
     def get_results(self, data):
         return data['results']
+
+
+class DateTimePaginator(KeysetPagination):
+    """
+    Keyset pagination by creation date.
+    It also accepts `date` parameter of previous API version as cursor.
+    """
+    max_page_size = 100
+
+    page_parameter = 'date'
+
+    def get_page_size(self, request):
+        if self.page_size_query_param not in request.query_params:
+            return self.max_page_size
+
+        return super().get_page_size(request)
+
+    def decode_cursor(self, request: Request):
+        cursor = super().decode_cursor(request)
+        if cursor is None and request.query_params.get(self.page_parameter):
+            return request.query_params[self.page_parameter], None
+
+        return cursor
+
+    @staticmethod
+    def cursor_to_timestamp(cursor: tuple or None) -> tuple or None:
+        if cursor is None:
+            return None
+
+        value, pk = cursor
+        date = parse_datetime(value)
+        if date is None:
+            raise NotFound('Invalid cursor')
+
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date, timezone.utc)
+
+        return date.timestamp(), pk
+
+    def paginate_timeline(self, queryset, request, timeline, view=None):
+        """
+        Paginates queryset by ids from timeline.
+        :param timeline: function ((timestamp, id) or None, count) -> list of (id, timestamp) ordered by date
+        :return: list of objects in timeline order
+        """
+        def fetch(cursor: tuple or None, count: int):
+            items = timeline(self.cursor_to_timestamp(cursor), count)
+            objects = {it.pk: it for it in queryset.filter(pk__in=[pk for pk, _ in items])}
+            page = [objects[pk] for pk, _ in items if pk in objects]
+
+            if len(items) < count:
+                return page, None
+
+            pk, timestamp = items[-1]
+            return page, (datetime.fromtimestamp(timestamp, timezone.utc).isoformat(), pk)
+
+        return self.collect_page(fetch, request, view)
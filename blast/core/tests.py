@@ -5,7 +5,6 @@ import uuid
 
 from io import BytesIO
 
-import redis
 from PIL import Image
 from unittest import mock
 from django.core.files.base import ContentFile
@@ -13,6 +12,8 @@ from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, TransactionTestCase, override_settings
 from django.core.urlresolvers import reverse_lazy
 
+from core.cache import r, batch, empty_key, warm_up, CACHE_LOCK_KEY
+from core.decorators import memoize_list, memoize_set, save_to_zset
 from countries.models import Country
 from users.models import User
 
@@ -36,6 +37,15 @@ def create_file(name, content_file=True):
         return SimpleUploadedFile(name, file.read(), content_type='image/png')
 
 
+def create_image(name, size=(300, 200)):
+    """Returns uploaded file with valid PNG image"""
+    image = Image.new('RGB', size=size)
+    file = BytesIO()
+    image.save(file, 'PNG')
+
+    return SimpleUploadedFile(name, file.getvalue(), content_type='image/png')
+
+
 @mock.patch('core.smsconfirmation.tasks.sinch_request_mok', sinch_request_mok)
 @override_settings(CELERY_ALWAYS_EAGER=True)
 class BaseTestCaseUnauth(TestCase):
@@ -65,7 +75,7 @@ class BaseTestCaseUnauth(TestCase):
         self.client.defaults.update(self.headers)
 
     def setUp(self):
-        self.r = redis.StrictRedis(host='localhost', port=6379, db=0)
+        self.r = r
         self.r.flushdb()
 
         data = {
@@ -123,4 +133,89 @@ class BaseTestCase(BaseTestCaseUnauth):
         self.headers = {
             'HTTP_AUTHORIZATION': 'Token {0}'.format(self.auth_token)
         }
-        self.client.defaults.update(self.headers)
\ No newline at end of file
+        self.client.defaults.update(self.headers)
+
+
+class CacheBatchTest(TestCase):
+    key = 'test:batch'
+
+    def setUp(self):
+        r.delete(self.key)
+
+    def test_nested_batch(self):
+        with batch() as outer:
+            outer.sadd(self.key, 1)
+            with batch() as inner:
+                self.assertIs(inner, outer)
+                inner.sadd(self.key, 2)
+
+            self.assertFalse(r.exists(self.key))  # Sent on exit of outermost batch
+
+        self.assertEqual(r.smembers(self.key), {b'1', b'2'})
+
+    def test_batch_error(self):
+        with self.assertRaises(ValueError):
+            with batch() as pipe:
+                pipe.sadd(self.key, 1)
+                raise ValueError()
+
+        self.assertFalse(r.exists(self.key))
+
+
+class CacheWarmUpTest(TestCase):
+    key = 'test:{}:items'
+
+    def setUp(self):
+        self.calls = 0
+        r.delete(self.key.format(1), empty_key(self.key.format(1)), CACHE_LOCK_KEY.format(self.key.format(1)))
+
+    def load(self, result):
+        def f(pk, start, end):
+            self.calls += 1
+            return result
+        return f
+
+    def test_fill_list(self):
+        get_items = memoize_list(self.key)(self.load([1, 2, 3]))
+
+        self.assertEqual(list(get_items(1, 0, -1)), [3, 2, 1])
+        self.assertEqual(list(get_items(1, 0, 0)), [3])
+        self.assertEqual(self.calls, 1)
+
+    def test_empty_result(self):
+        get_items = save_to_zset(self.key)(self.load([]))
+
+        self.assertEqual(get_items(1, 0, -1), [])
+        self.assertEqual(get_items(1, 0, -1), [])
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(r.exists(empty_key(self.key.format(1))))
+
+    def test_ttl(self):
+        get_items = save_to_zset(self.key, ttl=60)(self.load([1, 10, 2, 20]))
+
+        self.assertEqual(get_items(1, 0, -1), [20, 10])
+        self.assertGreater(r.ttl(self.key.format(1)), 0)
+
+    @mock.patch('core.cache.CACHE_LOCK_TIMEOUT', 0.1)
+    def test_expired_lock(self):
+        r.set(CACHE_LOCK_KEY.format(self.key.format(1)), '1')
+        get_items = memoize_list(self.key)(self.load([1]))
+
+        self.assertEqual(list(get_items(1, 0, -1)), [1])
+        self.assertTrue(r.exists(CACHE_LOCK_KEY.format(self.key.format(1))))  # Lock of other client is kept
+
+    def test_set_not_filled(self):
+        get_members = memoize_set(self.key)(lambda pk: [1, 2])
+
+        with mock.patch('core.decorators.warm_up'):  # Set is not written by warm up race
+            self.assertEqual(get_members(1, [1, 3]), {1})
+
+    def test_filled_while_loading(self):
+        key = self.key.format(1)
+
+        def load():
+            r.sadd(key, 5)  # Filled by other client
+            return [1, 2]
+
+        warm_up(key, load, lambda pipe, items: pipe.sadd(key, *items))
+        self.assertEqual(r.smembers(key), {b'5'})
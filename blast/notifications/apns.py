@@ -0,0 +1,197 @@
+import binascii
+import json
+import logging
+import select
+import socket
+import ssl
+import struct
+from collections import OrderedDict
+
+from typing import List, Set, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+APNS_HOST = 'gateway.push.apple.com'
+APNS_PORT = 2195
+
+# Status of error response for invalid device token
+INVALID_TOKEN = 8
+
+
+def build_payload(alert: str, badge: int = None, sound: str = None, extra: dict = None) -> bytes:
+    aps = {'alert': alert}
+    if badge is not None:
+        aps['badge'] = badge
+    if sound:
+        aps['sound'] = sound
+
+    data = dict(extra or {})
+    data['aps'] = aps
+
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def _pack_item(item_id: int, data: bytes) -> bytes:
+    return struct.pack('!BH', item_id, len(data)) + data
+
+
+def pack_frame(token: bytes, payload: bytes, identifier: int, priority: int = 10) -> bytes:
+    """Returns notification frame of APNs binary interface"""
+    items = b''.join([
+        _pack_item(1, token),
+        _pack_item(2, payload),
+        _pack_item(3, struct.pack('!I', identifier)),
+        _pack_item(4, struct.pack('!I', 0)),  # Expiration
+        _pack_item(5, struct.pack('!B', priority)),
+    ])
+
+    return struct.pack('!BI', 2, len(items)) + items
+
+
+class APNSConnection(object):
+    """
+    Long-lived connection to APNs binary interface.
+    APNs answers only on error and closes connection after it,
+    notifications sent after failed one are dropped by APNs and sent again by new connection.
+    Identifiers of frames grow through the whole connection, so late error response
+    of previous batch is matched with its own frame.
+    """
+    timeout = 10
+    error_timeout = 0.5  # Time to wait error response after batch
+    max_reconnects = 3
+    max_in_flight = 10000  # Count of last sent frames kept for matching error responses
+
+    def __init__(self, host: str, port: int, certfile: str = None):
+        self.host = host
+        self.port = port
+        self.certfile = certfile
+        self.socket = None
+
+        self.next_identifier = 0
+        self.in_flight = OrderedDict()  # identifier -> (device token, frame) sent by current socket
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.certfile:
+            context = ssl.create_default_context()
+            context.load_cert_chain(self.certfile)
+            sock = context.wrap_socket(sock, server_hostname=self.host)
+
+        self.socket = sock
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+        self.in_flight.clear()
+
+    def read_error(self, timeout: float) -> Tuple[int, int] or None:
+        """Returns (status, identifier) of error response or None"""
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        if not readable:
+            return None
+
+        data = self.socket.recv(6)
+        if len(data) < 6:
+            raise ConnectionError('Connection is closed by APNs')
+
+        _, status, identifier = struct.unpack('!BBI', data)
+        return status, identifier
+
+    def handle_error(self, error: Tuple[int, int] or None, invalid: Set[str]) -> list:
+        """
+        Closes connection after error response
+        :return: frames sent after failed one, they are dropped by APNs
+        """
+        if error is None:
+            return []
+
+        status, identifier = error
+        if identifier not in self.in_flight:
+            logger.error('APNs error {} for unknown frame {}'.format(status, identifier))
+            self.close()
+            return []
+
+        token, _ = self.in_flight[identifier]
+        if status == INVALID_TOKEN:
+            invalid.add(token)
+        else:
+            logger.error('APNs error {} for {}'.format(status, token))
+
+        identifiers = list(self.in_flight)
+        dropped = identifiers[identifiers.index(identifier) + 1:]
+        dropped = [(it, ) + self.in_flight[it] for it in dropped]
+
+        self.close()
+        return dropped
+
+    def send(self, messages: List[Tuple[str, bytes]]) -> Set[str]:
+        """
+        Sends notifications by one write
+        :param messages: list of (device token, payload)
+        :return: invalid device tokens
+        """
+        invalid = set()
+
+        queue = []
+        for token, payload in messages:
+            try:
+                frame = pack_frame(binascii.unhexlify(token), payload, self.next_identifier)
+            except (binascii.Error, ValueError):
+                invalid.add(token)
+                continue
+
+            queue.append((self.next_identifier, token, frame))
+            self.next_identifier = (self.next_identifier + 1) % 2 ** 32
+
+        reconnects = 0
+        while queue:
+            try:
+                if self.socket is None:
+                    self.connect()
+                else:
+                    # Error response of previous batch is handled before reusing socket
+                    dropped = self.handle_error(self.read_error(0), invalid)
+                    if dropped:
+                        queue = dropped + queue
+                        continue
+
+                self.socket.sendall(b''.join(frame for _, _, frame in queue))
+                for identifier, token, frame in queue:
+                    self.in_flight[identifier] = (token, frame)
+                while len(self.in_flight) > self.max_in_flight:
+                    self.in_flight.popitem(last=False)
+
+                # Written frames are sent again only if APNs drops them after error response
+                queue = self.handle_error(self.read_error(self.error_timeout), invalid)
+            except (OSError, ssl.SSLError):
+                self.close()
+                reconnects += 1
+                if reconnects > self.max_reconnects:
+                    raise
+
+                logger.warning('APNs connection is lost, reconnecting', exc_info=True)
+
+        return invalid
+
+
+_connection = None
+
+
+def get_connection() -> APNSConnection:
+    """Returns connection shared by all tasks of worker process"""
+    global _connection
+
+    conf = settings.PUSH_NOTIFICATIONS_SETTINGS
+    address = (conf.get('APNS_HOST', APNS_HOST), conf.get('APNS_PORT', APNS_PORT), conf.get('APNS_CERTIFICATE'))
+
+    if _connection is None or (_connection.host, _connection.port, _connection.certfile) != address:
+        if _connection is not None:
+            _connection.close()
+
+        _connection = APNSConnection(*address)
+
+    return _connection
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Partial index for notifications.tasks.purge_seen_notifications"""
+
+    dependencies = [
+        ('notifications', '0004_auto_20180218_1017'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX notifications_notification_seen_created_at '
+            'ON notifications_notification (created_at) WHERE is_seen',
+            'DROP INDEX notifications_notification_seen_created_at',
+        ),
+    ]
@@ -1,18 +1,46 @@
 import logging
+from collections import defaultdict, Counter
+from datetime import timedelta
+from typing import Dict, Iterable
 
 from django.db import models
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models import Q, Count
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from posts.models import Post, PostComment
+from posts.models import Post, PostComment, USER_REG
 from tags.models import Tag
 from users.models import User, UserSettings, Follower
 
-from notifications.tasks import send_push_notification
+from core.cache import r, batch, pipeline
+from core.utils import LRUCache
+from notifications.tasks import push_notifications
 
 logger = logging.getLogger(__name__)
 
+# Count of unseen notifications and follow requests of user.
+# Counter expires to be recounted from db, so it can not drift for long.
+UNSEEN_COUNT_KEY = 'user:{}:unseen'
+UNSEEN_COUNT_TTL = 60 * 60 * 24
+
+# Changes only cached counters, missing counter is counted from db on read
+_incr_unseen_count = r.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    local count = redis.call('incrby', KEYS[1], ARGV[1])
+    if count < 0 then
+        redis.call('incrby', KEYS[1], -count)
+    end
+end
+""")
+
+
+def change_unseen_counts(changes: Dict[int, int]):
+    """Adds changes to unseen counters of users"""
+    with batch() as pipe:
+        for user_id, value in changes.items():
+            if value:
+                _incr_unseen_count(keys=[UNSEEN_COUNT_KEY.format(user_id)], args=[value], client=pipe)
+
 
 # TODO: make proxy model for Notification
 class FollowRequest(models.Model):
@@ -37,7 +65,7 @@ class FollowRequest(models.Model):
 
     def send_push_message(self):
         logger.info('Send follow request push message for id = %s, follower = %s', self.followee_id, self.follower_id)
-        send_push_notification.delay(self.followee_id, self.notification_text, self.push_payload)
+        push_notifications([self.followee_id], self.notification_text, self.push_payload)
 
     def __str__(self):
         return u'{} {}'.format(self.follower_id, self.followee_id)
@@ -137,11 +165,46 @@ class Notification(models.Model):
 
     is_seen = models.BooleanField(default=False)
 
+    # Seen notifications are removed after it
+    SEEN_TTL = timedelta(days=1)
+
     @staticmethod
     def unseen_count(user_id: int):
-        count = Notification.objects.filter(user_id=user_id, is_seen=False).count()
-        count += FollowRequest.objects.filter(followee_id=user_id, is_seen=False).count()
-        return count
+        return Notification.unseen_counts([user_id])[user_id]
+
+    @staticmethod
+    def unseen_counts(user_ids: list) -> Dict[int, int]:
+        """Returns unseen count for each user from cache, missing counters are counted by grouped queries"""
+        result = defaultdict(int)
+        if not user_ids:
+            return result
+
+        cached = r.mget([UNSEEN_COUNT_KEY.format(it) for it in user_ids])
+        missing = []
+        for user_id, count in zip(user_ids, cached):
+            if count is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = int(count)
+
+        if not missing:
+            return result
+
+        notifications = Notification.objects.filter(user_id__in=missing, is_seen=False)
+        for it in notifications.values('user_id').annotate(count=Count('id')):
+            result[it['user_id']] += it['count']
+
+        requests = FollowRequest.objects.filter(followee_id__in=missing, is_seen=False)
+        for it in requests.values('followee_id').annotate(count=Count('id')):
+            result[it['followee_id']] += it['count']
+
+        # Counters changed while counting are not overwritten
+        pipe = pipeline()
+        for it in missing:
+            pipe.set(UNSEEN_COUNT_KEY.format(it), result[it], ex=UNSEEN_COUNT_TTL, nx=True)
+        pipe.execute()
+
+        return result
 
     @property
     def text(self):
@@ -229,7 +292,7 @@ class Notification(models.Model):
         logger.info('Send push message: type=%s, user=%s, text=%s, payload=%s', self.type, self.user_id,
                     self.notification_text, self.push_payload)
 
-        send_push_notification.delay(self.user_id, self.notification_text, self.push_payload)
+        push_notifications([self.user_id], self.notification_text, self.push_payload)
 
     def __str__(self):
         return '{} - {}'.format(self.user, self.text)
@@ -238,36 +301,75 @@ class Notification(models.Model):
         ordering = ('-id',)
 
 
+# Lowercase username -> (user id, notify_comments setting) of mentioned users
+MENTIONS_CACHE = LRUCache(maxsize=10000, ttl=60 * 5)
+
+
+def resolve_mentions(usernames: Iterable[str]) -> Dict[int, int]:
+    """Returns notify_comments settings of mentioned users by ids, usernames are case-insensitive"""
+    result = {}
+    missing = set()
+    for it in {it.lower() for it in usernames}:
+        cached = MENTIONS_CACHE.get(it)
+        if cached is None:
+            missing.add(it)
+        else:
+            user_id, notify_comments = cached
+            result[user_id] = notify_comments
+
+    if missing:
+        # iexact is served by users_user_username_upper index
+        query = Q()
+        for it in missing:
+            query |= Q(username__iexact=it)
+
+        users = User.objects.filter(query).values_list('pk', 'username', 'settings__notify_comments')
+        for user_id, username, notify_comments in users:
+            MENTIONS_CACHE.set(username.lower(), (user_id, notify_comments))
+            result[user_id] = notify_comments
+
+    return result
+
+
+@receiver(post_save, sender=User, dispatch_uid='notifications_mentions_user_save')
+@receiver(post_delete, sender=User, dispatch_uid='notifications_mentions_user_delete')
+def invalidate_user_mentions(sender, instance: User, **kwargs):
+    # Previous name of renamed user expires by ttl
+    MENTIONS_CACHE.delete(instance.username.lower())
+
+
+@receiver(post_save, sender=UserSettings, dispatch_uid='notifications_mentions_settings_save')
+def invalidate_settings_mentions(sender, instance: UserSettings, **kwargs):
+    MENTIONS_CACHE.delete(instance.user.username.lower())
+
+
 # TODO: move to TextNotificationMixin mixin
 def notify_users(users: list, post: Post, comment: PostComment or None, author: User):
     # TODO: author can be None
     if not users:
         return
 
-    query = Q()
-    for it in users:
-        query = query | Q(username__istartswith=it)
-
-    users = User.objects.filter(query).prefetch_related('settings')
+    users = resolve_mentions(users)
+    users = {user_id: notify_comments for user_id, notify_comments in users.items()
+             if notify_comments != UserSettings.OFF}
+    if not users:
+        return
 
-    followers = Follower.objects.filter(followee=author, follower__in=users)
-    followers = {it.follower_id for it in followers}
+    followers = Follower.objects.filter(followee=author, follower_id__in=users.keys())
+    followers = set(followers.values_list('follower_id', flat=True))
 
     notifications = []
-    for user in users:
-        is_follow = user.id in followers
-        if user.settings.notify_comments == UserSettings.OFF:
-            continue
-
-        for_everyone = user.settings.notify_comments == UserSettings.EVERYONE
-        for_follower = user.settings.notify_comments == UserSettings.PEOPLE_I_FOLLOW and is_follow
+    for user_id, notify_comments in users.items():
+        for_everyone = notify_comments == UserSettings.EVERYONE
+        for_follower = notify_comments == UserSettings.PEOPLE_I_FOLLOW and user_id in followers
         if for_everyone or for_follower:
-            notification = Notification(user=user, post=post,
+            notification = Notification(user_id=user_id, post=post,
                                         other=author, comment=comment,
                                         type=Notification.MENTIONED_IN_COMMENT)
             notifications.append(notification)
 
     Notification.objects.bulk_create(notifications)
+    change_unseen_counts(Counter(it.user_id for it in notifications))
 
     for it in notifications:
         it.send_push_message()
@@ -287,26 +389,35 @@ def save_comment_notifications(sender, instance: PostComment, **kwargs):
             notification.send_push_message()
 
 
-@receiver(post_save, sender=Post, dispatch_uid='notifications_posts')
-def blast_save_notifications(sender, instance: Post, **kwargs):
-    """Handles changing of votes counter and creates notification"""
-    votes = instance.voted_count
-
-    users = instance.notified_users
-    notify_users(users, instance, None, instance.user)
-
+def notify_votes_reached(post_id: int, user_id: int, votes: int):
+    """Creates notification if votes counter of post reached next milestone"""
     if votes == 0 or votes % 10:
         return
 
     if (votes <= 100 and votes % 10 == 0) or (votes >= 1000 and votes % 1000 == 0):
-        logger.info('Post {} reached {} votes'.format(instance, votes))
-        notification = Notification.objects.create(user_id=instance.user_id, other_id=instance.user_id,
-                                                   post_id=instance.pk, votes=votes, type=Notification.VOTES_REACHED)
+        logger.info('Post {} reached {} votes'.format(post_id, votes))
+        notification = Notification.objects.create(user_id=user_id, other_id=user_id,
+                                                   post_id=post_id, votes=votes, type=Notification.VOTES_REACHED)
 
-        if instance.user.settings.notify_votes:
+        if UserSettings.objects.filter(user_id=user_id, notify_votes=True).exists():
             notification.send_push_message()
 
 
+@receiver(post_save, sender=Post, dispatch_uid='notifications_posts')
+def blast_save_notifications(sender, instance: Post, **kwargs):
+    """Handles changing of text and votes counter and creates notification"""
+    changed = instance.changed_fields
+
+    if 'text' in changed:
+        # Users mentioned by previous text are already notified
+        previous = USER_REG.findall(instance.loaded_values.get('text', ''))
+        users = {it.lower() for it in instance.notified_users} - {it.lower() for it in previous}
+        notify_users(users, instance, None, instance.user)
+
+    if 'voted_count' in changed:
+        notify_votes_reached(instance.pk, instance.user_id, instance.voted_count)
+
+
 @receiver(post_save, sender=Follower, dispatch_uid='notifications_follow')
 def start_following_handler(sender, instance: Follower, **kwargs):
     """Handles following event"""
@@ -329,3 +440,27 @@ def follow_request_created(sender, instance: FollowRequest, created: bool, **kwa
         return False
 
     instance.send_push_message()
+
+
+@receiver(post_save, sender=Notification, dispatch_uid='notifications_unseen_count_save')
+def notification_unseen_count_save(sender, instance: Notification, created: bool, **kwargs):
+    if created and not instance.is_seen:
+        change_unseen_counts({instance.user_id: 1})
+
+
+@receiver(post_delete, sender=Notification, dispatch_uid='notifications_unseen_count_delete')
+def notification_unseen_count_delete(sender, instance: Notification, **kwargs):
+    if not instance.is_seen:
+        change_unseen_counts({instance.user_id: -1})
+
+
+@receiver(post_save, sender=FollowRequest, dispatch_uid='follow_request_unseen_count_save')
+def follow_request_unseen_count_save(sender, instance: FollowRequest, created: bool, **kwargs):
+    if created and not instance.is_seen:
+        change_unseen_counts({instance.followee_id: 1})
+
+
+@receiver(post_delete, sender=FollowRequest, dispatch_uid='follow_request_unseen_count_delete')
+def follow_request_unseen_count_delete(sender, instance: FollowRequest, **kwargs):
+    if not instance.is_seen:
+        change_unseen_counts({instance.followee_id: -1})
@@ -4,7 +4,7 @@ from notifications.models import Notification, FollowRequest
 from posts.serializers import PreviewPostSerializer
 from users.models import Follower
 
-from notifications.tasks import send_push_notification
+from notifications.tasks import push_notifications
 
 
 class NotificationPublicSerializer(serializers.ModelSerializer):
@@ -47,9 +47,9 @@ class FollowRequestSerializer(serializers.ModelSerializer):
     def _process_request(self, instance: FollowRequest, validated_data):
         if validated_data['accept']:
             Follower.objects.create(followee=instance.followee, follower=instance.follower)
-            send_push_notification.delay(instance.follower_id,
-                                         '@{} accepted your follow request.'.format(instance.followee.username),
-                                         {'userId': instance.followee.pk})
+            push_notifications([instance.follower_id],
+                               '@{} accepted your follow request.'.format(instance.followee.username),
+                               {'userId': instance.followee.pk})
         instance.delete()
 
         return instance
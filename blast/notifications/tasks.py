@@ -1,4 +1,6 @@
-from typing import List
+import json
+from collections import defaultdict
+from typing import List, Iterable
 
 from blast import celery
 import logging
@@ -7,19 +9,142 @@ from push_notifications.apns import apns_send_bulk_message
 from push_notifications.models import APNSDevice
 
 from celery import shared_task
+from django.utils import timezone
 
+from core.cache import r, pipeline, CACHE_LOCK_KEY
+from notifications.apns import build_payload, get_connection
 from users.models import Follower
 
 logger = logging.Logger(__name__)
 
+# Redis list of pending push messages, it is read by dispatch_push_notifications
+PUSH_QUEUE_KEY = 'push:queue'
+# Messages taken by dispatcher, they are removed after sending
+PUSH_PROCESSING_KEY = 'push:processing'
+# Exists while dispatching is scheduled
+PUSH_DISPATCH_KEY = 'push:dispatch'
+# Exists while messages are dispatched, so only one dispatcher uses processing list
+PUSH_DISPATCH_LOCK_KEY = CACHE_LOCK_KEY.format(PUSH_QUEUE_KEY)
+PUSH_DISPATCH_LOCK_TIMEOUT = 60  # seconds
+
+PUSH_BATCH_SIZE = 500
+PUSH_COALESCE_DELAY = 1  # seconds
+
+# Returns messages left by failed dispatcher to queue tail
+# and moves oldest messages from queue to processing list
+_take_push_batch = r.register_script("""
+local left = redis.call('lrange', KEYS[2], 0, -1)
+if #left > 0 then
+    redis.call('rpush', KEYS[1], unpack(left))
+    redis.call('del', KEYS[2])
+end
+
+local items = redis.call('lrange', KEYS[1], -ARGV[1], -1)
+if #items > 0 then
+    redis.call('ltrim', KEYS[1], 0, -ARGV[1] - 1)
+    redis.call('rpush', KEYS[2], unpack(items))
+end
+return items
+""")
+
+
+def push_notifications(users: Iterable[int], message: str, payload: dict):
+    """Queues push message to users, messages queued within PUSH_COALESCE_DELAY are sent together"""
+    items = [json.dumps({'user': it, 'message': message, 'payload': payload}) for it in users]
+    if not items:
+        return
+
+    pipe = pipeline()
+    pipe.lpush(PUSH_QUEUE_KEY, *items)
+    pipe.set(PUSH_DISPATCH_KEY, '1', nx=True, ex=60)
+    _, is_scheduled = pipe.execute()
+
+    if is_scheduled:
+        dispatch_push_notifications.apply_async(countdown=PUSH_COALESCE_DELAY)
+
 
 @shared_task(bind=False)
 def send_push_notification(user_id: int, message: str, payload: dict):
-    from notifications.models import Notification
     logger.info(u'Send push notification to {} user with {}'.format(user_id, payload))
+    push_notifications([user_id], message, payload)
+
+
+@shared_task(bind=False)
+def dispatch_push_notifications():
+    # Messages queued from now are dispatched by next task
+    r.delete(PUSH_DISPATCH_KEY)
+
+    if not r.set(PUSH_DISPATCH_LOCK_KEY, '1', nx=True, ex=PUSH_DISPATCH_LOCK_TIMEOUT):
+        # Other dispatcher is running, messages queued after its last batch are sent later
+        dispatch_push_notifications.apply_async(countdown=PUSH_COALESCE_DELAY)
+        return
+
+    try:
+        while True:
+            r.expire(PUSH_DISPATCH_LOCK_KEY, PUSH_DISPATCH_LOCK_TIMEOUT)
+
+            # Takes oldest messages from queue, they are kept in processing list until sent
+            items = _take_push_batch(keys=[PUSH_QUEUE_KEY, PUSH_PROCESSING_KEY], args=[PUSH_BATCH_SIZE])
+            if not items:
+                return
+
+            _send_push_batch([json.loads(it.decode('utf-8')) for it in reversed(items)])
+            r.delete(PUSH_PROCESSING_KEY)
+
+            if len(items) < PUSH_BATCH_SIZE:
+                return
+    finally:
+        # Unsent messages stay in processing list and are returned to queue by next dispatcher
+        r.delete(PUSH_DISPATCH_LOCK_KEY)
+
+
+def _send_push_batch(items: List[dict]):
+    from notifications.models import Notification
+
+    tokens = defaultdict(list)
+    devices = APNSDevice.objects.filter(user_id__in={it['user'] for it in items}, active=True)
+    for user_id, token in devices.values_list('user_id', 'registration_id'):
+        tokens[user_id].append(token)
 
-    devices = APNSDevice.objects.filter(user=user_id)
-    devices.send_message(message, sound='default', badge=Notification.unseen_count(user_id), extra=payload)
+    if not tokens:
+        return
+
+    badges = Notification.unseen_counts(list(tokens))
+
+    messages = []
+    for it in items:
+        payload = build_payload(it['message'], badge=badges.get(it['user'], 0), sound='default', extra=it['payload'])
+        messages.extend((token, payload) for token in tokens[it['user']])
+
+    logger.info('Send {} push messages'.format(len(messages)))
+    invalid = get_connection().send(messages)
+
+    if invalid:
+        logger.info('Deactivate devices {}'.format(invalid))
+        APNSDevice.objects.filter(registration_id__in=invalid).update(active=False)
+
+
+PURGE_CHUNK_SIZE = 1000
+PURGE_MAX_CHUNKS = 50
+
+
+@shared_task(bind=False)
+def purge_seen_notifications():
+    """Removes seen notifications older than Notification.SEEN_TTL by chunks"""
+    from notifications.models import Notification
+
+    expired_at = timezone.now() - Notification.SEEN_TTL
+    for _ in range(PURGE_MAX_CHUNKS):
+        ids = Notification.objects.filter(is_seen=True, created_at__lt=expired_at).order_by('created_at')
+        ids = list(ids.values_list('pk', flat=True)[:PURGE_CHUNK_SIZE])
+        if not ids:
+            return
+
+        Notification.objects.filter(pk__in=ids).delete()
+        logger.info('Removed {} seen notifications'.format(len(ids)))
+
+        if len(ids) < PURGE_CHUNK_SIZE:
+            return
 
 
 @shared_task(bind=False)
@@ -30,7 +155,7 @@ def send_push_notification_to_device(registration_ids, message):
 
 @celery.app.task
 def send_share_notifications(user_id: int, users: List, post_id: int = None, tag: str = None):
-    from notifications.models import Notification
+    from notifications.models import Notification, change_unseen_counts
 
     if not users:
         logger.info('send_share_notifications: users is empty')
@@ -59,20 +184,9 @@ def send_share_notifications(user_id: int, users: List, post_id: int = None, tag
         notifications.append(instance)
 
     Notification.objects.bulk_create(notifications)
+    change_unseen_counts({it: 1 for it in users})
 
     # Send messages
     logger.info('Send share push message %s %s %s %s', user_id, post_id, tag, users)
     notification = notifications[0]
-    devices = APNSDevice.objects.filter(user_id__in=users)
-
-    user_to_device = {it.registration_id: it.user_id for it in devices}
-
-    def get_badge(token):
-        if token not in user_to_device:
-            return 0
-        else:
-            return Notification.unseen_count(user_to_device[token])
-
-    for device in devices:
-        device.send_message(notification.notification_text, sound='default',
-                            badge=get_badge(device.registration_id), extra=notification.push_payload)
+    push_notifications(users, notification.notification_text, notification.push_payload)
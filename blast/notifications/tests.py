@@ -1,10 +1,21 @@
+import binascii
 import json
+import socketserver
+import struct
+import threading
+import time
+from datetime import timedelta
 
 from django.core.urlresolvers import reverse_lazy
+from django.test import override_settings
+from django.utils import timezone
+from push_notifications.models import APNSDevice
 from rest_framework import status
 
 from core.tests import BaseTestCase
-from notifications.models import Notification, FollowRequest
+from notifications.tasks import (push_notifications, purge_seen_notifications,
+                                 PUSH_QUEUE_KEY, PUSH_PROCESSING_KEY)
+from notifications.models import Notification, FollowRequest, UNSEEN_COUNT_KEY
 from posts.models import Post, PostComment
 from users.models import User, UserSettings, Follower
 
@@ -83,6 +94,50 @@ class TestPostUserNotification(BaseTestCase):
         self.assertEqual(notification.other, self.user)
         self.assertEqual(notification.type, Notification.MENTIONED_IN_COMMENT)
 
+    def test_exact_mention(self):
+        self.generate_user('otherwise')
+
+        self.post = Post.objects.create(text='@OTHER, hello!', user=self.user)
+
+        self.assertEqual(list(Notification.objects.values_list('user_id', flat=True)), [self.other.pk])
+
+    def test_mention_settings_changed(self):
+        Post.objects.create(text='@{}, hello!'.format(self.other.username), user=self.user)
+
+        self.other.settings.notify_comments = UserSettings.OFF
+        self.other.settings.save()  # Invalidates cached settings
+
+        Post.objects.create(text='@{}, hello!'.format(self.other.username), user=self.user)
+        self.assertEqual(Notification.objects.filter(type=Notification.MENTIONED_IN_COMMENT).count(), 1)
+
+    def test_post_update_mentions(self):
+        post = Post.objects.create(text='@{}, hello!'.format(self.other.username), user=self.user)
+
+        post = Post.objects.get(pk=post.pk)
+        post.save()  # Text is not changed
+        post.text += ' @{}'.format(self.other.username.upper())
+        post.save()  # Mentioned user is already notified
+        self.assertEqual(Notification.objects.count(), 1)
+
+        another = self.generate_user('another')
+        post.text += ' @another'
+        post.save()
+
+        self.assertEqual(Notification.objects.count(), 2)
+        self.assertTrue(Notification.objects.filter(user=another, post=post).exists())
+
+    def test_post_update_votes(self):
+        post = Post.objects.create(text='Hello', user=self.user)
+        Post.objects.filter(pk=post.pk).update(voted_count=10)
+
+        post = Post.objects.get(pk=post.pk)
+        post.save()
+        self.assertFalse(Notification.objects.filter(type=Notification.VOTES_REACHED).exists())
+
+        post.voted_count = 20
+        post.save()
+        self.assertTrue(Notification.objects.filter(type=Notification.VOTES_REACHED, votes=20).exists())
+
 
 class TestFollowingNotification(BaseTestCase):
     def setUp(self):
@@ -162,6 +217,62 @@ class TestFollowRequest(BaseTestCase):
                                                       follower=self.private_user.pk).exists())
 
 
+class TestUnseenCount(BaseTestCase):
+    url = reverse_lazy('notifications-unseen')
+
+    def setUp(self):
+        super().setUp()
+
+        self.other = self.generate_user('other')
+
+    def get_count(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['count']
+
+    def test_unseen_count(self):
+        Notification.objects.create(user=self.user, other=self.other, type=Notification.STARTED_FOLLOW)
+        self.assertEqual(self.get_count(), 1)  # Counted from db and cached
+
+        Notification.objects.create(user=self.user, other=self.other, type=Notification.STARTED_FOLLOW)
+        follow_request = FollowRequest.objects.create(followee=self.user, follower=self.other)
+        self.assertEqual(self.get_count(), 3)
+
+        follow_request.delete()
+        self.assertEqual(self.get_count(), 2)
+
+        self.client.get(reverse_lazy('notifications-list'))
+        self.assertEqual(self.get_count(), 0)
+        self.assertEqual(int(self.r.get(UNSEEN_COUNT_KEY.format(self.user.pk))), 0)
+
+
+class TestPurgeSeenNotifications(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.other = self.generate_user('other')
+
+    def create_notification(self, is_seen: bool, age: timedelta):
+        notification = Notification.objects.create(user=self.user, other=self.other,
+                                                   type=Notification.STARTED_FOLLOW, is_seen=is_seen)
+        Notification.objects.filter(pk=notification.pk).update(created_at=timezone.now() - age)
+        return notification
+
+    def test_purge(self):
+        old_seen = self.create_notification(True, timedelta(days=2))
+        old_unseen = self.create_notification(False, timedelta(days=2))
+        recent_seen = self.create_notification(True, timedelta(hours=1))
+
+        response = self.client.get(reverse_lazy('notifications-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({it['id'] for it in response.data['results']}, {old_unseen.pk, recent_seen.pk})
+        self.assertTrue(Notification.objects.filter(pk=old_seen.pk).exists())  # Not removed by GET
+
+        purge_seen_notifications()
+
+        self.assertEqual(set(Notification.objects.values_list('pk', flat=True)), {old_unseen.pk, recent_seen.pk})
+
+
 class TestPostCommentNotification(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -186,3 +297,81 @@ class TestPostCommentNotification(BaseTestCase):
         PostComment.objects.create(user=self.user, text='hello!', post=self.post)
 
         self.assertEqual(Notification.objects.all().count(), 0)
+
+
+class APNSStubHandler(socketserver.BaseRequestHandler):
+    """Reads notification frames, answers with error on first frame of invalid token"""
+    def handle(self):
+        while True:
+            header = self.request.recv(5)
+            if len(header) < 5:
+                return
+
+            _, length = struct.unpack('!BI', header)
+            data = b''
+            while len(data) < length:
+                data += self.request.recv(length - len(data))
+
+            items = {}
+            while data:
+                item_id, size = struct.unpack('!BH', data[:3])
+                items[item_id] = data[3:3 + size]
+                data = data[3 + size:]
+
+            token = binascii.hexlify(items[1]).decode('ascii')
+            identifier, = struct.unpack('!I', items[3])
+            if token in self.server.invalid_tokens:
+                self.request.sendall(struct.pack('!BBI', 8, 8, identifier))
+                return
+
+            self.server.messages.append((token, json.loads(items[2].decode('utf-8'))))
+
+
+class PushDispatcherTest(BaseTestCase):
+    token_1 = 'a' * 64
+    token_2 = 'b' * 64
+    invalid_token = 'c' * 64
+
+    def setUp(self):
+        super().setUp()
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), APNSStubHandler)
+        self.server.messages = []
+        self.server.invalid_tokens = {self.invalid_token}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.user1 = self.generate_user('push1')
+        self.user2 = self.generate_user('push2')
+        APNSDevice.objects.create(user=self.user1, registration_id=self.token_1)
+        APNSDevice.objects.create(user=self.user2, registration_id=self.invalid_token)
+        APNSDevice.objects.create(user=self.user2, registration_id=self.token_2)
+
+        Notification.objects.create(user=self.user1, type=Notification.STARTED_FOLLOW, other=self.user2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def wait_messages(self, count):
+        for _ in range(50):
+            if len(self.server.messages) >= count:
+                break
+            time.sleep(0.1)
+
+        return dict(self.server.messages)
+
+    def test_dispatch(self):
+        conf = {'APNS_HOST': '127.0.0.1', 'APNS_PORT': self.server.server_address[1], 'APNS_CERTIFICATE': None}
+        with override_settings(PUSH_NOTIFICATIONS_SETTINGS=conf):
+            push_notifications([self.user1.pk, self.user2.pk], 'message', {'postId': 1})
+
+        messages = self.wait_messages(2)
+        self.assertEqual(set(messages), {self.token_1, self.token_2})
+        self.assertEqual(messages[self.token_1]['aps'], {'alert': 'message', 'badge': 1, 'sound': 'default'})
+        self.assertEqual(messages[self.token_2]['aps']['badge'], 0)
+        self.assertEqual(messages[self.token_2]['postId'], 1)
+
+        self.assertFalse(APNSDevice.objects.get(registration_id=self.invalid_token).active)
+        self.assertFalse(self.r.exists(PUSH_QUEUE_KEY))
+        self.assertFalse(self.r.exists(PUSH_PROCESSING_KEY))
@@ -1,17 +1,17 @@
 from celery.bin.celery import list_
+from django.db.models import Q
 from rest_framework import viewsets, permissions, mixins
 from rest_framework.decorators import list_route
 from rest_framework.response import Response
 
-from notifications.models import Notification, FollowRequest
+from notifications.models import Notification, FollowRequest, change_unseen_counts
+from core.pagination import KeysetPagination
 from core.views import ExtendableModelMixin
 from notifications.serializers import NotificationPublicSerializer, FollowRequestPublicSerializer, \
     FollowRequestSerializer
 
-from  users.models import User, Follower
-from users.serializers import OwnerSerializer
+from users.serializers import serialize_owners
 from users.utils import mark_followee, mark_requested
-import datetime
 from django.utils import timezone
 
 class NotificationsViewSet(ExtendableModelMixin,
@@ -19,18 +19,14 @@ class NotificationsViewSet(ExtendableModelMixin,
     def extend_response_data(self, data):
         request = self.request
 
-        users = {it['other'] for it in data if it['other']}
-        users = list(User.objects.filter(pk__in=users))
-        users = {it.pk: it for it in users}
+        users = serialize_owners({it['other'] for it in data if it['other']}, request)
 
-        context = {'request': request}
         serialized_users = []
         for it in data:
             if not it['other']:
                 continue
 
-            user = users[it['other']]
-            user = OwnerSerializer(instance=user, context=context).data
+            user = dict(users[it['other']])
             serialized_users.append(user)
 
             it['user'] = user
@@ -45,10 +41,14 @@ class NotificationsViewSet(ExtendableModelMixin,
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = NotificationPublicSerializer
 
+    pagination_class = KeysetPagination
+    keyset_ordering = '-id'
+
     def get_queryset(self):
-        time_24_hours_ago = timezone.now() - datetime.timedelta(days=1)
-        Notification.objects.filter(user=self.request.user, is_seen=True, created_at__lt=time_24_hours_ago).delete()
-        return Notification.objects.filter(user=self.request.user)
+        # Old seen notifications are removed by notifications.tasks.purge_seen_notifications
+        expired_at = timezone.now() - Notification.SEEN_TTL
+        qs = Notification.objects.filter(user=self.request.user)
+        return qs.filter(Q(is_seen=False) | Q(created_at__gte=expired_at))
 
     # FIXME: need to write PUT for this action
     def list(self, request, *args, **kwargs):
@@ -57,7 +57,8 @@ class NotificationsViewSet(ExtendableModelMixin,
         ids = {it['id'] for it in results}
 
         # FIXME: need to write PUT for this action
-        Notification.objects.filter(id__in=ids, is_seen=False).update(is_seen=True)
+        seen = Notification.objects.filter(id__in=ids, is_seen=False).update(is_seen=True)
+        change_unseen_counts({request.user.pk: -seen})
 
         return response
 
@@ -90,6 +91,7 @@ class FollowRequestViewSet(mixins.RetrieveModelMixin,
         ids = {it['id'] for it in results}
 
         # FIXME: need to write PUT for this action
-        self.get_queryset().filter(id__in=ids, is_seen=False).update(is_seen=True)
+        seen = self.get_queryset().filter(id__in=ids, is_seen=False).update(is_seen=True)
+        change_unseen_counts({request.user.pk: -seen})
 
         return response
@@ -5,11 +5,10 @@ from rest_framework import viewsets
 
 from core.pagination import DateTimePaginator
 from core.views import ExtendableModelMixin
-from posts.models import Post, PostVote
+from posts.models import Post
 from posts.serializers import PostPublicSerializer
 from posts.utils import extend_posts
-from users.models import User, BlockedUsers
-from users.utils import mark_followee, mark_requested
+from users.models import User
 
 
 # TODO (VM): Add feeds test, check author, hidden posts and voted posts
@@ -32,41 +31,24 @@ class BaseFeedView(ExtendableModelMixin, viewsets.ReadOnlyModelViewSet):
     pagination_class = DateTimePaginator
 
     def extend_response_data(self, data):
+        # Adds author, viewer flags of posts and is_requested, is_followee flags of authors
         extend_posts(data, self.request.user, self.request)
 
-        # Adds is_requested and is_followee flags
-        authors = [it['author'] for it in data if it['author']]
-        mark_followee(authors, self.request.user)
-        mark_requested(authors, self.request.user)
-
     def get_queryset(self):
-        qs = Post.objects.actual()
+        # Blocked users, hidden and voted posts are excluded by filter_page
+        return Post.objects.actual().order_by('-created_at')
 
+    def filter_page(self, posts: list) -> list:
+        """Excludes posts of blocked users, hidden and voted posts from page"""
         user = self.request.user
+        if not user.is_authenticated() or not posts:
+            return posts
 
-        if not user.is_authenticated():
-            return qs
-
-        # Exclude blocked users
-        # FIXME (VM): cache list in redis?
-        blocked = BlockedUsers.objects.filter(user=user)
-        blocked = {it.blocked_id for it in blocked}
-        qs = qs.exclude(user__in=blocked)
-
-        # Exclude hidden posts
-        # FIXME (VM): cache list in redis?
-        hidden = user.hidden_posts.all().values('pk')
-        hidden = {it['pk'] for it in hidden}
-        qs = qs.exclude(pk__in=hidden)
-
-        # Exclude voted posts
-        # FIXME (VM): votes list can be very large
-        # FIXME (VM): cache list in redis?
-        voted = PostVote.objects.filter(user=user.pk).values('post')
-        voted = {it['post'] for it in voted}
-        qs = qs.exclude(pk__in=voted)
+        ids = {it.pk for it in posts}
+        excluded = User.filter_hidden(user.pk, ids) | User.filter_voted(user.pk, ids)
+        blocked = User.filter_blocked(user.pk, {it.user_id for it in posts})
 
-        return qs.order_by('-created_at')
+        return [it for it in posts if it.pk not in excluded and it.user_id not in blocked]
 
     def followees(self):
         user = self.request.user
@@ -84,13 +66,18 @@ class MainFeedView(BaseFeedView):
         if not user.is_authenticated():
             return Post.objects.filter(id__lt=0)  # Empty response :(
 
-        qs = super().get_queryset()
-        qs = qs.filter(Q(user__in=self.followees()) | Q(user_id=user.pk))
+        # Posts of followees are selected by user timeline, see paginate_queryset
+        return super().get_queryset()
 
-        if user.pk != User.objects.anonymous_id:
-            qs = qs.exclude(user_id=User.objects.anonymous_id)
+    def paginate_queryset(self, queryset):
+        user = self.request.user
+        if not user.is_authenticated():
+            return super().paginate_queryset(queryset)
 
-        return qs
+        def timeline(before: tuple or None, count: int):
+            return User.get_feed(user.pk, before, count)
+
+        return self.paginator.paginate_timeline(queryset, self.request, timeline, view=self)
 
 
 class RecentFeedView(BaseFeedView):
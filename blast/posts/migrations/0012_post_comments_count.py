@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_comments_count(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    PostComment = apps.get_model('posts', 'PostComment')
+
+    counters = PostComment.objects.values('post_id').annotate(count=Count('id'))
+    for it in counters:
+        Post.objects.filter(pk=it['post_id']).update(comments_count=it['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0011_auto_20180226_1814'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_comments_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_replies_count(apps, schema_editor):
+    PostComment = apps.get_model('posts', 'PostComment')
+
+    counters = PostComment.objects.exclude(parent=None).values('parent_id').annotate(count=Count('id'))
+    for it in counters:
+        PostComment.objects.filter(pk=it['parent_id']).update(replies_count=it['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0012_post_comments_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postcomment',
+            name='replies_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_replies_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import posts.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0013_postcomment_replies_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='expired_at',
+            field=models.DateTimeField(db_index=True, default=posts.models.get_expiration_date),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import posts.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0014_post_expired_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='thumbnail_135',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to=posts.models.post_thumbnail_upload_dir),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='thumbnail_248',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to=posts.models.post_thumbnail_upload_dir),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Q
+
+
+def queue_thumbnails(apps, schema_editor):
+    """Queues rendering of thumbnails for posts created before posts.tasks.render_thumbnail"""
+    from posts.tasks import generate_thumbnails
+
+    Post = apps.get_model('posts', 'Post')
+
+    posts = Post.objects.exclude(image='').exclude(image=None)
+    posts = posts.filter(Q(thumbnail_135=None) | Q(thumbnail_135='') | Q(thumbnail_248=None) | Q(thumbnail_248=''))
+    for pk in posts.values_list('pk', flat=True).iterator():
+        generate_thumbnails.delay(pk)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0016_videoupload'),
+    ]
+
+    operations = [
+        migrations.RunPython(queue_thumbnails, migrations.RunPython.noop),
+    ]
@@ -1,27 +1,30 @@
 import logging
-import redis
 import os
 import re
+import threading
 import uuid
+from contextlib import contextmanager
 from datetime import timedelta
 
+from django.conf import settings
 from django.db import models
 from django.db.models import F, Q
 from django.utils import timezone
-from django.db.backends.dummy.base import IntegrityError
 
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.utils.safestring import mark_safe
 
+from core.cache import r, batch, pipeline, add_to_cached_set, CACHE_LOCK_KEY
 from notifications.tasks import send_push_notification
 from tags.models import Tag
+from users import search
 from users.models import User, USER_RECENT_POSTS_KEY, UserSettings, Follower
+from imagekit import ImageSpec
 from imagekit.models import ImageSpecField
 from imagekit.processors import ResizeToFill
 
 logger = logging.getLogger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 
 def post_image_upload_dir(instance: User, filename: str):
@@ -38,6 +41,70 @@ def post_upload_dir(instance, filename: str):
     return u'/'.join([u'user', u'videos', filename])
 
 
+# Redis list of storage file names to delete, see posts.tasks.delete_media_files
+MEDIA_DELETE_QUEUE_KEY = 'media:delete'
+
+
+def queue_media_deletion(names: list):
+    if names:
+        r.lpush(MEDIA_DELETE_QUEUE_KEY, *names)
+
+
+# Ids of posts scored by expiration timestamp, claimed by posts.tasks.send_expire_notifications.
+# Deleted posts are left in it and dropped on claim.
+POSTS_EXPIRY_KEY = 'posts:expiry'
+POSTS_EXPIRY_FILLED_KEY = 'posts:expiry:filled'  # Set after all posts are indexed
+POSTS_EXPIRY_FILL_LOCK_KEY = CACHE_LOCK_KEY.format(POSTS_EXPIRY_FILLED_KEY)
+POSTS_EXPIRY_FILL_CHUNK_SIZE = 1000
+POSTS_EXPIRY_FILL_LOCK_TIMEOUT = 60 * 10  # seconds
+
+
+def index_post_expiry(pipe, post_id: int, expired_at):
+    pipe.zadd(POSTS_EXPIRY_KEY, expired_at.timestamp(), post_id)
+
+
+def fill_posts_expiry():
+    """Adds actual posts to expiry index if it was not filled from db"""
+    if r.exists(POSTS_EXPIRY_FILLED_KEY):
+        return
+
+    if not r.set(POSTS_EXPIRY_FILL_LOCK_KEY, 1, nx=True, ex=POSTS_EXPIRY_FILL_LOCK_TIMEOUT):
+        return
+
+    try:
+        posts = Post.objects.actual().filter(is_marked_for_removal=False).order_by('pk')
+        posts = posts.values_list('pk', 'expired_at')
+        last_id = 0
+        while True:
+            chunk = list(posts.filter(pk__gt=last_id)[:POSTS_EXPIRY_FILL_CHUNK_SIZE])
+            if not chunk:
+                break
+
+            with batch() as pipe:
+                for pk, expired_at in chunk:
+                    index_post_expiry(pipe, pk, expired_at)
+
+            last_id = chunk[-1][0]
+
+        r.set(POSTS_EXPIRY_FILLED_KEY, 1)
+    finally:
+        r.delete(POSTS_EXPIRY_FILL_LOCK_KEY)
+
+
+def post_thumbnail_upload_dir(instance, filename: str):
+    return u'/'.join([u'user', u'thumbnails', filename])
+
+
+class PostThumbnail(ImageSpec):
+    """Square JPEG thumbnail of post image, rendered by posts.tasks.render_thumbnail"""
+    format = 'JPEG'
+    options = {'quality': 85, 'progressive': True}
+
+    def __init__(self, source, size: int):
+        super().__init__(source=source)
+        self.processors = [ResizeToFill(size, size)]
+
+
 def get_expiration_date():
     return timezone.now() + timedelta(days=1)
 
@@ -112,7 +179,7 @@ class Post(PostAdminFields,
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    expired_at = models.DateTimeField(default=get_expiration_date)
+    expired_at = models.DateTimeField(default=get_expiration_date, db_index=True)
 
     text = models.CharField(max_length=1024, blank=True)
 
@@ -121,6 +188,13 @@ class Post(PostAdminFields,
     image = models.ImageField(upload_to=post_image_upload_dir, blank=True, null=True)
     video = models.FileField(upload_to=post_upload_dir, blank=True, null=True)
 
+    # Rendered after post creation by posts.tasks.generate_thumbnails,
+    # thumbnails of older posts are queued by 0017_backfill_thumbnails migration.
+    # image_135 and image_248 specs are left for admin previews and their previously generated files.
+    THUMBNAIL_SIZES = (135, 248)
+    thumbnail_135 = models.ImageField(upload_to=post_thumbnail_upload_dir, blank=True, null=True, editable=False)
+    thumbnail_248 = models.ImageField(upload_to=post_thumbnail_upload_dir, blank=True, null=True, editable=False)
+
     image_135 = ImageSpecField(source='image',
                                processors=[ResizeToFill(135, 135)],
                                format='PNG',
@@ -137,6 +211,9 @@ class Post(PostAdminFields,
     downvoted_count = models.PositiveIntegerField(default=0)
     voted_count = models.PositiveIntegerField(default=0)
 
+    # Cache for comments list, updated by PostComment signals.
+    comments_count = models.PositiveIntegerField(default=0)
+
     is_marked_for_removal = models.BooleanField(default=False)
 
     @property
@@ -147,6 +224,21 @@ class Post(PostAdminFields,
     def popularity(self):
         return self.voted_count - self.downvoted_count
 
+    def get_media_files(self) -> list:
+        """Returns storage names of post media with generated thumbnails"""
+        files = []
+        if self.image:
+            files.extend([self.image.name, self.image_135.name, self.image_248.name])
+
+        for it in (self.thumbnail_135, self.thumbnail_248):
+            if it:
+                files.append(it.name)
+
+        if self.video:
+            files.append(self.video.name)
+
+        return files
+
     def get_tag_titles(self):
         expr = re.compile(r'(?:(?<=\s)|^)#(\w*[A-Za-z_]+\w*)', re.IGNORECASE)
         return {it.lower() for it in expr.findall(self.text)}
@@ -157,15 +249,41 @@ class Post(PostAdminFields,
         delta = delta - timedelta(microseconds=delta.microseconds)  # Remove microseconds for pretty printing
         return delta
 
-    def comments_count(self):
-        # TODO (VM): Cache this value to redis
-        return PostComment.objects.filter(post=self.pk).count()
+    # Fields compared with values loaded from db to find changes in post_save handlers
+    TRACKED_FIELDS = ('text', 'voted_count', 'expired_at')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.loaded_values = instance._tracked_values()
+        return instance
+
+    def _tracked_values(self) -> dict:
+        # Deferred fields are not in __dict__ and are not fetched for comparing
+        return {it: self.__dict__[it] for it in self.TRACKED_FIELDS if it in self.__dict__}
+
+    def get_changed_fields(self) -> set:
+        """Returns tracked fields changed since loading, all of them for new post"""
+        loaded = getattr(self, 'loaded_values', {})
+        return {it for it, value in self._tracked_values().items() if it not in loaded or loaded[it] != value}
 
     def save(self, **kwargs):
         if not self.user:
             self.user_id = User.objects.anonymous_id
 
-        return super().save(**kwargs)
+        # Previous values and changed fields are available for post_save handlers
+        self.loaded_values = getattr(self, 'loaded_values', {})
+        self.changed_fields = self.get_changed_fields()
+
+        result = super().save(**kwargs)
+
+        self.loaded_values = self._tracked_values()
+        return result
+
+    def delete(self, **kwargs):
+        # Comments are deleted before post, their handlers skip counters of deleted post
+        with deleting_post(self.pk):
+            return super().delete(**kwargs)
 
     def __str__(self):
         return u'{} {}'.format(self.id, self.user_id)
@@ -196,60 +314,139 @@ class PostComment(TextNotificationMixin, models.Model):
     post = models.ForeignKey(Post, db_index=True)
     text = models.CharField(max_length=1024)
 
-    def replies_count(self):
-        # TODO (VM): Add redis cache
-        return PostComment.objects.filter(parent=self.pk).count()
+    # Cache for replies list, updated by PostComment signals.
+    replies_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return u'{} for post {}'.format(self.pk, self.post)
 
 
+class VideoUpload(models.Model):
+    """
+    Resumable chunked upload of post video.
+    Post is created by posts.tasks.transcode_video when upload is finished and transcoded.
+    """
+    UPLOADING = 0
+    PROCESSING = 1
+    READY = 2
+    FAILED = 3
+
+    STATUSES = (
+        (UPLOADING, 'Uploading'),
+        (PROCESSING, 'Processing'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    user = models.ForeignKey(User, db_index=True)
+    post = models.OneToOneField(Post, blank=True, null=True, on_delete=models.SET_NULL)
+
+    size = models.PositiveIntegerField()
+    offset = models.PositiveIntegerField(default=0)  # Count of received bytes
+    status = models.IntegerField(choices=STATUSES, default=UPLOADING)
+
+    # Post fields, set on finish of upload
+    text = models.CharField(max_length=1024, blank=True)
+    is_anonymous = models.BooleanField(default=False)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(settings.VIDEO_UPLOAD_DIR, '{}.part'.format(self.pk))
+
+    def __str__(self):
+        return u'{} upload of {}'.format(self.pk, self.user_id)
+
+
 USERS_RANGES_COUNT = 4
 
+_local = threading.local()
+
+
+@contextmanager
+def bulk_delete():
+    """
+    Delete signal handlers of posts, votes and comments are skipped inside,
+    caller updates caches and counters of deleted posts by itself.
+    See posts.tasks.clear_expired_posts
+    """
+    _local.bulk_delete = True
+    try:
+        yield
+    finally:
+        _local.bulk_delete = False
+
+
+def is_bulk_delete() -> bool:
+    return getattr(_local, 'bulk_delete', False)
+
+
+@contextmanager
+def deleting_post(post_id: int):
+    """Marks post deleted by Post.delete, see comment_delete_counter"""
+    if not hasattr(_local, 'deleting_posts'):
+        _local.deleting_posts = set()
+
+    _local.deleting_posts.add(post_id)
+    try:
+        yield
+    finally:
+        _local.deleting_posts.discard(post_id)
+
+
+def is_post_deleting(post_id: int) -> bool:
+    return post_id in getattr(_local, 'deleting_posts', ())
+
 
 @receiver(pre_delete, sender=Post, dispatch_uid='on_blast_delete')
 def blast_delete_handler(sender, instance: Post, **kwargs):
+    if is_bulk_delete():
+        return
+
     logging.info('pre_delete for {} post'.format(instance.pk))
-    if instance.video:
-        logger.info('Delete {} image of {} post'.format(instance.image, instance.pk))
-        instance.video.delete()
 
-    if instance.image:
-        logger.info('Delete {} video of {} post'.format(instance.image, instance.pk))
-        instance.image.delete()
+    # Files are deleted by worker
+    queue_media_deletion(instance.get_media_files())
 
     # Remove post from user post set.
+    # zrem of cold cache is no-op, so post set, its size and recent posts are updated in one round trip.
     posts_key = User.redis_posts_key(instance.user_id)
-    if r.exists(posts_key):  # If cache is "hot"
-        r.zrem(posts_key, instance.pk)
-        logging.info('Remove {} from {} cache'.format(instance.pk, posts_key))
-
-    # Updates search range
-    search_range = min(r.zcard(posts_key), USERS_RANGES_COUNT)
-    User.objects.filter(pk=instance.user_id).update(search_range=search_range)
-
-    # Updates user popularity
-    User.objects.filter(pk=instance.user_id).update(popularity=F('popularity') - 1)
-
-    # Update user recent posts
-    key = USER_RECENT_POSTS_KEY.format(instance.user_id)
-    r.lrem(key, 1, instance.pk)
+    pipe = pipeline()
+    pipe.zrem(posts_key, instance.pk)
+    pipe.zcard(posts_key)
+    pipe.lrem(USER_RECENT_POSTS_KEY.format(instance.user_id), 1, instance.pk)
+    _, posts_count, _ = pipe.execute()
+    logging.info('Remove {} from {} cache'.format(instance.pk, posts_key))
+
+    # Updates search range and user popularity
+    search_range = min(posts_count, USERS_RANGES_COUNT)
+    User.objects.filter(pk=instance.user_id).update(search_range=search_range,
+                                                    popularity=F('popularity') - 1)
+    if posts_count <= USERS_RANGES_COUNT:  # Search range is not changed for users with more posts
+        with batch() as pipe:
+            search.rank_user(pipe, instance.user_id, search_range)
+
+    # Remove post from followers timelines
+    from posts.tasks import remove_from_feeds
+    remove_from_feeds.delay(instance.pk, instance.user_id)
 
 
 @receiver(pre_delete, sender=Post, dispatch_uid='post_clear_cache')
 def blast_delete_handle_tags(sender, instance: Post, **kwargs):
+    if is_bulk_delete():
+        return
+
     tags = list(instance.tags.all())
     tags = {it.title for it in tags}
     logging.info('pre_delete: Post. Update tag counters. {}'.format(tags))
-    for it in tags:
-        key = Tag.redis_posts_key(it)
-        logging.info('pre_delete: Post. Update tag {} with key {}'.format(it, key))
-        r.zrem(key, instance.pk)
+    with batch() as pipe:
+        for it in tags:
+            key = Tag.redis_posts_key(it)
+            logging.info('pre_delete: Post. Update tag {} with key {}'.format(it, key))
+            pipe.zrem(key, instance.pk)
 
-    try:
-        Tag.objects.filter(title__in=tags).update(total_posts=F('total_posts') - 1)
-    except IntegrityError as e:
-        logger.error('{}'.format(e))
+        Tag.change_posts_counts(pipe, {it: -1 for it in tags})
 
 
 @receiver(post_save, sender=Post, dispatch_uid='on_blast_save')
@@ -262,19 +459,31 @@ def blast_save_handler(sender, instance: Post, **kwargs):
     if not r.exists(posts_key):
         User.get_posts(instance.user_id, 0, 1)  # Heat up cache
 
-    r.zadd(posts_key, 1, instance.pk)
+    pipe = pipeline()
+    pipe.zadd(posts_key, 1, instance.pk)
+    pipe.zcard(posts_key)
+    pipe.lpush(USER_RECENT_POSTS_KEY.format(instance.user_id), instance.pk)  # Update user recent posts
+    _, posts_count, _ = pipe.execute()
     logging.info('Add {} to {} cache'.format(instance.pk, posts_key))
 
-    # Updates search popularity
-    search_range = min(r.zcard(posts_key), USERS_RANGES_COUNT)
-    User.objects.filter(pk=instance.user_id).update(search_range=search_range)
+    # Updates search range and user popularity
+    search_range = min(posts_count, USERS_RANGES_COUNT)
+    User.objects.filter(pk=instance.user_id).update(search_range=search_range,
+                                                    popularity=F('popularity') + 1)
+    if posts_count <= USERS_RANGES_COUNT:  # Search range is not changed for users with more posts
+        with batch() as pipe:
+            search.rank_user(pipe, instance.user_id, search_range)
 
-    # Updates user popularity
-    User.objects.filter(pk=instance.user_id).update(popularity=F('popularity') + 1)
+    # Push post to followers timelines
+    from posts.tasks import fan_out_post
+    fan_out_post.delay(instance.pk, instance.user_id, instance.created_at.timestamp())
 
-    # Update user recent posts
-    key = USER_RECENT_POSTS_KEY.format(instance.user_id)
-    r.lpush(key, instance.pk)
+
+@receiver(post_save, sender=Post, dispatch_uid='post_save_expiry')
+def blast_save_expiry(sender, instance: Post, **kwargs):
+    if 'expired_at' in instance.changed_fields:
+        with batch() as pipe:
+            index_post_expiry(pipe, instance.pk, instance.expired_at)
 
 
 @receiver(post_save, sender=Post, dispatch_uid='post_create_tags')
@@ -290,28 +499,16 @@ def blast_save_handle_tags(sender, instance: Post, **kwargs):
     if not tags:
         return
 
-    db_tags = Tag.objects.filter(title__in=tags)
-    db_tags = {it.title for it in db_tags}
-    to_create = set(tags) - db_tags
-
-    db_tags = []
-    for it in to_create:
-        db_tags.append(Tag(title=it))
-
-    if db_tags:
-        # FIXME (VM): if two user tries to create a same tags,
-        # it will throw exception for one of them.
-        Tag.objects.bulk_create(db_tags)
-
-    db_tags = list(Tag.objects.filter(title__in=tags))
-    instance.tags.add(*db_tags)
+    # Tags are inserted and linked with post by one statement each
+    Tag.objects.insert_missing(tags)
+    Post.tags.through.objects.bulk_create([Post.tags.through(post_id=instance.pk, tag_id=it) for it in tags])
 
     # Increase total posts counter
-    for it in db_tags:
-        key = Tag.redis_posts_key(it.title)
-        r.zincrby(key, instance.pk)
+    with batch() as pipe:
+        for it in tags:
+            pipe.zincrby(Tag.redis_posts_key(it), instance.pk)
 
-    Tag.objects.filter(title__in=tags).update(total_posts=F('total_posts') + 1)
+        Tag.change_posts_counts(pipe, {it: 1 for it in tags})
 
 
 @receiver(post_save, sender=PostVote, dispatch_uid='posts_post_save_vote_handler')
@@ -334,6 +531,43 @@ def vote_save(sender, instance: PostVote, created: bool, **kwargs):
     instance.post.refresh_from_db()
 
 
+@receiver(post_save, sender=PostVote, dispatch_uid='posts_post_save_voted_set')
+def vote_save_voted_set(sender, instance: PostVote, created: bool, **kwargs):
+    if created:
+        add_to_cached_set(User.redis_voted_key(instance.user_id), instance.post_id)
+
+
+@receiver(post_delete, sender=PostVote, dispatch_uid='posts_post_delete_voted_set')
+def vote_delete_voted_set(sender, instance: PostVote, **kwargs):
+    if is_bulk_delete():  # Ids of deleted posts are left in set, they are never shown again
+        return
+
+    r.srem(User.redis_voted_key(instance.user_id), instance.post_id)
+
+
+@receiver(post_save, sender=PostComment, dispatch_uid='posts_comment_save_counter')
+def comment_save_counter(sender, instance: PostComment, created: bool, **kwargs):
+    if not created:
+        return
+
+    Post.objects.filter(pk=instance.post_id).update(comments_count=F('comments_count') + 1)
+
+    if instance.parent_id:
+        PostComment.objects.filter(pk=instance.parent_id).update(replies_count=F('replies_count') + 1)
+
+
+@receiver(pre_delete, sender=PostComment, dispatch_uid='posts_comment_delete_counter')
+def comment_delete_counter(sender, instance: PostComment, **kwargs):
+    if is_bulk_delete() or is_post_deleting(instance.post_id):  # Commented post is deleted too
+        return
+
+    Post.objects.filter(pk=instance.post_id, comments_count__gt=0).update(comments_count=F('comments_count') - 1)
+
+    if instance.parent_id:
+        replies = PostComment.objects.filter(pk=instance.parent_id, replies_count__gt=0)
+        replies.update(replies_count=F('replies_count') - 1)
+
+
 @receiver(post_save, sender=PostComment, dispatch_uid='blast_comment_notification')
 def blast_comment_notification(sender, instance: PostComment, created, **kwargs):
     from notifications.models import Notification
@@ -1,13 +1,40 @@
+from django.conf import settings
 from rest_framework import serializers
 
-from posts.models import Post, PostComment, PostVote
+from posts.models import Post, PostComment, PostVote, VideoUpload
 
 
 # TODO (VM): Exclude user for anonymous posts
 from users.models import User
 
 
-class PostPublicSerializer(serializers.ModelSerializer):
+class PostThumbnailsMixin(serializers.Serializer):
+    """
+    Thumbnails are rendered in background, original image is returned until they are ready.
+    Imagekit specs are not used here, they render image inside request.
+    """
+    image_135 = serializers.SerializerMethodField()
+    image_248 = serializers.SerializerMethodField()
+
+    def get_thumbnail(self, instance, size: int):
+        image = getattr(instance, 'thumbnail_{}'.format(size)) or instance.image
+        if not image:
+            return None
+
+        request = self.context.get('request', None)
+        if request:
+            return request.build_absolute_uri(image.url)
+
+        return image.url
+
+    def get_image_135(self, instance):
+        return self.get_thumbnail(instance, 135)
+
+    def get_image_248(self, instance):
+        return self.get_thumbnail(instance, 248)
+
+
+class PostPublicSerializer(PostThumbnailsMixin, serializers.ModelSerializer):
     comments = serializers.ReadOnlyField(source='comments_count')
     image = serializers.SerializerMethodField()
     video = serializers.SerializerMethodField()
@@ -17,9 +44,6 @@ class PostPublicSerializer(serializers.ModelSerializer):
 
     is_anonymous = serializers.ReadOnlyField(read_only=True)
 
-    image_135 = serializers.ImageField()
-    image_248 = serializers.ImageField()
-
     def get_image(self, instance):
         request = self.context.get('request', None)
         if request and instance.image:
@@ -37,14 +61,11 @@ class PostPublicSerializer(serializers.ModelSerializer):
     class Meta:
         model = Post
         read_only = ('comments', 'votes', 'downvotes', 'is_anonymous')
-        exclude = ('tags', 'voted_count', 'downvoted_count',)
+        exclude = ('tags', 'voted_count', 'downvoted_count', 'comments_count', 'thumbnail_135', 'thumbnail_248',)
 
 
-class PreviewPostSerializer(serializers.ModelSerializer):
+class PreviewPostSerializer(PostThumbnailsMixin, serializers.ModelSerializer):
     """Serializer with limited fields set for previewing in Notifications"""
-    image_135 = serializers.ImageField()
-    image_248 = serializers.ImageField()
-
     class Meta:
         model = Post
         fields = ('id', 'user', 'image', 'image_135', 'image_248',
@@ -71,12 +92,31 @@ class PostSerializer(serializers.ModelSerializer):
         return super().save()
 
 
+class VideoUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VideoUpload
+        fields = ('id', 'size', 'offset', 'status', 'post',)
+        read_only_fields = ('offset', 'status', 'post',)
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.VIDEO_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError('Size should be from 1 to {} bytes'.format(settings.VIDEO_UPLOAD_MAX_SIZE))
+
+        return value
+
+
+class VideoUploadFinishSerializer(serializers.Serializer):
+    text = serializers.CharField(max_length=1024, required=False, allow_blank=True)
+    is_anonymous = serializers.BooleanField(required=False)
+
+
 class CommentPublicSerializer(serializers.ModelSerializer):
     replies = serializers.ReadOnlyField(source='replies_count')
 
     class Meta:
         model = PostComment
         read_only = ('id', 'created_at', 'user', 'text', 'post', 'parent', 'replies_count')
+        exclude = ('replies_count',)
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -1,191 +1,453 @@
 import logging
+from collections import defaultdict, Counter
 from datetime import timedelta
 
-import itertools
+import os
+import subprocess
+import tempfile
 
-import redis
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import F, Q, Case, When, Value, IntegerField
+from django.db import transaction
 from django.utils import timezone
 
-from push_notifications.models import APNSDevice
+from celery import shared_task, group
 
-from celery import shared_task
-
-from notifications.models import Notification
-from posts.models import Post, PostVote
-from users.models import User, PinnedPosts
+from core.cache import r, batch, pipeline, empty_key, add_to_cached_set
+from notifications.models import Notification, notify_votes_reached, change_unseen_counts
+from notifications.tasks import push_notifications
+from posts.models import (Post, PostVote, PostThumbnail, VideoUpload, USERS_RANGES_COUNT, MEDIA_DELETE_QUEUE_KEY,
+                          POSTS_EXPIRY_KEY, bulk_delete, queue_media_deletion, index_post_expiry, fill_posts_expiry)
+from tags.models import Tag
+from users import search
+from users.models import User, PinnedPosts, USER_FEED_SIZE, USER_RECENT_POSTS_KEY
 
 
 EXPIRE_LIMIT_MINUTES = 10
 
+# Expired posts are removed by chunks, rest of them are removed by next run
+REAPER_CHUNK_SIZE = 500
+REAPER_MAX_CHUNKS = 20
+
+MEDIA_DELETE_ATTEMPTS_KEY = 'media:delete:attempts'
+MEDIA_DELETE_BATCH_SIZE = 100
+MEDIA_DELETE_MAX_BATCHES = 50
+MEDIA_DELETE_MAX_ATTEMPTS = 5
+
 
 logger = logging.getLogger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 
 @shared_task(bind=False)
 def clear_expired_posts():
-    posts = Post.objects.expired()
+    now = timezone.now()
+    for _ in range(REAPER_MAX_CHUNKS):
+        posts = Post.objects.filter(expired_at__lt=now).order_by('expired_at')
+        posts = posts.values_list('pk', 'user_id', 'image', 'video', 'thumbnail_135', 'thumbnail_248')
+        posts = list(posts[:REAPER_CHUNK_SIZE])
+        if not posts:
+            return
+
+        logger.info('Remove {} expired posts'.format(len(posts)))
+        _remove_posts(posts)
+
+        if len(posts) < REAPER_CHUNK_SIZE:
+            return
+
+
+def _counter_case(values: dict) -> Case:
+    """Returns CASE expression with value for each primary key"""
+    return Case(*[When(pk=pk, then=Value(it)) for pk, it in values.items()],
+                default=Value(0), output_field=IntegerField())
+
+
+def _remove_posts(posts: list):
+    """
+    Removes posts with caches and counters updated in bulk.
+    :param posts: list of (id, user_id, image, video, thumbnail_135, thumbnail_248)
+    """
+    ids = [it[0] for it in posts]
+
+    user_posts = defaultdict(list)
+    for pk, user_id, *_ in posts:
+        if user_id is not None:
+            user_posts[user_id].append(pk)
+
+    tag_posts = defaultdict(list)
+    for pk, tag in Post.tags.through.objects.filter(post_id__in=ids).values_list('post_id', 'tag_id'):
+        tag_posts[tag].append(pk)
+
+    pipe = pipeline()
+    for user_id, post_ids in user_posts.items():
+        pipe.zrem(User.redis_posts_key(user_id), *post_ids)
+        for it in post_ids:
+            pipe.lrem(USER_RECENT_POSTS_KEY.format(user_id), 1, it)
+
+    for tag, post_ids in tag_posts.items():
+        pipe.zrem(Tag.redis_posts_key(tag), *post_ids)
+    Tag.change_posts_counts(pipe, {tag: -len(post_ids) for tag, post_ids in tag_posts.items()})
+
+    users = list(user_posts)
+    for it in users:
+        pipe.zcard(User.redis_posts_key(it))
+    posts_count = pipe.execute()[-len(users):] if users else []
 
-    posts = list(posts)
-    if not len(posts):
-        return
+    if users:
+        search_range = {user_id: min(count, USERS_RANGES_COUNT) for user_id, count in zip(users, posts_count)}
+        removed = {user_id: len(post_ids) for user_id, post_ids in user_posts.items()}
+        User.objects.filter(pk__in=users).update(search_range=_counter_case(search_range),
+                                                 popularity=F('popularity') - _counter_case(removed))
+
+        with batch() as pipe:
+            for user_id, value in search_range.items():
+                search.rank_user(pipe, user_id, value)
 
-    logger.info('Remove {} expired posts'.format(len(posts)))
+    _remove_from_feeds(user_posts)
 
-    for it in posts:
-        logger.info('Delete {}'.format(it.pk))
-        # TODO: delete file
-        it.delete()
+    with bulk_delete(), batch():
+        Post.objects.filter(pk__in=ids).delete()
 
+    files = []
+    for pk, _, image, video, thumbnail_135, thumbnail_248 in posts:
+        post = Post(pk=pk, image=image, video=video, thumbnail_135=thumbnail_135, thumbnail_248=thumbnail_248)
+        files.extend(post.get_media_files())
+    queue_media_deletion(files)
 
-def send_ending_soon_notification(post_id: int, users: set, message: str):
-    send_marker_key = 'EndSoonPUSHSendState:{}:{}'.format(post_id, '{}')
-    logger.info('Ending soon PUSH message candidates %s: %s', post_id, users)
 
-    users = [it for it in users if not r.exists(send_marker_key.format(it))]
-    logger.info('Send ending soon PUSH message to %s: %s', post_id, users)
+@shared_task(bind=False)
+def delete_media_files():
+    """
+    Deletes files from MEDIA_DELETE_QUEUE_KEY queue by batches.
+    Failed files are queued again up to MEDIA_DELETE_MAX_ATTEMPTS times.
+    """
+    for _ in range(MEDIA_DELETE_MAX_BATCHES):
+        # Takes oldest files from queue
+        pipe = r.pipeline()
+        pipe.lrange(MEDIA_DELETE_QUEUE_KEY, -MEDIA_DELETE_BATCH_SIZE, -1)
+        pipe.ltrim(MEDIA_DELETE_QUEUE_KEY, 0, -MEDIA_DELETE_BATCH_SIZE - 1)
+        names, _ = pipe.execute()
+        if not names:
+            return
+
+        names = [it.decode('utf-8') for it in names]
+        failed = []
+        for it in names:
+            try:
+                default_storage.delete(it)
+            except Exception:
+                logger.exception('Failed to delete {} file'.format(it))
+                failed.append(it)
+
+        logger.info('Deleted {} files, {} failed'.format(len(names) - len(failed), len(failed)))
+
+        pipe = pipeline()
+        for it in failed:
+            pipe.hincrby(MEDIA_DELETE_ATTEMPTS_KEY, it, 1)
+        attempts = pipe.execute()
+
+        retry = [it for it, count in zip(failed, attempts) if count < MEDIA_DELETE_MAX_ATTEMPTS]
+        done = set(names) - set(retry)
+        for it in set(failed) - set(retry):
+            logger.error('Give up deleting {} file'.format(it))
+
+        pipe = pipeline()
+        if retry:
+            pipe.lpush(MEDIA_DELETE_QUEUE_KEY, *retry)
+        if done:
+            pipe.hdel(MEDIA_DELETE_ATTEMPTS_KEY, *done)
+        pipe.execute()
+
+        if len(names) < MEDIA_DELETE_BATCH_SIZE:
+            return
 
-    devices = APNSDevice.objects.filter(user_id__in=users)
-    token_to_user_id = {it.registration_id: it.user_id for it in devices}
 
-    def get_badge(token):
-        if token not in token_to_user_id:
-            return 0
-        else:
-            return Notification.unseen_count(token_to_user_id[token])
+@shared_task(bind=False)
+def generate_thumbnails(post_id: int):
+    """Renders thumbnails of post image by parallel tasks"""
+    group(render_thumbnail.s(post_id, it) for it in Post.THUMBNAIL_SIZES).delay()
 
-    for device in devices:
-        device.send_message(message, sound='default',
-                            badge=get_badge(device.registration_id), extra={'postId': post_id})
 
-    author_id = Post.objects.get(id=post_id).user_id
-    # Create notifications
-    try:
-        notify_type = None
-        if message == Notification.TEXT_END_SOON_OWNER:
-            notify_type = Notification.ENDING_SOON_OWNER
-        elif message == Notification.TEXT_END_SOON_PINNER:
-            notify_type = Notification.ENDING_SOON_PINNER
-        elif message == Notification.TEXT_END_SOON_UPVOTER:
-            notify_type = Notification.ENDING_SOON_UPVOTER
-        elif message == Notification.TEXT_END_SOON_DOWNVOTER:
-            notify_type = Notification.ENDING_SOON_DOWNVOTER
-
-        logger.info('Creating notifications for %s, %s, notify_type is %s', post_id, users, notify_type)
-        notifications = []
-        for user_id in users:
-            notify = Notification(post_id=post_id, user_id=user_id, other_id=author_id, type=notify_type)
-            notifications.append(notify)
+@shared_task(bind=False)
+def render_thumbnail(post_id: int, size: int):
+    post = Post.objects.filter(pk=post_id).only('pk', 'image').first()
+    if post is None or not post.image:
+        return
 
-        Notification.objects.bulk_create(notifications)
-        logger.info('Created notifications for %s, %s', post_id, users)
+    try:
+        content = PostThumbnail(source=post.image, size=size).generate()
     except Exception:
-        logger.exception("Failed to create notifications for %s %s", post_id, users)
+        logger.exception('Failed to render {} thumbnail for {} post'.format(size, post_id))
+        return
 
-    logger.info('Set up ending soon markers for %s %s', post_id, users)
-    for it in users:
-        key = send_marker_key.format(it)
-        r.set(key, '1', ex=60 * (EXPIRE_LIMIT_MINUTES + 1))
+    field = 'thumbnail_{}'.format(size)
+    thumbnail = getattr(post, field)
+    name, _ = os.path.splitext(os.path.basename(post.image.name))
+    thumbnail.save('{}_{}.jpg'.format(name, size), ContentFile(content.read()), save=False)
 
+    # Only thumbnail field is updated, post could be changed by other tasks
+    updated = Post.objects.filter(pk=post_id).update(**{field: thumbnail.name})
+    if not updated:  # Post was removed while thumbnail was rendered
+        queue_media_deletion([thumbnail.name])
 
-def _get_post_for_users_push_list() -> dict:
-    expired_posts = Post.objects.actual().filter(expired_at__lte=timezone.now() + timedelta(minutes=EXPIRE_LIMIT_MINUTES))
-    expired_posts = expired_posts.filter(is_marked_for_removal=False)
-    expired_posts = expired_posts.values('id', 'user_id')
-    expired_posts = [{'post_id': it['id'], 'user_id': it['user_id']} for it in expired_posts]
-    expired_ids = {it['post_id'] for it in expired_posts}
-    posts = {it['post_id']: it for it in expired_posts}
+    logger.info('Rendered {} thumbnail for {} post'.format(size, post_id))
 
-    if not expired_posts:
+
+TRANSCODE_TIMEOUT = 60 * 10  # seconds
+
+# Upload is finished within a day and transcoded within minutes,
+# so older processing upload was lost by worker
+STUCK_UPLOAD_AGE = timedelta(days=2)
+
+
+def _ffmpeg(*args):
+    subprocess.check_call([settings.FFMPEG_BINARY, '-y', '-loglevel', 'error'] + list(args),
+                          timeout=TRANSCODE_TIMEOUT)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def transcode_video(self, upload_id: int):
+    """Transcodes uploaded video to H.264 MP4, renders poster frame and creates post"""
+    upload = VideoUpload.objects.filter(pk=upload_id, status=VideoUpload.PROCESSING, post__isnull=True).first()
+    if upload is None:
         return
 
-    logger.info('Got ready for removal posts: {}'.format(expired_posts))
+    with tempfile.TemporaryDirectory() as tmp:
+        video_path = os.path.join(tmp, 'video.mp4')
+        poster_path = os.path.join(tmp, 'poster.jpg')
 
-    # Owners
-    own_user_ids = {it['user_id'] for it in expired_posts}
-    own_user_ids = User.objects.filter(id__in=own_user_ids, settings__notify_my_blasts=True)
-    own_user_ids = set(own_user_ids.values_list('id', flat=True))
-    logger.info('Got own_user_ids: {}'.format(own_user_ids))
+        try:
+            _ffmpeg('-i', upload.path, '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+                    '-c:a', 'aac', '-movflags', '+faststart', video_path)
+            _ffmpeg('-i', upload.path, '-frames:v', '1', poster_path)
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.exception('Failed to transcode {} upload'.format(upload_id))
+            if self.request.retries >= self.max_retries:
+                VideoUpload.objects.filter(pk=upload_id).update(status=VideoUpload.FAILED)
+                return
 
-    # Pinned
-    pinned_posts = PinnedPosts.objects.filter(post_id__in=expired_ids)
-    pinned_posts = list(pinned_posts.values('user_id', 'post_id'))
-    logger.info('Got pinned_posts {}'.format(pinned_posts))
+            raise self.retry(exc=e)
 
-    pin_user_ids = {it['user_id'] for it in pinned_posts}
-    pin_user_ids = User.objects.filter(id__in=pin_user_ids, settings__notify_pinned_blasts=True)
-    pin_user_ids = set(pin_user_ids.values_list('id', flat=True))
+        user = User.objects.anonymous if upload.is_anonymous else upload.user
+        post = Post(user=user, text=upload.text)
+        with open(video_path, 'rb') as f:
+            post.video.save('video.mp4', File(f), save=False)
+        with open(poster_path, 'rb') as f:
+            post.image.save('poster.jpg', File(f), save=False)
 
-    def pinned_cond(it):
-        if it['user_id'] not in pin_user_ids:
-            return False
+        # Task can be run again by broker, post is created only for upload without it
+        with transaction.atomic():
+            upload = VideoUpload.objects.select_for_update().filter(pk=upload_id, status=VideoUpload.PROCESSING,
+                                                                   post__isnull=True).first()
+            if upload is None:
+                logger.info('Post of {} upload is already created'.format(upload_id))
+                queue_media_deletion([post.video.name, post.image.name])
+                return
 
-        if it['user_id'] == posts[it['post_id']]['user_id']: # Was user pin own post?
-            return False
+            post.save()
 
-        return True
+            if upload.is_anonymous:
+                PinnedPosts.objects.create(user=upload.user, post=post)
 
-    pinned_posts = list(filter(pinned_cond, pinned_posts))
-    logger.info('Filtered pinned_posts is %s', pinned_posts)
+            upload.post = post
+            upload.status = VideoUpload.READY
+            upload.save(update_fields=['post', 'status'])
 
-    post_to_pinner = {it['post_id']: {it['user_id']} for it in pinned_posts}
+    _remove_upload_file(upload)
+    logger.info('Created {} post from {} upload'.format(post.pk, upload_id))
 
-    # Upvoters and downvoters
-    votes = PostVote.objects.filter(post_id__in=expired_ids)
-    votes = list(votes.values('is_positive', 'post_id', 'user_id'))
-    logger.info('Got votes {}'.format(votes))
+    generate_thumbnails.delay(post.pk)
 
-    def map_post_to_users(is_positive: bool) -> dict:
-        """
-        Maps posts to list of voters
-        :return: dict of post_id to set of user_id
-        """
-        def voters_cond(it):
-            post_id = it['post_id']
-            if it['is_positive'] != is_positive:
-                return False
 
-            if it['user_id'] == posts[post_id]['user_id']:  # Was user vote for own post?
-                return False
+def _remove_upload_file(upload: VideoUpload):
+    """Removes received file of upload, it could be removed already by previous run"""
+    try:
+        os.remove(upload.path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logger.exception('Failed to remove file of {} upload'.format(upload.pk))
+
 
-            if post_id in post_to_pinner and it['user_id'] in post_to_pinner[post_id]:  # Was user pin this post?
-                return False
+@shared_task(bind=False)
+def clear_stale_uploads():
+    """Removes unfinished and failed uploads older than a day and uploads stuck in processing"""
+    now = timezone.now()
+    uploads = VideoUpload.objects.filter(Q(status__in=[VideoUpload.UPLOADING, VideoUpload.FAILED],
+                                           created_at__lt=now - timedelta(days=1)) |
+                                         Q(status=VideoUpload.PROCESSING, post__isnull=True,
+                                           created_at__lt=now - STUCK_UPLOAD_AGE))
+    uploads = list(uploads)
+    for it in uploads:
+        _remove_upload_file(it)
 
-            return True
+    VideoUpload.objects.filter(pk__in=[it.pk for it in uploads]).delete()
+    logger.info('Removed {} stale uploads'.format(len(uploads)))
 
-        votes_subset = list(filter(voters_cond, votes))
-        users_ids = {it['user_id'] for it in votes_subset}
 
-        query = {'id__in': users_ids}
-        if is_positive:
-            query['settings__notify_upvoted_blasts'] = True
+@shared_task(bind=False)
+def fan_out_post(post_id: int, user_id: int, timestamp: float):
+    """Pushes new post to timelines of author and author followers"""
+    users = [user_id]
+    if user_id != User.objects.anonymous_id:  # Anonymous posts are not shown in followers timelines
+        users.extend(User.get_followers(user_id, 0, -1))
+
+    keys = [User.redis_feed_key(it) for it in users]
+
+    # Cold timelines will be built from db on first read
+    pipe = pipeline()
+    for key in keys:
+        pipe.exists(key)
+    exists = pipe.execute()
+
+    pipe = pipeline()
+    for key, is_cached in zip(keys, exists):
+        if is_cached:
+            pipe.zadd(key, timestamp, post_id)
+            pipe.zremrangebyrank(key, 0, -USER_FEED_SIZE - 1)
         else:
-            query['settings__notify_downvoted_blasts'] = True
+            pipe.delete(empty_key(key))  # Timeline is not empty anymore
+    pipe.execute()
+
+    logger.info('Push post {} to {} timelines'.format(post_id, sum(exists)))
 
-        # Excludes user without appropriate settings
-        users_ids = User.objects.filter(**query)
-        users_ids = list(users_ids.values_list('id', flat=True))
-        if is_positive:
-            logger.info('Got post voters: %s', users_ids)
-        else:
-            logger.info('Got post downvoters: %s', users_ids)
 
-        _votes = list(filter(lambda it: it['user_id'] in users_ids, votes_subset))
-        _groups = itertools.groupby(_votes, lambda it: it['post_id'])
-        _groups = {p: {it['user_id'] for it in g} for p, g in _groups}
+def _remove_from_feeds(user_posts: dict):
+    """
+    Removes posts from timelines of authors and their followers.
+    zrem of cold timeline is no-op, it is built from actual posts on first read.
+    :param user_posts: dict of author id to list of post ids
+    """
+    pipe = pipeline()
+    for user_id, post_ids in user_posts.items():
+        users = [user_id]
+        if user_id != User.objects.anonymous_id:
+            users.extend(User.get_followers(user_id, 0, -1))
 
-        logger.debug('map_post_to_user: {}'.format(_groups))
-        return _groups
+        for it in users:
+            pipe.zrem(User.redis_feed_key(it), *post_ids)
+    pipe.execute()
 
-    post_to_owners = {it['post_id']: {it['user_id']} for it in expired_posts if it['user_id'] in own_user_ids}
+
+@shared_task(bind=False)
+def remove_from_feeds(post_id: int, user_id: int):
+    """Removes deleted post from timelines, see fan_out_post"""
+    _remove_from_feeds({user_id: [post_id]})
+
+
+@shared_task(bind=False)
+def process_vote(post_id: int, author_id: int, user_id: int, is_positive: bool, created: bool, voted_count: int):
+    """Handles vote work which is not required for vote response"""
+    if not created:
+        return
+
+    add_to_cached_set(User.redis_voted_key(user_id), post_id)
+
+    if is_positive:
+        notify_votes_reached(post_id, author_id, voted_count)
+
+
+# Marker of sent ending soon notification, formatted by post id and user id
+END_SOON_MARKER_KEY = 'EndSoonPUSHSendState:{}:{}'
+
+# Posts claimed for ending soon notifications, scored by claim timestamp.
+# Claims are removed when notifications are created, claims of failed workers are taken again.
+POSTS_EXPIRY_CLAIMED_KEY = 'posts:expiry:claimed'
+EXPIRY_CLAIM_TIMEOUT = 60 * 5  # seconds
+
+# Moves ids of posts expiring before ARGV[1] and claims older than ARGV[3] to claimed set,
+# so each post is claimed by one worker
+_claim_expiring_posts = r.register_script("""
+local ids = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[3])
+for _, id in ipairs(redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1])) do
+    table.insert(ids, id)
+end
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+
+for _, id in ipairs(ids) do
+    redis.call('zadd', KEYS[2], ARGV[2], id)
+end
+return ids
+""")
+
+
+def _release_claimed_posts(pipe, ids: list):
+    if ids:
+        pipe.zrem(POSTS_EXPIRY_CLAIMED_KEY, *ids)
+
+
+def _claim_expiring_posts_ids() -> list:
+    """Returns ids of posts entered to ending soon window since previous call"""
+    fill_posts_expiry()
+
+    now = timezone.now()
+    limit = now + timedelta(minutes=EXPIRE_LIMIT_MINUTES)
+    args = [limit.timestamp(), now.timestamp(), now.timestamp() - EXPIRY_CLAIM_TIMEOUT]
+    ids = [int(it) for it in _claim_expiring_posts(keys=[POSTS_EXPIRY_KEY, POSTS_EXPIRY_CLAIMED_KEY], args=args)]
+    if not ids:
+        return []
+
+    posts = Post.objects.actual().filter(pk__in=ids, is_marked_for_removal=False).values_list('pk', 'expired_at')
+
+    # Score can be behind db after concurrent votes, such posts are returned to index
+    claimed = []
+    with batch() as pipe:
+        for pk, expired_at in posts:
+            if expired_at <= limit:
+                claimed.append(pk)
+            else:
+                index_post_expiry(pipe, pk, expired_at)
+
+        _release_claimed_posts(pipe, list(set(ids) - set(claimed)))
+
+    return claimed
+
+
+def _get_post_for_users_push_list() -> dict or None:
+    """
+    Claims posts entered to ending soon window
+    :return: dict of category to dict of post id to set of user ids or None if there are not such posts
+    """
+    expired_ids = _claim_expiring_posts_ids()
+    if not expired_ids:
+        return None
+
+    posts = Post.objects.filter(pk__in=expired_ids)
+    posts = list(posts.values_list('pk', 'user_id', 'user__settings__notify_my_blasts'))
+    authors = {pk: user_id for pk, user_id, _ in posts}
+    logger.info('Got ready for removal posts: {}'.format(authors))
+
+    post_to_owners = {pk: {user_id} for pk, user_id, is_notified in posts if is_notified}
+
+    # Pinners except owners
+    pinned_posts = PinnedPosts.objects.filter(post_id__in=expired_ids, user__settings__notify_pinned_blasts=True)
+    post_to_pinner = defaultdict(set)
+    for post_id, user_id in pinned_posts.values_list('post_id', 'user_id'):
+        if user_id != authors[post_id]:
+            post_to_pinner[post_id].add(user_id)
+
+    # Voters except owners and pinners
+    votes = PostVote.objects.filter(Q(is_positive=True, user__settings__notify_upvoted_blasts=True) |
+                                    Q(is_positive=False, user__settings__notify_downvoted_blasts=True),
+                                    post_id__in=expired_ids)
+    voters = {True: defaultdict(set), False: defaultdict(set)}
+    for post_id, user_id, is_positive in votes.values_list('post_id', 'user_id', 'is_positive'):
+        if user_id != authors[post_id] and user_id not in post_to_pinner.get(post_id, ()):
+            voters[is_positive][post_id].add(user_id)
 
     result = {
         'owner': post_to_owners,
-        'pinned': post_to_pinner,
-        'upvote': map_post_to_users(True),
-        'downvote': map_post_to_users(False),
+        'pinned': dict(post_to_pinner),
+        'upvote': dict(voters[True]),
+        'downvote': dict(voters[False]),
     }
 
+    # Posts without recipients are done, others are released after creating notifications
+    with batch() as pipe:
+        _release_claimed_posts(pipe, list(set(expired_ids) - {pk for it in result.values() for pk in it}))
+
     logger.info('_get_post_for_users_push_list result is %s', result)
 
     return result
@@ -193,11 +455,11 @@ def _get_post_for_users_push_list() -> dict:
 
 @shared_task(bind=False)
 def send_expire_notifications():
-    messages = {
-        'owner': Notification.TEXT_END_SOON_OWNER,
-        'pinned': Notification.TEXT_END_SOON_PINNER,
-        'upvote': Notification.TEXT_END_SOON_UPVOTER,
-        'downvote': Notification.TEXT_END_SOON_DOWNVOTER
+    categories = {
+        'owner': (Notification.TEXT_END_SOON_OWNER, Notification.ENDING_SOON_OWNER),
+        'pinned': (Notification.TEXT_END_SOON_PINNER, Notification.ENDING_SOON_PINNER),
+        'upvote': (Notification.TEXT_END_SOON_UPVOTER, Notification.ENDING_SOON_UPVOTER),
+        'downvote': (Notification.TEXT_END_SOON_DOWNVOTER, Notification.ENDING_SOON_DOWNVOTER),
     }
 
     post_dict = _get_post_for_users_push_list()
@@ -206,9 +468,47 @@ def send_expire_notifications():
 
     logger.info('Sending expired PUSH to %s', post_dict)
 
-    for category in post_dict:
-        msg = messages[category]
-        for post_id in post_dict[category]:
-            users = post_dict[category][post_id]
-            logger.info('Sending expired push %s %s %s', category, post_id, users)
-            send_ending_soon_notification(post_id, users, msg)  # TODO: make async
+    recipients = [(category, post_id, user_id)
+                  for category in post_dict
+                  for post_id, users in post_dict[category].items()
+                  for user_id in users]
+
+    # Markers are set in one round trip, user gets notification only if marker was not set before
+    markers = [END_SOON_MARKER_KEY.format(post_id, user_id) for _, post_id, user_id in recipients]
+    pipe = pipeline()
+    for it in markers:
+        pipe.set(it, 1, ex=60 * (EXPIRE_LIMIT_MINUTES + 1), nx=True)
+    is_new = pipe.execute()
+    markers = [it for it, is_set in zip(markers, is_new) if is_set]
+    recipients = [it for it, is_set in zip(recipients, is_new) if is_set]
+
+    authors = dict(Post.objects.filter(pk__in={post_id for _, post_id, _ in recipients}).values_list('pk', 'user_id'))
+
+    groups = defaultdict(list)
+    for category, post_id, user_id in recipients:
+        if post_id in authors:  # Post could be deleted after claim
+            groups[category, post_id].append(user_id)
+
+    notifications = []
+    for (category, post_id), users in groups.items():
+        _, notify_type = categories[category]
+        notifications.extend(Notification(post_id=post_id, user_id=user_id, other_id=authors[post_id], type=notify_type)
+                             for user_id in users)
+
+    # Posts stay claimed and markers are removed if notifications are not created, so they are sent by next run
+    try:
+        Notification.objects.bulk_create(notifications)
+    except Exception:
+        if markers:
+            r.delete(*markers)
+        raise
+
+    with batch() as pipe:
+        _release_claimed_posts(pipe, list({post_id for it in post_dict.values() for post_id in it}))
+
+    change_unseen_counts(Counter(it.user_id for it in notifications))
+
+    for (category, post_id), users in groups.items():
+        message, _ = categories[category]
+        logger.info('Sending expired push %s %s %s', category, post_id, users)
+        push_notifications(users, message, {'postId': post_id})
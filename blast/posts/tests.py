@@ -1,17 +1,25 @@
 import datetime
 
 import itertools
+from unittest import mock
 from django.utils import timezone
+from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse_lazy
 from django.test import TestCase
 from rest_framework import status
 
-from core.tests import BaseTestCase, create_file
+from PIL import Image
+
+from core.tests import BaseTestCase, create_file, create_image
 from countries.models import Country
+from notifications.models import Notification
 from reports.models import Report
+from tags.models import Tag
 from users.models import User, Follower, UserSettings, PinnedPosts
-from posts.models import Post, PostComment, PostVote
-from posts.tasks import send_expire_notifications, _get_post_for_users_push_list
+from posts.models import Post, PostComment, PostVote, VideoUpload, MEDIA_DELETE_QUEUE_KEY, POSTS_EXPIRY_KEY
+from posts.tasks import (send_expire_notifications, _get_post_for_users_push_list, clear_expired_posts,
+                         delete_media_files, POSTS_EXPIRY_CLAIMED_KEY)
+from tags.tasks import flush_tag_counters
 
 
 class AnyPermissionTest(TestCase):
@@ -60,6 +68,23 @@ class PostTest(BaseTestCase):
         file = create_file('test.png')
         self.post = Post.objects.create(user=self.user, text='some_text', video=file)
 
+    def test_create_post_thumbnails(self):
+        response = self.client.post(reverse_lazy('post-list'), {
+            'text': 'text',
+            'image': create_image('test.png'),
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        post = Post.objects.get(pk=response.data['id'])
+        for size in Post.THUMBNAIL_SIZES:
+            thumbnail = getattr(post, 'thumbnail_{}'.format(size))
+            self.assertTrue(thumbnail.name.endswith('_{}.jpg'.format(size)))
+            self.assertEqual(Image.open(thumbnail).size, (size, size))
+
+        response = self.client.get(reverse_lazy('post-detail', kwargs={'pk': post.pk}))
+        self.assertTrue(response.data['image_135'].endswith(post.thumbnail_135.url))
+        self.assertTrue(response.data['image_248'].endswith(post.thumbnail_248.url))
+
     def test_create_post(self):
         url = reverse_lazy('post-list')
 
@@ -104,6 +129,20 @@ class PostTest(BaseTestCase):
 
         self.assertEqual(Post.objects.all().count(), 0)
 
+    def test_author_card_cache(self):
+        url = reverse_lazy('post-detail', kwargs={'pk': self.post.pk})
+
+        response = self.client.get(url)
+        self.assertEqual(response.data['author']['username'], self.user.username)
+        self.assertTrue(self.r.exists(User.redis_card_key(self.user.pk)))
+
+        self.user.username = 'renamed'
+        self.user.save()
+
+        self.assertFalse(self.r.exists(User.redis_card_key(self.user.pk)))
+        response = self.client.get(url)
+        self.assertEqual(response.data['author']['username'], 'renamed')
+
     def test_get_my_private_post(self):
         self.user.is_private = True
         self.user.save()
@@ -170,6 +209,22 @@ class TestIsPinnedPost(BaseTestCase):
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['is_pinned'], True)
 
+    def test_viewer_state(self):
+        other = self.generate_user('other')
+        post = Post.objects.create(user=other)
+        Follower.objects.create(follower=self.user, followee=other)
+        PostVote.objects.create(user=self.user, post=post, is_positive=False)
+
+        url = reverse_lazy('post-detail', kwargs={'pk': post.pk})
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['is_pinned'])
+        self.assertFalse(response.data['is_upvoted'])
+        self.assertTrue(response.data['is_downvoted'])
+        self.assertTrue(response.data['author']['is_followee'])
+        self.assertFalse(response.data['author']['is_requested'])
+
 
 class CommentTest(BaseTestCase):
     url = reverse_lazy('comment-list')
@@ -229,6 +284,37 @@ class CommentTest(BaseTestCase):
 
         self.assertEqual(PostComment.objects.filter(post=self.post, user=self.user).count(), 0)
 
+    def test_comments_count(self):
+        parent = PostComment.objects.create(post=self.post, user=self.user, text='parent')
+        PostComment.objects.create(post=self.post, user=self.user, text='reply', parent=parent)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 2)
+
+        response = self.client.get(reverse_lazy('post-detail', kwargs={'pk': self.post.pk}))
+        self.assertEqual(response.data['comments'], 2)
+
+        parent.delete()  # Reply is deleted by cascade
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 0)
+
+    def test_replies_preview(self):
+        parent = PostComment.objects.create(post=self.post, user=self.user, text='parent')
+        replies = [PostComment.objects.create(post=self.post, user=self.user, text=str(it), parent=parent)
+                   for it in range(5)]
+
+        parent.refresh_from_db()
+        self.assertEqual(parent.replies_count, 5)
+
+        response = self.client.get(self.url, {'parent__is_null': 'true', 'replies_preview': 3})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        result = response.data['results'][0]
+        self.assertEqual(result['replies'], 5)
+        self.assertEqual([it['id'] for it in result['replies_preview']], [it.pk for it in replies[:3]])
+        self.assertEqual(result['replies_preview'][0]['author']['username'], self.user.username)
+
     def test_filter_comments(self):
         url = reverse_lazy('comment-list')
         parent = PostComment.objects.create(post=self.post, text='parent', user=self.user)
@@ -402,6 +488,16 @@ class VoteTest(BaseTestCase):
         delta = (expired_at - self.post.expired_at).total_seconds()
         self.assertEqual(round(delta), extra_time_in_minutes * 60)
 
+    def test_vote_notification(self):
+        Post.objects.filter(pk=self.post.pk).update(voted_count=9)
+
+        response = self.put_json(self.url + 'vote/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['votes'], 10)
+        self.assertTrue(Notification.objects.filter(post=self.post, votes=10,
+                                                    type=Notification.VOTES_REACHED).exists())
+
     def test_twice_vote(self):
         """Checks votes counter for twice vote request"""
         self.post.refresh_from_db()
@@ -561,6 +657,121 @@ class FeedsTest(BaseTestCase):
         self.assertNotIn(should_be_hidden[1], response.data['results'])
 
 
+class MainFeedTest(BaseTestCase):
+    url = reverse_lazy('feed-first-list')
+
+    def setUp(self):
+        super().setUp()
+
+        self.followee = self.generate_user('followee')
+        self.other = self.generate_user('other')
+
+        Follower.objects.create(follower=self.user, followee=self.followee)
+
+    def test_main_feed(self):
+        own = Post.objects.create(user=self.user)
+        followee = Post.objects.create(user=self.followee)
+        Post.objects.create(user=self.other)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [it['id'] for it in response.data['results']]
+        self.assertEqual(ids, [followee.pk, own.pk])
+
+    def test_fan_out_to_hot_timeline(self):
+        Post.objects.create(user=self.user)
+        self.client.get(self.url)  # Heat up timeline
+
+        post = Post.objects.create(user=self.followee)
+        self.assertIsNotNone(self.r.zscore(User.redis_feed_key(self.user.pk), post.pk))
+        self.assertIsNone(self.r.zscore(User.redis_feed_key(self.other.pk), post.pk))
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['results'][0]['id'], post.pk)
+
+    def test_fan_out_to_empty_timeline(self):
+        self.client.get(self.url)  # Empty timeline is remembered
+
+        post = Post.objects.create(user=self.followee)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['results'][0]['id'], post.pk)
+
+    def test_deleted_post_removed_from_timeline(self):
+        post = Post.objects.create(user=self.followee)
+        self.client.get(self.url)
+
+        post.delete()
+        self.assertIsNone(self.r.zscore(User.redis_feed_key(self.user.pk), post.pk))
+
+    def test_unfollow_rebuilds_timeline(self):
+        post = Post.objects.create(user=self.followee)
+        self.client.get(self.url)
+
+        Follower.objects.filter(follower=self.user, followee=self.followee).delete()
+
+        response = self.client.get(self.url)
+        ids = [it['id'] for it in response.data['results']]
+        self.assertNotIn(post.pk, ids)
+
+
+class FeedExclusionTest(BaseTestCase):
+    url = reverse_lazy('feed-first-list')
+
+    def setUp(self):
+        super().setUp()
+
+        self.followee = self.generate_user('followee')
+        Follower.objects.create(follower=self.user, followee=self.followee)
+
+        self.posts = [Post.objects.create(user=self.followee) for _ in range(5)]
+        self.client.get(self.url)  # Heat up exclusion sets
+
+    def get_ids(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {it['id'] for it in response.data['results']}
+
+    def test_hidden_post(self):
+        url = reverse_lazy('post-hide', kwargs={'pk': self.posts[0].pk})
+        self.put_json(url)
+
+        self.assertTrue(self.r.sismember(User.redis_hidden_key(self.user.pk), self.posts[0].pk))
+        self.assertNotIn(self.posts[0].pk, self.get_ids())
+
+        url = reverse_lazy('post-show', kwargs={'pk': self.posts[0].pk})
+        self.put_json(url)
+
+        self.assertIn(self.posts[0].pk, self.get_ids())
+
+    def test_voted_post(self):
+        url = reverse_lazy('post-vote', kwargs={'pk': self.posts[1].pk})
+        self.put_json(url)
+
+        self.assertTrue(self.r.sismember(User.redis_voted_key(self.user.pk), self.posts[1].pk))
+        self.assertNotIn(self.posts[1].pk, self.get_ids())
+
+    def test_blocked_user(self):
+        url = reverse_lazy('user-detail', kwargs={'pk': self.followee.pk})
+        self.put_json(url + 'block/')
+
+        self.assertEqual(self.get_ids(), set())
+
+        self.put_json(url + 'unblock/')
+
+        self.assertEqual(self.get_ids(), {it.pk for it in self.posts})
+
+    def test_page_is_filled_up(self):
+        for it in self.posts[3:]:
+            self.user.hidden_posts.add(it)
+
+        response = self.client.get(self.url, {'page_size': 1})
+        ids = [it['id'] for it in response.data['results']]
+
+        self.assertEqual(ids, [self.posts[2].pk])
+
+
 class VotersList(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -589,6 +800,132 @@ class VotersList(BaseTestCase):
         self.assertEqual(response.data['results'][1]['username'], '1')
         self.assertEqual(response.data['results'][1]['is_followee'], True)
 
+    def test_votes_list_cursor(self):
+        url = reverse_lazy('post-detail', kwargs={'pk': self.post.pk})
+        url += 'voters/'
+
+        usernames = []
+        response = self.client.get(url, {'page_size': 2})
+        self.assertIsNone(response.data['previous'])
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['count'], 3)
+            usernames.extend(it['username'] for it in response.data['results'])
+
+            if not response.data['next']:
+                break
+
+            response = self.client.get(response.data['next'])
+
+        self.assertEqual(usernames, [self.user.username, '1', '2'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([it['username'] for it in response.data['results']], [self.user.username, '1'])
+
+
+class ClearExpiredPostsTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.voter = self.generate_user('voter')
+
+    def test_clear_expired_posts(self):
+        actual = Post.objects.create(user=self.user, text='#reaper')
+        expired = Post.objects.create(user=self.user, text='#reaper')
+        PostVote.objects.create(user=self.voter, post=expired, is_positive=True)
+        PostComment.objects.create(user=self.voter, post=expired, text='comment')
+
+        User.get_posts(self.user.pk, 0, -1)  # Heat up cache
+        Post.objects.filter(pk=expired.pk).update(expired_at=timezone.now() - datetime.timedelta(minutes=1))
+        popularity = User.objects.get(pk=self.user.pk).popularity
+
+        clear_expired_posts()
+
+        self.assertFalse(Post.objects.filter(pk=expired.pk).exists())
+        self.assertFalse(PostVote.objects.filter(post=expired.pk).exists())
+        self.assertFalse(PostComment.objects.filter(post=expired.pk).exists())
+        self.assertTrue(Post.objects.filter(pk=actual.pk).exists())
+
+        self.assertEqual(User.objects.get(pk=self.user.pk).popularity, popularity - 1)
+        flush_tag_counters()
+        self.assertEqual(Tag.objects.get(title='reaper').total_posts, 1)
+        self.assertEqual(User.get_posts(self.user.pk, 0, -1), [actual.pk])
+        self.assertIsNone(self.r.zscore(Tag.redis_posts_key('reaper'), expired.pk))
+
+    def test_clear_expired_post_thumbnails(self):
+        post = Post.objects.create(user=self.user)
+        thumbnails = ['user/thumbnails/test_135.jpg', 'user/thumbnails/test_248.jpg']
+        Post.objects.filter(pk=post.pk).update(thumbnail_135=thumbnails[0], thumbnail_248=thumbnails[1],
+                                               expired_at=timezone.now() - datetime.timedelta(minutes=1))
+
+        clear_expired_posts()
+
+        queued = {it.decode('utf-8') for it in self.r.lrange(MEDIA_DELETE_QUEUE_KEY, 0, -1)}
+        self.assertTrue(set(thumbnails) <= queued)
+
+
+class MediaDeletionTest(BaseTestCase):
+    def test_delete_post_media(self):
+        post = Post.objects.create(user=self.user, image=create_file('test.png'))
+        files = post.get_media_files()
+        self.assertEqual(len(files), 3)  # Image and thumbnails
+
+        post.delete()
+
+        self.assertTrue(default_storage.exists(post.image.name))
+        queued = {it.decode('utf-8') for it in self.r.lrange(MEDIA_DELETE_QUEUE_KEY, 0, -1)}
+        self.assertEqual(queued, set(files))
+
+        delete_media_files()
+
+        self.assertFalse(default_storage.exists(post.image.name))
+        self.assertEqual(self.r.llen(MEDIA_DELETE_QUEUE_KEY), 0)
+
+
+class VideoUploadTest(BaseTestCase):
+    url = reverse_lazy('video-upload-list')
+
+    def put_chunk(self, pk, data: bytes, offset: int):
+        url = reverse_lazy('video-upload-detail', kwargs={'pk': pk})
+        return self.client.put(url, data=data, content_type='application/octet-stream',
+                               HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_chunked_upload(self):
+        response = self.post_json(self.url, {'size': 6})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        pk = response.data['id']
+
+        response = self.put_chunk(pk, b'abc', 0)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['offset'], 3)
+
+        # Client resumes from offset of upload
+        response = self.put_chunk(pk, b'abc', 0)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 3)
+
+        response = self.put_chunk(pk, b'def', 3)
+        self.assertEqual(response.data['offset'], 6)
+
+        finish_url = reverse_lazy('video-upload-finish', kwargs={'pk': pk})
+        with mock.patch('posts.views.transcode_video') as transcode:
+            response = self.post_json(finish_url, {'text': 'video'})
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        transcode.delay.assert_called_once_with(pk)
+
+        upload = VideoUpload.objects.get(pk=pk)
+        self.assertEqual(upload.status, VideoUpload.PROCESSING)
+        with open(upload.path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    def test_finish_incomplete_upload(self):
+        pk = self.post_json(self.url, {'size': 6}).data['id']
+        self.put_chunk(pk, b'abc', 0)
+
+        response = self.post_json(reverse_lazy('video-upload-finish', kwargs={'pk': pk}), {})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
 
 class ExpiredNotificationsTest(BaseTestCase):
     def setUp(self):
@@ -660,3 +997,61 @@ class ExpiredNotificationsTest(BaseTestCase):
         }
 
         self.assertEqual(result, should_be)
+
+    def test_claim_once(self):
+        expired_at = timezone.now() + datetime.timedelta(minutes=5)
+        post = Post.objects.create(user=self.user, expired_at=expired_at)
+        later = Post.objects.create(user=self.user1)
+        PinnedPosts.objects.create(user=self.user1, post=post)
+
+        send_expire_notifications()
+
+        qs = Notification.objects.filter(post=post)
+        self.assertEqual(set(qs.values_list('user_id', 'type')), {
+            (self.user.pk, Notification.ENDING_SOON_OWNER),
+            (self.user1.pk, Notification.ENDING_SOON_PINNER),
+        })
+
+        self.assertIsNone(_get_post_for_users_push_list())  # Post is already claimed
+        self.assertEqual(self.r.zrange(POSTS_EXPIRY_KEY, 0, -1), [str(later.pk).encode()])
+
+        # Post is claimed again after changing of expiration, but markers prevent second notification
+        post.expired_at = expired_at + datetime.timedelta(minutes=1)
+        post.save()
+        send_expire_notifications()
+        self.assertEqual(Notification.objects.filter(post=post).count(), 2)
+
+    def test_deleted_claimed_post(self):
+        expired_at = timezone.now() + datetime.timedelta(minutes=5)
+        deleted = Post.objects.create(user=self.user, expired_at=expired_at)
+        post = Post.objects.create(user=self.user1, expired_at=expired_at)
+
+        # Post is deleted after it is claimed and recipients are found
+        get_push_list = _get_post_for_users_push_list
+
+        def claim_and_delete():
+            result = get_push_list()
+            Post.objects.filter(pk=deleted.pk).delete()
+            return result
+
+        with mock.patch('posts.tasks._get_post_for_users_push_list', claim_and_delete):
+            send_expire_notifications()
+
+        self.assertFalse(Notification.objects.filter(post=deleted.pk).exists())
+        self.assertTrue(Notification.objects.filter(post=post, user=self.user1).exists())
+
+    def test_failed_claim(self):
+        expired_at = timezone.now() + datetime.timedelta(minutes=5)
+        post = Post.objects.create(user=self.user, expired_at=expired_at)
+
+        with mock.patch.object(Notification.objects, 'bulk_create', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                send_expire_notifications()
+
+        self.assertIsNotNone(self.r.zscore(POSTS_EXPIRY_CLAIMED_KEY, post.pk))
+
+        with mock.patch('posts.tasks.EXPIRY_CLAIM_TIMEOUT', -1):  # Claim of failed run is taken again
+            send_expire_notifications()
+
+        self.assertEqual(Notification.objects.filter(post=post, user=self.user).count(), 1)
+        self.assertIsNone(self.r.zscore(POSTS_EXPIRY_CLAIMED_KEY, post.pk))
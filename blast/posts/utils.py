@@ -1,11 +1,14 @@
-from typing import List, Dict
+from typing import List, Dict, Iterable
 
-from posts.models import PostVote
-from users.models import User
+from django.db import connection
+
+from notifications.models import FollowRequest
+from posts.models import PostVote, PostComment
+from users.models import User, Follower, PinnedPosts
 
 
 # TODO: It uses in PostComment.list method and should be refactored.
-from users.serializers import OwnerSerializer
+from users.serializers import serialize_owners
 
 
 def attach_users(items: List[Dict], user: User, request):
@@ -17,20 +20,40 @@ def attach_users(items: List[Dict], user: User, request):
     if not items:
         return items
 
-    users = {it['user'] for it in items if it['user']}
-    users = User.objects.filter(pk__in=users)
-    users = {it.pk: it for it in users}
+    users = serialize_owners({it['user'] for it in items if it['user']}, request)
 
-    context = {'request': request}
     for post in items:
-        user = users[post['user']]
-        author = OwnerSerializer(instance=user, context=context).data
-
-        post['author'] = author
+        post['author'] = dict(users[post['user']])
 
     return items
 
 
+def get_first_replies(parents: Iterable[int], count: int) -> Dict[int, List[PostComment]]:
+    """
+    Returns first replies for each comment in parents by one query
+    :param parents: list of comment ids
+    :param count: max count of replies for each comment
+    :return: dict of parent id to list of replies ordered by creation
+    """
+    parents = set(parents)
+    result = {it: [] for it in parents}
+    if not parents or count <= 0:
+        return result
+
+    # Selects replies which have less than `count` older siblings
+    table = PostComment._meta.db_table
+    replies = PostComment.objects.filter(parent_id__in=parents)
+    replies = replies.extra(where=['(SELECT COUNT(*) FROM {0} AS sibling '
+                                   'WHERE sibling.parent_id = {0}.parent_id AND sibling.id < {0}.id) < %s'.format(table)],
+                            params=[count])
+    replies = replies.order_by('id')
+
+    for it in replies:
+        result[it.parent_id].append(it)
+
+    return result
+
+
 def mark_voted(posts: List, user: User):
     if user.is_anonymous() or len(posts) == 0:
         return posts
@@ -47,24 +70,75 @@ def mark_voted(posts: List, user: User):
     return posts
 
 
-def mark_pinned(posts: list, user: User):
-    # TODO (VM): Make test
+def get_viewer_state(user: User, post_ids: Iterable[int], author_ids: Iterable[int]) -> Dict[str, set]:
     """
-    Adds is_pinned flag to each post dictionary in posts list
-    :return: modified list of posts
+    Returns viewer state for page of posts by one UNION query
+    :return: dict with sets of pinned, upvoted and downvoted post ids
+             and sets of followee and requested author ids
     """
-    if user.is_anonymous() or len(posts) == 0:
-        return posts
+    state = {'pinned': set(), 'upvoted': set(), 'downvoted': set(),
+             'followee': set(), 'requested': set()}
+
+    post_ids = list(set(post_ids))
+    author_ids = list(set(author_ids))
+
+    queries = []
+    params = []
+
+    def add_query(name: str, table: str, user_column: str, id_column: str, ids: list, is_positive=None):
+        if not ids:
+            return
 
-    ids = [it['id'] for it in posts]
-    pinned = user.pinned_posts.filter(id__in=ids).values('id')
-    pinned = [it['id'] for it in pinned]
+        query = "SELECT '{}', {} FROM {} WHERE {} = %s AND {} IN ({})".format(
+            name, id_column, table, user_column, id_column, ', '.join(['%s'] * len(ids)))
+        params.append(user.pk)
+        params.extend(ids)
+
+        if is_positive is not None:
+            query += ' AND is_positive = %s'
+            params.append(is_positive)
+
+        queries.append(query)
+
+    add_query('pinned', PinnedPosts._meta.db_table, 'user_id', 'post_id', post_ids)
+    add_query('upvoted', PostVote._meta.db_table, 'user_id', 'post_id', post_ids, is_positive=True)
+    add_query('downvoted', PostVote._meta.db_table, 'user_id', 'post_id', post_ids, is_positive=False)
+    add_query('followee', Follower._meta.db_table, 'follower_id', 'followee_id', author_ids)
+    add_query('requested', FollowRequest._meta.db_table, 'follower_id', 'followee_id', author_ids)
+
+    if not queries:
+        return state
+
+    with connection.cursor() as cursor:
+        cursor.execute(' UNION ALL '.join(queries), params)
+        for name, pk in cursor.fetchall():
+            state[name].add(pk)
+
+    return state
+
+
+def mark_viewer_state(posts: List[Dict], user: User) -> List[Dict]:
+    """
+    Adds is_pinned, is_upvoted, is_downvoted flags to posts
+    and is_followee, is_requested flags to post authors
+    """
+    authors = [it['author'] for it in posts if it.get('author')]
+
+    if user.is_authenticated():
+        state = get_viewer_state(user, [it['id'] for it in posts], [it['id'] for it in authors])
+    else:
+        state = get_viewer_state(user, [], [])
 
     for post in posts:
-        if post['id'] in pinned:
-            post['is_pinned'] = True
-        else:
-            post['is_pinned'] = False
+        pk = post['id']
+        post['is_pinned'] = pk in state['pinned']
+        post['is_upvoted'] = pk in state['upvoted']
+        post['is_downvoted'] = pk in state['downvoted']
+
+    for author in authors:
+        pk = author['id']
+        author['is_followee'] = pk in state['followee']
+        author['is_requested'] = pk in state['requested']
 
     return posts
 
@@ -75,8 +149,7 @@ def extend_posts(posts: list, user: User, request):
     :param posts: list of dictionaries
     :return: modified posts list
     """
-    data = mark_pinned(posts, user)
-    data = attach_users(data, user, request)
-    data = mark_voted(posts, user)
+    data = attach_users(posts, user, request)
+    data = mark_viewer_state(data, user)
 
-    return data
\ No newline at end of file
+    return data
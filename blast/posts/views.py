@@ -1,6 +1,11 @@
-import redis
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q, F, Case, When, Value
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
@@ -10,16 +15,19 @@ from rest_framework import viewsets, mixins, permissions, status
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
 
+from core.cache import batch
+from core.pagination import KeysetPagination
 from core.views import ExtendableModelMixin
 
-from posts.models import Post, PostComment, PostVote
+from posts.models import Post, PostComment, PostVote, VideoUpload, index_post_expiry
 from posts.serializers import (PostSerializer, PostPublicSerializer,
                                CommentSerializer, CommentPublicSerializer,
-                               VoteSerializer)
+                               VoteSerializer, VideoUploadSerializer, VideoUploadFinishSerializer)
 
 from datetime import timedelta
 
 from notifications.tasks import send_share_notifications
+from posts.tasks import process_vote, generate_thumbnails, transcode_video
 
 from reports.serializers import ReportSerializer
 from tags.models import Tag
@@ -27,14 +35,15 @@ from users.models import User, Follower, BlockedUsers, PinnedPosts
 
 from users.serializers import UsernameSerializer
 
-from posts.utils import attach_users, extend_posts
+from posts.utils import attach_users, extend_posts, get_first_replies
 from users.utils import mark_followee
 from users.utils import mark_requested
 
 import datetime
 from django.utils import timezone
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+VOTE_EXTRA_TIME = timedelta(minutes=5)
+DOWNVOTE_MIN_TIME = timedelta(minutes=10)
 
 
 # FIXME: Replace by custom permission class
@@ -119,8 +128,7 @@ class PostsViewSet(PerObjectPermissionMixin,
         if not self.request.user.is_authenticated():
             return self.queryset.filter(user__is_private=False)
 
-        followees = Follower.objects.filter(follower=self.request.user.pk)
-        followees = {it.followee_id for it in followees}
+        followees = Follower.objects.filter(follower=self.request.user.pk).values('followee_id')
 
         qs = Post.objects.actual()
         qs = qs.filter(Q(user__is_private=False) | Q(user=None) |
@@ -143,11 +151,17 @@ class PostsViewSet(PerObjectPermissionMixin,
         return Response(data[0], status=status.HTTP_201_CREATED, headers=headers)
 
     def perform_create(self, serializer):
-        serializer.save()
+        # Redis writes of post signal handlers are sent in one round trip
+        with batch():
+            serializer.save()
+
         post = serializer.instance
         if post.is_anonymous:
             PinnedPosts.objects.create(user=self.request.user, post=post)
 
+        if post.image:
+            generate_thumbnails.delay(post.pk)
+
     def destroy(self, request, *args, **kwargs):
         """
         Deletes user post
@@ -169,35 +183,55 @@ class PostsViewSet(PerObjectPermissionMixin,
         except Post.DoesNotExist:
             raise Http404()
 
+        # Vote is inserted without signals, counters are updated below by one query
         try:
-            vote = PostVote.objects.get(user=request.user, post=post)
-        except PostVote.DoesNotExist:
-            vote = PostVote(user=request.user, post=post, is_positive=is_positive)
-        # vote, created = PostVote.objects.get_or_create(user=request.user, post=post)
-        vote.is_positive = is_positive
-        vote.save()
-
-        # Increase popularity in tags cache
-        # TODO: Move to post_save for vote?
-        tags = post.get_tag_titles()
-        for tag in tags:
-            key = Tag.redis_posts_key(tag)
-            r.zincrby(key, post.pk, 1 if is_positive else -1)
-
-        if is_positive:
-            post.expired_at += timedelta(minutes=5)
-        else:
-            min_time_in_seconds = 60 * 10
+            with transaction.atomic():
+                PostVote.objects.bulk_create([PostVote(user=request.user, post=post, is_positive=is_positive)])
+            created = True
+        except IntegrityError:
+            PostVote.objects.filter(user=request.user, post=post).update(is_positive=is_positive)
+            created = False
 
-            remains = post.time_remains.total_seconds()
-            if remains > min_time_in_seconds: # Is enough time to downvote?
-                post.expired_at -= timedelta(seconds=min_time_in_seconds)
-                remains = post.time_remains.total_seconds()
+        now = timezone.now()
+        updates = {'updated_at': now}
 
-                if remains < min_time_in_seconds:  # Is too much taken away?
-                    post.expired_at = timezone.now() + timedelta(seconds=min_time_in_seconds)
+        if is_positive:
+            updates['expired_at'] = F('expired_at') + VOTE_EXTRA_TIME
 
-        post.save()
+            if created:
+                updates['voted_count'] = F('voted_count') + 1
+        else:
+            # Takes away time if post has enough time, but leaves at least DOWNVOTE_MIN_TIME
+            limit = now + DOWNVOTE_MIN_TIME
+            updates['expired_at'] = Case(When(expired_at__gt=limit + DOWNVOTE_MIN_TIME,
+                                              then=F('expired_at') - DOWNVOTE_MIN_TIME),
+                                         When(expired_at__gt=limit, then=Value(limit)),
+                                         default=F('expired_at'),
+                                         output_field=models.DateTimeField())
+
+            if created:
+                updates['downvoted_count'] = F('downvoted_count') + 1
+
+        # Counters are read back after update, so concurrent votes are counted in response and notifications
+        with transaction.atomic():
+            posts = Post.objects.filter(pk=post.pk)
+            posts.update(**updates)
+            values = posts.values_list('voted_count', 'downvoted_count', 'expired_at').get()
+
+        post.voted_count, post.downvoted_count, post.expired_at = values
+        post.updated_at = now
+
+        with batch() as pipe:
+            index_post_expiry(pipe, post.pk, post.expired_at)
+
+            if created:
+                # Updates popularity of post in user and tags caches
+                score = 1 if is_positive else -1
+                pipe.zincrby(User.redis_posts_key(post.user_id), post.pk, score)
+                for tag in post.get_tag_titles():
+                    pipe.zincrby(Tag.redis_posts_key(tag), post.pk, score)
+
+        process_vote.delay(post.pk, post.user_id, request.user.pk, is_positive, created, post.voted_count)
 
         serializer = PostPublicSerializer(instance=post)
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -207,7 +241,8 @@ class PostsViewSet(PerObjectPermissionMixin,
         qs = PostVote.objects.filter(post=pk)
         qs = qs.prefetch_related('user')
 
-        page = self.paginate_queryset(qs)
+        paginator = KeysetPagination('created_at')
+        page = paginator.paginate_queryset(qs, request, self)
         users = [it.user for it in page]
 
         serializer = UsernameSerializer(users, many=True,
@@ -216,7 +251,7 @@ class PostsViewSet(PerObjectPermissionMixin,
         mark_followee(serializer.data, self.request.user)
         mark_requested(serializer.data, self.request.user)
 
-        return self.get_paginated_response(serializer.data)
+        return paginator.get_paginated_response(serializer.data, count=qs.count())
 
     @detail_route(methods=['put'])
     def vote(self, request, pk=None):
@@ -356,6 +391,127 @@ class PostsViewSet(PerObjectPermissionMixin,
         return Response({'users': users})
 
 
+class VideoUploadViewSet(mixins.CreateModelMixin,
+                         mixins.RetrieveModelMixin,
+                         viewsets.GenericViewSet):
+    """
+    Resumable chunked upload of video post.
+    Client creates upload with total size, sends chunks by PUT with Upload-Offset header
+    and finishes upload with post fields. Post is created when video is transcoded.
+    ---
+    create:
+        parameters:
+            - name: size
+              description: video size in bytes
+              type: integer
+    retrieve:
+        omit_serializer: true
+        parameters:
+            - name: pk
+              description: upload id, response contains offset to resume from
+    """
+    serializer_class = VideoUploadSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    read_size = 64 * 1024
+
+    def get_queryset(self):
+        return VideoUpload.objects.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        upload = serializer.save(user=self.request.user)
+
+        os.makedirs(settings.VIDEO_UPLOAD_DIR, exist_ok=True)
+        open(upload.path, 'wb').close()
+
+    def update(self, request, *args, **kwargs):
+        """
+        Appends chunk from request body to upload
+
+        ---
+        omit_serializer: true
+        parameters:
+            - name: pk
+              description: upload id
+            - name: Upload-Offset
+              description: offset of chunk, should be equal to offset of upload
+              paramType: header
+        """
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            return Response({'error': 'Upload-Offset header is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not 0 < length <= settings.VIDEO_UPLOAD_CHUNK_SIZE:
+            return Response({'error': 'Chunk size should be from 1 to {} bytes'.format(settings.VIDEO_UPLOAD_CHUNK_SIZE)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        upload = get_object_or_404(self.get_queryset(), pk=kwargs['pk'])
+        if upload.status != VideoUpload.UPLOADING or offset != upload.offset:
+            return Response(self.get_serializer(upload).data, status=status.HTTP_409_CONFLICT)
+
+        if offset + length > upload.size:
+            return Response({'error': 'Chunk is out of upload size'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Chunk is streamed to temporary file without lock, received part is kept if connection is broken
+        with tempfile.TemporaryFile(dir=settings.VIDEO_UPLOAD_DIR) as chunk:
+            while length > 0:
+                data = request.stream.read(min(self.read_size, length))
+                if not data:
+                    break
+
+                chunk.write(data)
+                length -= len(data)
+
+            received = chunk.tell()
+            chunk.seek(0)
+
+            # Upload is locked only to check offset and append received chunk
+            with transaction.atomic():
+                upload = get_object_or_404(self.get_queryset().select_for_update(), pk=kwargs['pk'])
+                if upload.status != VideoUpload.UPLOADING or offset != upload.offset:
+                    return Response(self.get_serializer(upload).data, status=status.HTTP_409_CONFLICT)
+
+                with open(upload.path, 'r+b') as f:
+                    f.seek(offset)
+                    shutil.copyfileobj(chunk, f, self.read_size)
+                    upload.offset += received
+
+                upload.save(update_fields=['offset'])
+
+        return Response(self.get_serializer(upload).data)
+
+    @detail_route(methods=['post'])
+    def finish(self, request, pk=None):
+        """
+        Finishes upload and starts video transcoding
+
+        ---
+        serializer: posts.serializers.VideoUploadFinishSerializer
+        parameters:
+            - name: pk
+              description: upload id
+        """
+        serializer = VideoUploadFinishSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            upload = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+
+            if upload.status != VideoUpload.UPLOADING or upload.offset != upload.size:
+                return Response(self.get_serializer(upload).data, status=status.HTTP_409_CONFLICT)
+
+            upload.text = serializer.validated_data.get('text', '')
+            upload.is_anonymous = serializer.validated_data.get('is_anonymous', False)
+            upload.status = VideoUpload.PROCESSING
+            upload.save()
+
+        transcode_video.delay(upload.pk)
+
+        return Response(self.get_serializer(upload).data, status=status.HTTP_202_ACCEPTED)
+
+
 class PinnedPostsViewSet(ExtendableModelMixin,
                          mixins.ListModelMixin,
                          viewsets.GenericViewSet):
@@ -421,6 +577,20 @@ class CommentsViewSet(PerObjectPermissionMixin,
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('user', 'post', 'parent',)
 
+    max_replies_preview = 10
+
+    def list(self, request, *args, **kwargs):
+        """
+        Returns list of comments
+        ---
+        parameters:
+            - name: replies_preview
+              type: integer
+              description: count of first replies attached to each comment, max is 10
+              paramType: query
+        """
+        return super().list(request, *args, **kwargs)
+
     def get_queryset(self):
         qs = super().get_queryset()
 
@@ -432,8 +602,32 @@ class CommentsViewSet(PerObjectPermissionMixin,
 
         return qs
 
+    def get_replies_preview_count(self):
+        try:
+            count = int(self.request.query_params.get('replies_preview', 0))
+        except ValueError:
+            return 0
+
+        return min(count, self.max_replies_preview)
+
     def extend_response_data(self, data):
-        attach_users(data, self.request.user, self.request)
+        count = self.get_replies_preview_count()
+        if not count:
+            attach_users(data, self.request.user, self.request)
+            return
+
+        parents = [it['id'] for it in data if it['replies']]
+        replies = get_first_replies(parents, count)
+
+        context = self.get_serializer_context()
+        all_replies = []
+        for it in data:
+            preview = CommentPublicSerializer(replies.get(it['id'], []), many=True, context=context).data
+            it['replies_preview'] = preview
+            all_replies.extend(preview)
+
+        # Authors of comments and replies are pulled by one query
+        attach_users(data + all_replies, self.request.user, self.request)
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -489,9 +683,6 @@ class PostSearchViewSet(mixins.ListModelMixin,
     queryset = Post.objects.all()
 
     def get_queryset(self):
-        tag = self.request.query_params.get('tag', '')
-        tags = Tag.objects.filter(title__istartswith=tag)
-        tags = tags.order_by('-total_posts')[:100]
         time_24_hours_ago = timezone.now() - datetime.timedelta(days=1)
 
         # Select first 100 posts assume that search output will be short
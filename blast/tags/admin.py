@@ -5,6 +5,6 @@ from tags.models import Tag
 
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
-    list_display = ('title', 'total_posts', 'posts_count')
-    readonly_fields = ('title', 'total_posts', 'posts_count')
+    list_display = ('title', 'total_posts')
+    readonly_fields = ('title', 'total_posts')
     search_fields = ('title',)
\ No newline at end of file
@@ -1,18 +1,86 @@
 import logging
 import re
-import redis
+from typing import Dict, Iterable, List, Tuple
 
-from django.db import models
+from django.db import models, connections, router, transaction, IntegrityError
 
 # Create your models here.
 from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
+from core.cache import r, batch, pipeline, empty_key, lock, unlock, write_absent, CACHE_LOCK_KEY
 from core.decorators import save_to_zset
 
 
 logger = logging.Logger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+
+# Authoritative counters of posts by tag titles and titles changed since last flush,
+# flushed to Tag.total_posts and rebuilt from db by tags.tasks
+TAG_COUNTERS_KEY = u'tags:counters'
+TAG_COUNTERS_DIRTY_KEY = u'tags:counters:dirty'
+# Exists while counters are rebuilt, collects changes made since counting posts in db
+TAG_COUNTERS_DELTA_KEY = u'tags:counters:delta'
+
+# Changes only filled counters, missing counters are rebuilt from db.
+# Changes made while counters are rebuilt are collected to delta
+_incr_tag_counters = r.register_script("""
+local filled = redis.call('exists', KEYS[1]) == 1
+local reconciling = redis.call('exists', KEYS[3]) == 1
+for i = 1, #ARGV, 2 do
+    if filled then
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    if reconciling then
+        redis.call('hincrby', KEYS[3], ARGV[i], ARGV[i + 1])
+    end
+    if filled or reconciling then
+        redis.call('sadd', KEYS[2], ARGV[i])
+    end
+end
+""")
+
+# Titles of tags starting with prefix scored by count of posts
+TAG_COMPLETIONS_KEY = u'tags:completions:{}'
+TAG_COMPLETIONS_FILLED_KEY = u'tags:completions:filled'  # Set after all tags are added
+TAG_COMPLETIONS_FILL_LOCK_KEY = CACHE_LOCK_KEY.format(TAG_COMPLETIONS_FILLED_KEY)
+TAG_COMPLETIONS_FILL_CHUNK_SIZE = 1000
+TAG_COMPLETIONS_FILL_LOCK_TIMEOUT = 60 * 10  # seconds
+
+
+class TagManager(models.Manager):
+    def insert_missing(self, titles: Iterable[str]):
+        """Inserts tags by one statement, existing and concurrently inserted tags are skipped"""
+        titles = sorted(set(titles))
+        if not titles:
+            return
+
+        connection = connections[router.db_for_write(self.model)]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        values = ', '.join(['(%s, 0)'] * len(titles))
+
+        if connection.vendor == 'postgresql':
+            sql = 'INSERT INTO {} (title, total_posts) VALUES {} ON CONFLICT DO NOTHING'
+        elif connection.vendor == 'sqlite':
+            sql = 'INSERT OR IGNORE INTO {} (title, total_posts) VALUES {}'
+        else:
+            self._insert_missing_by_orm(titles)
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(table, values), titles)
+
+    def _insert_missing_by_orm(self, titles: List[str]):
+        """Inserts tags without upsert statement, tags inserted concurrently are inserted one by one"""
+        existing = set(self.filter(title__in=titles).values_list('title', flat=True))
+        missing = [it for it in titles if it not in existing]
+
+        try:
+            with transaction.atomic():
+                self.bulk_create([self.model(title=it) for it in missing])
+        except IntegrityError:
+            for it in missing:
+                self.get_or_create(title=it)
 
 
 class Tag(models.Model):
@@ -21,23 +89,10 @@ class Tag(models.Model):
     """
     title = models.CharField(max_length=30, unique=True, primary_key=True)
 
-    # Total count of posts for current tag.
+    # Total count of posts for current tag, flushed from TAG_COUNTERS_KEY by tags.tasks.flush_tag_counters
     total_posts = models.PositiveIntegerField(default=0)
 
-    def posts_count(self):
-        from posts.models import Post
-        return Post.objects.filter(tags__title=self.title).count()
-        # key = r.zcard(Tag.redis_posts_key(self.pk))
-        # if not r.exists(key):
-        #     posts = Post.objects.filter(tags__title=self.title).values_list('id', flat=True)
-        #     result = []
-        #     for it in posts:
-        #         result.append(1)
-        #         result.append(it)
-        #     if result:
-        #         r.zadd(key, *result)
-        #
-        # return r.zcard(key)
+    objects = TagManager()
 
     @staticmethod
     def redis_posts_key(pk):
@@ -55,6 +110,150 @@ class Tag(models.Model):
 
         return result
 
+    @staticmethod
+    def get_posts_batch(titles: List[str], start: int, end: int) -> Dict[str, List[int]]:
+        """
+        Returns ids of posts of several tags like get_posts.
+        Caches are read in one round trip and missing ones are filled by one query.
+        """
+        from posts.models import Post
+
+        titles = list(titles)
+        pipe = pipeline()
+        for it in titles:
+            key = Tag.redis_posts_key(it)
+            pipe.exists(key)
+            pipe.exists(empty_key(key))
+            pipe.zrevrange(key, start, end)
+        values = pipe.execute()
+
+        result = {}
+        missing = []
+        for i, title in enumerate(titles):
+            exists, is_empty, ids = values[i * 3:i * 3 + 3]
+            if exists or is_empty:
+                result[title] = [int(it) for it in ids]
+            else:
+                missing.append(title)
+
+        if not missing:
+            return result
+
+        # Tags loaded by other clients are read by get_posts, which waits for them
+        keys = lock(*[Tag.redis_posts_key(it) for it in missing])
+        locked = [it for it in missing if Tag.redis_posts_key(it) in keys]
+        for title in set(missing) - set(locked):
+            result[title] = Tag.get_posts(title, start, end)
+
+        if not locked:
+            return result
+
+        try:
+            logger.debug('Heat up posts cache for {} tags'.format(len(locked)))
+            posts = Post.tags.through.objects.filter(tag_id__in=locked, post__expired_at__gte=timezone.now())
+            posts = posts.values_list('tag_id', 'post_id', 'post__voted_count', 'post__downvoted_count')
+
+            items = {Tag.redis_posts_key(it): [] for it in locked}
+            for title, post_id, voted_count, downvoted_count in posts:
+                items[Tag.redis_posts_key(title)].extend([voted_count - downvoted_count, post_id])
+
+            write_absent(items, lambda pipe, key, values: pipe.zadd(key, *values))
+        finally:
+            unlock(*keys)
+
+        pipe = pipeline()
+        for title in locked:
+            pipe.zrevrange(Tag.redis_posts_key(title), start, end)
+
+        for title, ids in zip(locked, pipe.execute()):
+            result[title] = [int(it) for it in ids]
+
+        return result
+
+    @staticmethod
+    def redis_completions_key(prefix: str):
+        return TAG_COMPLETIONS_KEY.format(prefix)
+
+    @staticmethod
+    def get_prefixes(title: str) -> List[str]:
+        return [title[:i] for i in range(1, len(title) + 1)]
+
+    @staticmethod
+    def change_posts_counts(pipe, counts: Dict[str, int]):
+        """Adds changes to posts counters of tags"""
+        counts = {title: count for title, count in counts.items() if count}
+        if not counts:
+            return
+
+        args = []
+        for title, count in counts.items():
+            args.extend([title, count])
+
+        _incr_tag_counters(keys=[TAG_COUNTERS_KEY, TAG_COUNTERS_DIRTY_KEY, TAG_COUNTERS_DELTA_KEY],
+                           args=args, client=pipe)
+        Tag.change_completions(pipe, counts)
+
+    @staticmethod
+    def get_posts_counts(titles: List[str]) -> Dict[str, int]:
+        """Returns current posts counters of tags, tags are missing if counters are not filled"""
+        titles = list(titles)
+        if not titles:
+            return {}
+
+        counts = r.hmget(TAG_COUNTERS_KEY, titles)
+        return {title: int(count) for title, count in zip(titles, counts) if count is not None}
+
+    @staticmethod
+    def change_completions(pipe, counts: Dict[str, int]):
+        """Adds changes of posts counters to completions, tags without posts are removed"""
+        for title, count in counts.items():
+            for prefix in Tag.get_prefixes(title):
+                key = Tag.redis_completions_key(prefix)
+                pipe.zincrby(key, title, count)
+                if count < 0:
+                    pipe.zremrangebyscore(key, '-inf', 0)
+
+    @staticmethod
+    def fill_completions():
+        """
+        Adds tags with posts to completions if they were not filled from db.
+        Completions are filled by one worker, they are partial until it is done.
+        """
+        if r.exists(TAG_COMPLETIONS_FILLED_KEY):
+            return
+
+        if not r.set(TAG_COMPLETIONS_FILL_LOCK_KEY, 1, nx=True, ex=TAG_COMPLETIONS_FILL_LOCK_TIMEOUT):
+            return
+
+        try:
+            tags = Tag.objects.filter(total_posts__gt=0).order_by('title').values_list('title', 'total_posts')
+            last_title = ''
+            while True:
+                chunk = list(tags.filter(title__gt=last_title)[:TAG_COMPLETIONS_FILL_CHUNK_SIZE])
+                if not chunk:
+                    break
+
+                with batch() as pipe:
+                    for title, total_posts in chunk:
+                        for prefix in Tag.get_prefixes(title):
+                            pipe.zadd(Tag.redis_completions_key(prefix), total_posts, title)
+
+                last_title = chunk[-1][0]
+
+            r.set(TAG_COMPLETIONS_FILLED_KEY, 1)
+        finally:
+            r.delete(TAG_COMPLETIONS_FILL_LOCK_KEY)
+
+    @staticmethod
+    def get_completions(prefix: str, start: int, end: int) -> List[Tuple[str, int]]:
+        """Returns titles and posts counters of most popular tags starting with prefix"""
+        items = r.zrevrange(Tag.redis_completions_key(prefix), start, end, withscores=True)
+        return [(title.decode('utf-8'), int(score)) for title, score in items]
+
+    @staticmethod
+    def count_completions(prefix: str) -> int:
+        return r.zcard(Tag.redis_completions_key(prefix))
+
     def save(self, **kwargs):
         self.title = self.title.lower()
         return super().save(**kwargs)
@@ -65,4 +264,7 @@ class Tag(models.Model):
 
 @receiver(pre_delete, sender=Tag, dispatch_uid='pre_deleted_tag')
 def pre_delete_tag(sender, instance: Tag, **kwargs):
-    r.delete(Tag.redis_posts_key(pk=instance.title))
+    with batch() as pipe:
+        pipe.delete(Tag.redis_posts_key(pk=instance.title))
+        for prefix in Tag.get_prefixes(instance.title):
+            pipe.zrem(Tag.redis_completions_key(prefix), instance.title)
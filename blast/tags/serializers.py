@@ -4,7 +4,7 @@ from tags.models import Tag
 
 
 class TagPublicSerializer(serializers.ModelSerializer):
-    total_posts = serializers.ReadOnlyField(source='posts_count')
+    total_posts = serializers.ReadOnlyField()
 
     class Meta:
         model = Tag
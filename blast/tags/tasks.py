@@ -0,0 +1,126 @@
+import logging
+
+from celery import shared_task
+from django.db.models import Case, When, Value, IntegerField, Count
+
+from core.cache import r, pipeline, CACHE_LOCK_KEY
+from tags.models import Tag, TAG_COUNTERS_KEY, TAG_COUNTERS_DIRTY_KEY, TAG_COUNTERS_DELTA_KEY
+
+logger = logging.getLogger(__name__)
+
+TAG_COUNTERS_CHUNK_SIZE = 500
+
+# Counters counted in db, they replace TAG_COUNTERS_KEY with changes made since counting
+TAG_COUNTERS_NEW_KEY = u'tags:counters:new'
+TAG_COUNTERS_LOCK_KEY = CACHE_LOCK_KEY.format(TAG_COUNTERS_KEY)
+TAG_COUNTERS_LOCK_TIMEOUT = 60 * 10  # seconds
+
+# Pops titles of changed counters, so each change is flushed by one worker
+_pop_dirty_tags = r.register_script("""
+local titles = redis.call('smembers', KEYS[1])
+redis.call('del', KEYS[1])
+return titles
+""")
+
+# Adds changes collected while counting to new counters and replaces current ones
+_replace_tag_counters = r.register_script("""
+local delta = redis.call('hgetall', KEYS[3])
+for i = 1, #delta, 2 do
+    if delta[i] ~= '' then
+        redis.call('hincrby', KEYS[2], delta[i], delta[i + 1])
+    end
+end
+redis.call('del', KEYS[3])
+
+if redis.call('exists', KEYS[2]) == 1 then
+    redis.call('rename', KEYS[2], KEYS[1])
+else
+    redis.call('del', KEYS[1])
+end
+""")
+
+
+def _update_total_posts(counts: dict):
+    """Writes posts counters to tags by chunked UPDATE with CASE"""
+    titles = list(counts)
+    for start in range(0, len(titles), TAG_COUNTERS_CHUNK_SIZE):
+        chunk = titles[start:start + TAG_COUNTERS_CHUNK_SIZE]
+        total_posts = Case(*[When(pk=it, then=Value(max(counts[it], 0))) for it in chunk],
+                           default=Value(0), output_field=IntegerField())
+        Tag.objects.filter(pk__in=chunk).update(total_posts=total_posts)
+
+
+@shared_task(bind=False)
+def flush_tag_counters():
+    """Writes changed posts counters of tags to Tag.total_posts"""
+    if not r.exists(TAG_COUNTERS_KEY):
+        reconcile_tag_counters()
+        return
+
+    titles = [it.decode('utf-8') for it in _pop_dirty_tags(keys=[TAG_COUNTERS_DIRTY_KEY])]
+    if not titles:
+        return
+
+    counts = Tag.get_posts_counts(titles)
+    _update_total_posts(counts)
+    logger.info('Flushed posts counters of {} tags'.format(len(counts)))
+
+
+@shared_task(bind=False)
+def reconcile_tag_counters():
+    """Recounts posts of tags from db and replaces drifted counters and completions"""
+    if not r.set(TAG_COUNTERS_LOCK_KEY, '1', nx=True, ex=TAG_COUNTERS_LOCK_TIMEOUT):
+        logger.info('Tag counters are reconciled by other worker')
+        return
+
+    try:
+        # Counts are read by one statement before collecting delta,
+        # so changes committed while counting are not added twice
+        counts = Tag.objects.annotate(count=Count('post')).values_list('title', 'count', 'total_posts')
+        counts = list(counts)
+
+        # Changes made from now are collected to delta, empty field keeps delta existing
+        pipe = r.pipeline()
+        pipe.delete(TAG_COUNTERS_NEW_KEY)
+        pipe.hset(TAG_COUNTERS_DELTA_KEY, '', 0)
+        pipe.execute()
+
+        changed = {}
+        titles = []
+        mapping = {}
+        for title, count, total_posts in counts:
+            titles.append(title)
+            mapping[title] = count
+            if count != total_posts:
+                changed[title] = count
+
+            if len(mapping) >= TAG_COUNTERS_CHUNK_SIZE:
+                r.hmset(TAG_COUNTERS_NEW_KEY, mapping)
+                mapping = {}
+
+        if mapping:
+            r.hmset(TAG_COUNTERS_NEW_KEY, mapping)
+
+        _replace_tag_counters(keys=[TAG_COUNTERS_KEY, TAG_COUNTERS_NEW_KEY, TAG_COUNTERS_DELTA_KEY])
+    finally:
+        r.delete(TAG_COUNTERS_DELTA_KEY, TAG_COUNTERS_LOCK_KEY)
+
+    # Changes made while counting are in dirty set and flushed by flush_tag_counters
+    _update_total_posts(changed)
+    _rewrite_completions(titles)
+    logger.info('Reconciled posts counters of tags, {} were drifted'.format(len(changed)))
+
+
+def _rewrite_completions(titles: list):
+    """Sets completion scores of tags to reconciled counters"""
+    for start in range(0, len(titles), TAG_COUNTERS_CHUNK_SIZE):
+        counts = Tag.get_posts_counts(titles[start:start + TAG_COUNTERS_CHUNK_SIZE])
+
+        pipe = pipeline()
+        for title, count in counts.items():
+            for prefix in Tag.get_prefixes(title):
+                if count > 0:
+                    pipe.zadd(Tag.redis_completions_key(prefix), count, title)
+                else:
+                    pipe.zrem(Tag.redis_completions_key(prefix), title)
+        pipe.execute()
@@ -1,11 +1,12 @@
-import redis
 from django.core.urlresolvers import reverse_lazy
 from django.test import TestCase
 from rest_framework import status
 
+from core.cache import r, empty_key
 from core.tests import BaseTestCase
 from posts.models import Post
-from tags.models import Tag
+from tags.models import Tag, TAG_COUNTERS_KEY
+from tags.tasks import flush_tag_counters, reconcile_tag_counters
 
 
 class PostTagsTest(BaseTestCase):
@@ -19,6 +20,7 @@ class PostTagsTest(BaseTestCase):
         post = Post.objects.create(text=self.text,
                                    user=self.user)
 
+        flush_tag_counters()
         tags = Tag.objects.all()
 
         self.assertEqual(len(tags), 3)
@@ -32,23 +34,32 @@ class PostTagsTest(BaseTestCase):
         for it in tags:
             self.assertEqual(it.total_posts, 1)
 
+    def test_insert_missing(self):
+        Tag.objects.insert_missing(['hashtag1', 'hashtag2', 'hashtag2'])
+        Tag.objects.insert_missing(['hashtag2', 'hashtag3'])  # Already inserted tags are skipped
+
+        self.assertEqual(set(Tag.objects.values_list('title', flat=True)), {'hashtag1', 'hashtag2', 'hashtag3'})
+
     def test_post_deleted(self):
         total = 5
 
         for it in range(total):
             Post.objects.create(text=self.text, user=self.user)
 
+        flush_tag_counters()  # Counters are filled from db
         tags = Tag.objects.all()
         for it in tags:
             self.assertEqual(it.total_posts, total)
 
         Post.objects.first().delete()
 
+        flush_tag_counters()
         tags = Tag.objects.all()
         for it in tags:
             self.assertEqual(it.total_posts, total - 1)
 
         Post.objects.all().delete()
+        flush_tag_counters()
         tags = Tag.objects.all()
 
         self.assertEqual(len(tags), 3)
@@ -65,7 +76,6 @@ class TagSearchTest(BaseTestCase):
         text = ', '.join(['#' + it for it in self.tags])
 
         # Clear cache
-        r = redis.StrictRedis(host='localhost', port=6379, db=0)
         for tag in self.tags:
             key = Tag.redis_posts_key(tag)
             r.delete(key)
@@ -94,6 +104,20 @@ class TagSearchTest(BaseTestCase):
 
             self.assertEqual(len(result['posts']), 3)
 
+    def test_tag_completions(self):
+        Post.objects.create(text='#testtag3', user=self.user)
+        Post.objects.first().delete()
+
+        url = reverse_lazy('tag-list') + '?search={}'.format('#TestT')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        results = [(it['title'], it['total_posts']) for it in response.data['results']]
+        self.assertEqual(results[0], ('testtag3', 5))
+        self.assertEqual({it for it, _ in results}, {'testtag1', 'testtag2', 'testtag3'})
+
+        self.assertEqual(Tag.get_completions('other', 0, -1), [('othertag', 4)])
+
     def test_post_rank(self):
         """Checks that posts up to top in tag.posts after voting"""
         # Upvote last post
@@ -129,7 +153,6 @@ class TestCacheHeatUp(BaseTestCase):
             self.posts.append(post)
 
     def test_heat_up(self):
-        r = redis.StrictRedis(host='localhost', port=6379, db=0)
         for it in self.tags:
             key = Tag.redis_posts_key(it)
             self.assertTrue(r.exists(key))
@@ -154,6 +177,18 @@ class TestCacheHeatUp(BaseTestCase):
             key = Tag.redis_posts_key(tag)
             self.assertTrue(r.exists(key))
 
+    def test_heat_up_batch(self):
+        Tag.objects.create(title='empty')
+        r.delete(Tag.redis_posts_key('tag1'), Tag.redis_posts_key('tag2'))
+
+        cached = Tag.get_posts('tag3', 0, 2)
+        result = Tag.get_posts_batch(['tag1', 'tag2', 'tag3', 'empty'], 0, 2)
+
+        self.assertEqual(len(cached), 3)
+        self.assertEqual(result, {'tag1': cached, 'tag2': cached, 'tag3': cached, 'empty': []})
+        self.assertTrue(r.exists(Tag.redis_posts_key('tag1')))
+        self.assertTrue(r.exists(empty_key(Tag.redis_posts_key('empty'))))
+
 
 class TestPostCounterInTagModel(BaseTestCase):
     def setUp(self):
@@ -166,29 +201,38 @@ class TestPostCounterInTagModel(BaseTestCase):
             text = ', '.join(['#{}'.format(it) for it in self.tags])
             Post.objects.create(user=self.user, text=text)
 
-    def test_posts_count(self):
-        """Should check count of posts in tag"""
-        tags_db = Tag.objects.all()
-        for tag in tags_db:
+    def assert_counters(self):
+        flush_tag_counters()
+
+        for tag in Tag.objects.all():
             should_be = Post.objects.filter(tags=tag).count()
-            self.assertEqual(tag.posts_count(), should_be)
             self.assertEqual(tag.total_posts, should_be)
+            self.assertEqual(int(self.r.hget(TAG_COUNTERS_KEY, tag.title)), should_be)
+
+    def test_posts_count(self):
+        """Should check count of posts in tag"""
+        self.assert_counters()
 
         posts = Post.objects.filter(tags__title__in=['tag4', 'tag3'])
         for it in posts:
             it.delete()
 
-        tags_db = Tag.objects.all()
-        for tag in tags_db:
-            should_be = Post.objects.filter(tags=tag).count()
-            self.assertEqual(tag.posts_count(), should_be)
-            self.assertEqual(tag.total_posts, should_be)
+        self.assert_counters()
 
         self.clear_cache()
-        for tag in tags_db:
-            should_be = Post.objects.filter(tags=tag).count()
-            self.assertEqual(tag.posts_count(), should_be)
-            self.assertEqual(tag.total_posts, should_be)
+        self.assert_counters()
+
+    def test_reconcile(self):
+        reconcile_tag_counters()
+        Tag.objects.filter(title='tag1').update(total_posts=100)
+        self.r.hset(TAG_COUNTERS_KEY, 'tag2', 100)
+        self.r.zadd(Tag.redis_completions_key('ta'), 100, 'tag2')
+
+        reconcile_tag_counters()
+
+        self.assertEqual(Tag.objects.get(title='tag1').total_posts, 4)
+        self.assertEqual(int(self.r.hget(TAG_COUNTERS_KEY, 'tag2')), 3)
+        self.assertEqual(self.r.zscore(Tag.redis_completions_key('ta'), 'tag2'), 3)
 
         # class TagPinnedSearch(BaseTestCase):
         #
@@ -2,13 +2,13 @@ import logging
 
 import itertools
 from django.shortcuts import get_object_or_404
-import redis
 
-from rest_framework import viewsets, filters, permissions
+from rest_framework import viewsets, permissions
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
-from posts.serializers import PostPublicSerializer
+from posts.serializers import PostPublicSerializer, PreviewPostSerializer
 from notifications.tasks import send_share_notifications
 
 from core.views import ExtendableModelMixin
@@ -21,41 +21,58 @@ from tags.serializers import TagPublicSerializer
 
 
 logger = logging.Logger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 
 def extend_tags(data, serializer_context):
     tags = {it['title'] for it in data}
 
-    # Attaches posts to tags
-    posts = []
-    tags_to_posts = {}
-    for tag in tags:
-        tag_post_ids = Tag.get_posts(tag, 0, 5)
+    # Counters of tags are fresher than flushed total_posts
+    counts = Tag.get_posts_counts(tags)
+    for it in data:
+        it['total_posts'] = counts.get(it['title'], it['total_posts'])
 
-        tags_to_posts[tag] = tag_post_ids
-        posts.extend(tag_post_ids)
+    # Attaches posts to tags
+    tags_to_posts = Tag.get_posts_batch(tags, 0, 5)
 
-    # Pulls posts from db and builds in-memory index
+    # Pulls posts from db and serializes each of them once
+    posts = {it for post_ids in tags_to_posts.values() for it in post_ids}
     posts = Post.objects.actual().filter(pk__in=posts)
-    posts = {it.pk: it for it in posts}
+    posts = PreviewPostSerializer(posts, many=True, context=serializer_context).data
+    posts = {it['id']: it for it in posts}
 
     for it in data:
-        tag_post_ids = tags_to_posts[it['title']]
-        tag_posts = []
+        # Order of posts is defined by zrevrange
+        tag_posts = [posts[post_id] for post_id in tags_to_posts[it['title']] if post_id in posts]
+        it['posts'] = tag_posts[:3]  # FIXME (VM): Magic number?
 
-        for post_id in tag_post_ids:
-            if post_id in posts:
-                tag_posts.append(posts[post_id])
+    return data
 
-            if len(tag_posts) >= 3:  # FIXME (VM): Magic number?
-                break
 
-        # Order of posts is defined by zrevrange
-        serializer = PostPublicSerializer(tag_posts, many=True, context=serializer_context)
-        it['posts'] = serializer.data
+class TagSearchResult(object):
+    """Lazy list of tags found by completions index, paginator takes its count and slice"""
+    def __init__(self, prefix: str):
+        self.prefix = prefix
 
-    return data
+    def count(self) -> int:
+        return Tag.count_completions(self.prefix)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+
+        start = item.start or 0
+        end = -1 if item.stop is None else item.stop - 1
+        if item.stop is not None and item.stop <= start:
+            return []
+
+        return [Tag(title=title, total_posts=total_posts)
+                for title, total_posts in Tag.get_completions(self.prefix, start, end)]
+
+    def __iter__(self):
+        return iter(self[:])
 
 
 # On tags tab the ones pinned will appear at the top then underneath ones that is most popular
@@ -65,11 +82,17 @@ class TagsViewSet(ExtendableModelMixin,
     queryset = Tag.objects.filter(total_posts__gt=0).order_by('-total_posts')
     serializer_class = TagPublicSerializer
 
-    filter_backends = (filters.SearchFilter,)
-    search_fields = ('title',)
-
     permission_classes = (permissions.IsAuthenticated,)
 
+    def filter_queryset(self, queryset):
+        """Finds tags of list by prefix in completions index"""
+        prefix = self.request.query_params.get(api_settings.SEARCH_PARAM, '').strip().lstrip('#').lower()
+        if self.action != 'list' or not prefix:
+            return super().filter_queryset(queryset)
+
+        Tag.fill_completions()
+        return TagSearchResult(prefix)
+
     def extend_response_data(self, data):
         serializer_context = self.get_serializer_context()
         extend_tags(data, serializer_context)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Expression of username__iexact lookup in PostgreSQL backend
+CREATE_INDEX = 'CREATE INDEX users_user_username_upper ON users_user (UPPER(username::text))'
+DROP_INDEX = 'DROP INDEX users_user_username_upper'
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_INDEX)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_INDEX)
+
+
+class Migration(migrations.Migration):
+    """Functional index for case-insensitive lookup of users by username"""
+
+    dependencies = [
+        ('users', '0003_user_last_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -5,21 +5,20 @@ from typing import Set, List
 import logging
 import os
 import uuid
-import redis
 
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser, PermissionsMixin
 )
 from django.db import models
 from django.db.models import F
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.utils import timezone
 
-from core.decorators import save_to_zset, memoize_list
+from core.cache import r, batch, pipeline, empty_key, is_filled, warm_up, add_to_cached_set
+from core.decorators import save_to_zset, memoize_list, memoize_set
 from countries.models import Country
-
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+from users import search
 
 logger = logging.getLogger(__name__)
 
@@ -70,6 +69,17 @@ USER_POSTS_KEY = u'user:{}:posts'
 USER_FOLLOWERS_KEY = u'user:{}:followers'
 USER_FOLLOWEES_KEY = u'user:{}:followees'
 USER_RECENT_POSTS_KEY = u'user:{}:recent:posts'
+USER_FEED_KEY = u'user:{}:feed'
+USER_VOTED_KEY = u'user:{}:voted'
+USER_HIDDEN_KEY = u'user:{}:hidden'
+USER_BLOCKED_KEY = u'user:{}:blocked'
+USER_CARD_KEY = u'user:{}:card'
+
+USER_CARD_TTL = 60 * 60 * 24
+USER_SETS_TTL = 60 * 60 * 24 * 7  # Voted, hidden and blocked sets of inactive user expire in a week
+
+USER_FEED_SIZE = 1000  # Max count of post ids in materialized timeline
+USER_FEED_TTL = 60 * 60 * 24 * 7  # Timeline of inactive user expires in a week
 
 
 class User(AbstractBaseUser, PermissionsMixin):
@@ -156,6 +166,97 @@ class User(AbstractBaseUser, PermissionsMixin):
     def redis_followees_key(pk: int):
         return USER_FOLLOWEES_KEY.format(pk)
 
+    @staticmethod
+    def redis_feed_key(pk: int):
+        return USER_FEED_KEY.format(pk)
+
+    @staticmethod
+    def redis_voted_key(pk: int):
+        return USER_VOTED_KEY.format(pk)
+
+    @staticmethod
+    def redis_hidden_key(pk: int):
+        return USER_HIDDEN_KEY.format(pk)
+
+    @staticmethod
+    def redis_blocked_key(pk: int):
+        return USER_BLOCKED_KEY.format(pk)
+
+    @staticmethod
+    def redis_card_key(pk: int):
+        return USER_CARD_KEY.format(pk)
+
+    @staticmethod
+    @memoize_set(USER_VOTED_KEY, ttl=USER_SETS_TTL)
+    def filter_voted(user_id: int):
+        """Returns subset of given post ids voted by user"""
+        from posts.models import PostVote
+        return list(PostVote.objects.filter(user=user_id).values_list('post_id', flat=True))
+
+    @staticmethod
+    @memoize_set(USER_HIDDEN_KEY, ttl=USER_SETS_TTL)
+    def filter_hidden(user_id: int):
+        """Returns subset of given post ids hidden by user"""
+        hidden = User.hidden_posts.through.objects.filter(user_id=user_id)
+        return list(hidden.values_list('post_id', flat=True))
+
+    @staticmethod
+    @memoize_set(USER_BLOCKED_KEY, ttl=USER_SETS_TTL)
+    def filter_blocked(user_id: int):
+        """Returns subset of given user ids blocked by user"""
+        return list(BlockedUsers.objects.filter(user=user_id).values_list('blocked_id', flat=True))
+
+    @staticmethod
+    def get_feed(user_id: int, before: tuple or None, count: int) -> List[tuple]:
+        """
+        Returns (id, timestamp) pairs of posts from user timeline older than before (timestamp, id) key.
+        Timeline is a sorted set of post ids scored by creation timestamp,
+        it is filled up by posts.tasks.fan_out_post.
+        """
+        key = User.redis_feed_key(user_id)
+        if not is_filled(key):
+            logger.debug('Heat up cache for {}'.format(key))
+
+            def load():
+                from posts.models import Post
+
+                followees = Follower.objects.filter(follower=user_id).values('followee_id')
+                posts = Post.objects.actual().filter(models.Q(user__in=followees) | models.Q(user=user_id))
+                if user_id != User.objects.anonymous_id:
+                    posts = posts.exclude(user=User.objects.anonymous_id)
+
+                posts = posts.order_by('-created_at').values_list('pk', 'created_at')[:USER_FEED_SIZE]
+
+                result = []
+                for pk, created_at in posts:
+                    result.append(created_at.timestamp())
+                    result.append(pk)
+
+                return result
+
+            warm_up(key, load, lambda pipe, items: pipe.zadd(key, *items))
+
+        pipe = pipeline()
+        pipe.expire(key, USER_FEED_TTL)
+
+        if before is None:
+            pipe.zrevrangebyscore(key, '+inf', '-inf', start=0, num=count, withscores=True)
+            _, items = pipe.execute()
+            return [(int(pk), score) for pk, score in items]
+
+        # Posts with the same timestamp are ordered by id,
+        # so range is fetched including boundary and filtered by key
+        before_score, before_pk = before
+        pipe.zrevrangebyscore(key, before_score, '-inf', start=0, num=count * 2, withscores=True)
+        _, items = pipe.execute()
+        items = sorted(((score, int(pk)) for pk, score in items), reverse=True)
+        if before_pk is None:
+            items = [it for it in items if it[0] < before_score]
+        else:
+            items = [it for it in items if it < (before_score, before_pk)]
+
+        return [(pk, score) for score, pk in items[:count]]
+
     @staticmethod
     @save_to_zset(USER_POSTS_KEY)
     def get_posts(user_id: int, start: int, end: int):
@@ -206,17 +307,27 @@ class User(AbstractBaseUser, PermissionsMixin):
     def followers_count(self):
         # return Follower.objects.filter(followee_id=self.pk).count()
         key = User.redis_followers_key(self.pk)
-        if not r.exists(key):
+        pipe = pipeline()
+        pipe.exists(key)
+        pipe.zcard(key)
+        exists, count = pipe.execute()
+        if not exists:
             User.get_followers(self.pk, 0, 1)  # Heat up cache
+            count = r.zcard(key)
 
-        return r.zcard(key)
+        return count
 
     def following_count(self):
         key = User.redis_followees_key(self.pk)
-        if not r.exists(key):
+        pipe = pipeline()
+        pipe.exists(key)
+        pipe.zcard(key)
+        exists, count = pipe.execute()
+        if not exists:
             User.get_followees(self.pk, 0, 1)  # Heat up cache
+            count = r.zcard(key)
 
-        return r.zcard(key)
+        return count
 
     def blasts_count(self):
         # key = User.redis_posts_key(self.pk)
@@ -267,10 +378,7 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     @staticmethod
     def get_users_count():
-        if r.exists(User.USERS_ZSET_KEY):
-            return r.zcard(User.USERS_ZSET_KEY)
-        else:
-            return 0
+        return r.zcard(User.USERS_ZSET_KEY)  # zcard of missing key is 0
 
     @property
     def is_staff(self):
@@ -357,8 +465,9 @@ def post_user_created(sender, instance: User, **kwargs):
         return
 
     # add user to set of all users.
-    r.sadd(User.USERS_SET_KEY, instance.pk)
-    r.zadd(User.USERS_ZSET_KEY, 1, instance.pk)
+    with batch() as pipe:
+        pipe.sadd(User.USERS_SET_KEY, instance.pk)
+        pipe.zadd(User.USERS_ZSET_KEY, 1, instance.pk)
 
     # Creates settings for user
     UserSettings.objects.create(user=instance)
@@ -369,34 +478,94 @@ def post_user_created(sender, instance: User, **kwargs):
                                 followee_id=User.objects.anonymous_id)
 
 
+@receiver(post_save, sender=User, dispatch_uid='users_post_user_save_search')
+def post_user_save_search(sender, instance: User, update_fields=None, **kwargs):
+    if update_fields and not {'username', 'fullname', 'search_range'} & set(update_fields):
+        return
+
+    with batch() as pipe:
+        search.index_user(pipe, instance.pk, instance.username, instance.fullname, instance.search_range)
+
+
+@receiver(post_delete, sender=User, dispatch_uid='users_post_user_delete_search')
+def post_user_delete_search(sender, instance: User, **kwargs):
+    with batch() as pipe:
+        search.remove_user(pipe, instance.pk)
+
+
+@receiver(post_save, sender=User, dispatch_uid='users_post_user_save_card')
+def post_user_save_card(sender, instance: User, **kwargs):
+    # Author card will be cached again on next read
+    r.delete(User.redis_card_key(instance.pk))
+
+
 @receiver(post_save, sender=Follower, dispatch_uid='update_user_popularity_positive')
 def update_user_popularity_positive(sender, instance: Follower, **kwargs):
     if not kwargs['created']:
         return
 
-    # TODO: Check cache exists
-    r.zincrby(User.USERS_ZSET_KEY, instance.followee_id, 1)
     User.objects.filter(pk=instance.followee_id).update(popularity=F('popularity') + 1)
 
-    # Updates followers cache
-    key = User.redis_followers_key(instance.followee_id)
-    r.zadd(key, instance.follower_id, instance.follower_id)
+    with batch() as pipe:
+        # TODO: Check cache exists
+        pipe.zincrby(User.USERS_ZSET_KEY, instance.followee_id, 1)
+
+        # Updates followers cache
+        key = User.redis_followers_key(instance.followee_id)
+        pipe.zadd(key, instance.follower_id, instance.follower_id)
 
-    key = User.redis_followees_key(instance.follower_id)
-    r.zadd(key, instance.followee_id, instance.followee_id)
+        key = User.redis_followees_key(instance.follower_id)
+        pipe.zadd(key, instance.followee_id, instance.followee_id)
+
+        # Timeline of follower will be rebuilt with posts of new followee
+        pipe.delete(User.redis_feed_key(instance.follower_id))
 
 
 @receiver(pre_delete, sender=Follower, dispatch_uid='update_user_popularity_negative')
 def update_user_popularity_negative(sender, instance: Follower, **kwargs):
-    # TODO: Check cache exists
-    r.zincrby(User.USERS_ZSET_KEY, instance.followee_id, -1)
-
     User.objects.filter(pk=instance.followee_id).update(popularity=F('popularity') - 1)
 
-    # Updates followers cache
-    key = User.redis_followers_key(instance.followee_id)
-    r.zrem(key, instance.follower_id)
+    with batch() as pipe:
+        # TODO: Check cache exists
+        pipe.zincrby(User.USERS_ZSET_KEY, instance.followee_id, -1)
+
+        # Updates followers cache
+        key = User.redis_followers_key(instance.followee_id)
+        pipe.zrem(key, instance.follower_id)
+
+        # Updates followees cache
+        key = User.redis_followees_key(instance.follower_id)
+        pipe.zrem(key, instance.followee_id)
+
+        # Timeline of follower will be rebuilt without posts of old followee
+        pipe.delete(User.redis_feed_key(instance.follower_id))
+
+
+@receiver(m2m_changed, sender=User.hidden_posts.through, dispatch_uid='users_hidden_posts_changed')
+def hidden_posts_changed(sender, instance, action: str, reverse: bool, pk_set: set, **kwargs):
+    if reverse:  # Post.hidden_users was changed, instance is post
+        if action.startswith('post_'):
+            keys = [User.redis_hidden_key(it) for it in pk_set or []]
+            keys.extend([empty_key(it) for it in keys])
+            if keys:
+                r.delete(*keys)
+        return
+
+    key = User.redis_hidden_key(instance.pk)
+    if action == 'post_add' and pk_set:
+        add_to_cached_set(key, *pk_set)
+    elif action == 'post_remove' and pk_set:
+        r.srem(key, *pk_set)
+    elif action == 'post_clear':
+        r.delete(key)
+
+
+@receiver(post_save, sender=BlockedUsers, dispatch_uid='users_blocked_user_save')
+def blocked_user_save(sender, instance: BlockedUsers, created: bool, **kwargs):
+    if created:
+        add_to_cached_set(User.redis_blocked_key(instance.user_id), instance.blocked_id)
+
 
-    # Updates followees cache
-    key = User.redis_followees_key(instance.follower_id)
-    r.zrem(key, instance.followee_id)
+@receiver(post_delete, sender=BlockedUsers, dispatch_uid='users_blocked_user_delete')
+def blocked_user_delete(sender, instance: BlockedUsers, **kwargs):
+    r.srem(User.redis_blocked_key(instance.user_id), instance.blocked_id)
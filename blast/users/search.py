@@ -0,0 +1,197 @@
+"""
+Autocomplete index of users.
+
+Each prefix of username, its parts and words of full name has sorted set of
+'<lowercase username>\\x00<id>' members scored by negative search range,
+so ZRANGE returns users in order of users.views.UserSearchView:
+by search range descending, then by username.
+
+Members of all users are also kept with zero score in USERNAMES_KEY,
+so users.views.UsernameSearchView finds username prefix by ZRANGEBYLEX.
+"""
+import re
+from typing import List, Set
+
+from core.cache import r, batch, pipeline, CACHE_LOCK_KEY
+
+SEARCH_KEY = u'users:search:{}'
+SEARCH_USER_KEY = u'users:search:user:{}'  # Indexed member and prefixes of user
+SEARCH_QUERY_KEY = u'users:search:query:{}'  # Intersection of several prefixes
+USERNAMES_KEY = u'users:search:usernames'
+SEARCH_FILLED_KEY = u'users:search:filled'  # Set after all users are indexed
+SEARCH_FILL_LOCK_KEY = CACHE_LOCK_KEY.format(SEARCH_FILLED_KEY)
+
+SEARCH_PREFIX_LENGTH = 15
+SEARCH_QUERY_TTL = 60
+SEARCH_FILL_CHUNK_SIZE = 1000
+SEARCH_FILL_LOCK_TIMEOUT = 60 * 10  # seconds
+
+WORD_REG = re.compile(r'[^\W_]+')
+
+# Replaces previous entries of user by new member and prefixes
+_index_user = r.register_script("""
+local old = redis.call('hmget', KEYS[1], 'member', 'prefixes')
+if old[1] then
+    for prefix in string.gmatch(old[2], '%S+') do
+        redis.call('zrem', ARGV[1] .. prefix, old[1])
+    end
+    redis.call('zrem', KEYS[2], old[1])
+end
+
+if #ARGV < 4 then
+    redis.call('del', KEYS[1])
+    return
+end
+
+for i = 4, #ARGV do
+    redis.call('zadd', ARGV[1] .. ARGV[i], ARGV[3], ARGV[2])
+end
+redis.call('zadd', KEYS[2], 0, ARGV[2])
+redis.call('hmset', KEYS[1], 'member', ARGV[2], 'prefixes', table.concat(ARGV, ' ', 4))
+""")
+
+# Changes score of indexed user
+_rank_user = r.register_script("""
+local old = redis.call('hmget', KEYS[1], 'member', 'prefixes')
+if old[1] then
+    for prefix in string.gmatch(old[2], '%S+') do
+        redis.call('zadd', ARGV[1] .. prefix, ARGV[2], old[1])
+    end
+end
+""")
+
+
+def get_prefixes(username: str, fullname: str) -> Set[str]:
+    words = set(username.lower().split())
+    words.update(WORD_REG.findall(username.lower()))
+    words.update(WORD_REG.findall(fullname.lower()))
+
+    prefixes = set()
+    for word in words:
+        word = word[:SEARCH_PREFIX_LENGTH]
+        prefixes.update(word[:i] for i in range(1, len(word) + 1))
+
+    return prefixes
+
+
+def index_user(pipe, user_id: int, username: str, fullname: str, search_range: int):
+    member = u'{}\x00{}'.format(username.lower(), user_id)
+    prefixes = sorted(get_prefixes(username, fullname))
+    _index_user(keys=[SEARCH_USER_KEY.format(user_id), USERNAMES_KEY],
+                args=[SEARCH_KEY.format(''), member, -search_range] + prefixes, client=pipe)
+
+
+def remove_user(pipe, user_id: int):
+    _index_user(keys=[SEARCH_USER_KEY.format(user_id), USERNAMES_KEY],
+                args=[SEARCH_KEY.format(''), '', 0], client=pipe)
+
+
+def rank_user(pipe, user_id: int, search_range: int):
+    _rank_user(keys=[SEARCH_USER_KEY.format(user_id)], args=[SEARCH_KEY.format(''), -search_range], client=pipe)
+
+
+def fill_index():
+    """
+    Indexes all users if index was not filled from db.
+    Index is filled by one worker, search returns partial results until it is done.
+    """
+    if r.exists(SEARCH_FILLED_KEY):
+        return
+
+    if not r.set(SEARCH_FILL_LOCK_KEY, 1, nx=True, ex=SEARCH_FILL_LOCK_TIMEOUT):
+        return
+
+    from users.models import User
+
+    try:
+        users = User.objects.values_list('pk', 'username', 'fullname', 'search_range').order_by('pk')
+        last_id = 0
+        while True:
+            chunk = list(users.filter(pk__gt=last_id)[:SEARCH_FILL_CHUNK_SIZE])
+            if not chunk:
+                break
+
+            with batch() as pipe:
+                for pk, username, fullname, search_range in chunk:
+                    index_user(pipe, pk, username, fullname, search_range)
+
+            last_id = chunk[-1][0]
+
+        r.set(SEARCH_FILLED_KEY, 1)
+    finally:
+        r.delete(SEARCH_FILL_LOCK_KEY)
+
+
+def parse_terms(query: str) -> List[str]:
+    """Returns lowercase terms of search query like rest_framework.filters.SearchFilter"""
+    terms = query.replace(',', ' ').lower().split()
+    return sorted({it[:SEARCH_PREFIX_LENGTH] for it in terms})
+
+
+def get_search_key(terms: List[str]) -> str:
+    """Returns key of sorted set of users matched by all terms"""
+    if len(terms) == 1:
+        return SEARCH_KEY.format(terms[0])
+
+    key = SEARCH_QUERY_KEY.format(' '.join(terms))
+    if not r.exists(key):
+        pipe = pipeline()
+        pipe.zinterstore(key, [SEARCH_KEY.format(it) for it in terms], aggregate='MAX')
+        pipe.expire(key, SEARCH_QUERY_TTL)
+        pipe.execute()
+
+    return key
+
+
+class SearchResult(object):
+    """Lazy list of found users, paginator takes its count and slice"""
+    def __init__(self, terms: List[str]):
+        self.key = get_search_key(terms)
+
+    def count(self) -> int:
+        return r.zcard(self.key)
+
+    def get_members(self, start: int, end: int) -> List[bytes]:
+        return r.zrange(self.key, start, end)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+
+        from users.models import User
+
+        start = item.start or 0
+        end = -1 if item.stop is None else item.stop - 1
+        if item.stop is not None and item.stop <= start:
+            return []
+
+        ids = [int(it.rsplit(b'\x00', 1)[1]) for it in self.get_members(start, end)]
+        users = User.objects.in_bulk(ids)
+
+        return [users[it] for it in ids if it in users]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+class UsernameSearchResult(SearchResult):
+    """Lazy list of users whose username starts with all terms, ordered by username"""
+    def __init__(self, terms: List[str]):
+        self.key = USERNAMES_KEY
+
+        # Terms are prefixes of the same username only if they are prefixes of the longest one
+        prefix = max(terms, key=len).encode('utf-8')
+        if all(prefix.startswith(it.encode('utf-8')) for it in terms):
+            self.min, self.max = b'[' + prefix, b'[' + prefix + b'\xff'
+        else:
+            self.min, self.max = b'+', b'-'
+
+    def count(self) -> int:
+        return r.zlexcount(self.key, self.min, self.max)
+
+    def get_members(self, start: int, end: int) -> List[bytes]:
+        num = -1 if end == -1 else end - start + 1
+        return r.zrangebylex(self.key, self.min, self.max, start=start, num=num)
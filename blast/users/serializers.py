@@ -1,7 +1,11 @@
+import json
+from typing import Dict, Iterable
+
 from rest_framework import serializers
 
 from smsconfirmation.models import PhoneConfirmation
-from users.models import User, UserSettings
+from core.cache import r, pipeline
+from users.models import User, UserSettings, USER_CARD_TTL
 
 
 # TODO: Rename
@@ -233,3 +237,47 @@ class OwnerSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'avatar', 'is_private',)
+
+
+def serialize_owners(user_ids: Iterable[int], request) -> Dict[int, dict]:
+    """
+    Returns OwnerSerializer data for each user id.
+    Data is cached in redis with relative avatar url and pulled by one MGET,
+    missed users are pulled by one query.
+    :return: dict of user id to serialized user
+    """
+    user_ids = list(set(user_ids))
+    if not user_ids:
+        return {}
+
+    cached = r.mget([User.redis_card_key(it) for it in user_ids])
+
+    cards = {}
+    missed = []
+    for pk, card in zip(user_ids, cached):
+        if card is None:
+            missed.append(pk)
+        else:
+            cards[pk] = json.loads(card.decode('utf-8'))
+
+    if missed:
+        pipe = pipeline()
+        for user in User.objects.filter(pk__in=missed):
+            card = {
+                'id': user.pk,
+                'username': user.username,
+                'avatar': user.avatar.url if user.avatar else None,
+                'is_private': user.is_private,
+            }
+            cards[user.pk] = card
+            pipe.set(User.redis_card_key(user.pk), json.dumps(card), ex=USER_CARD_TTL)
+        pipe.execute()
+
+    result = {}
+    for pk, card in cards.items():
+        card = dict(card)
+        if card['avatar']:
+            card['avatar'] = request.build_absolute_uri(card['avatar'])
+        result[pk] = card
+
+    return result
@@ -1,6 +1,5 @@
 import json
 
-import redis
 from django.test import TestCase
 from django.core.urlresolvers import reverse_lazy, reverse
 from django.utils import timezone
@@ -14,6 +13,7 @@ from reports.models import Report
 from smsconfirmation.models import PhoneConfirmation
 from tags.models import Tag
 from users.models import User, UserSettings, Follower, BlockedUsers
+from core.cache import r
 from core.tests import BaseTestCase
 from users.utils import mark_followee, mark_requested
 
@@ -664,6 +664,31 @@ class TestUserSearch(BaseTestCase):
         # for i in range(len(new_order)):
         #     self.assertEqual(posts[i]['id'], new_order[i].pk)
 
+    def search(self, query: str) -> list:
+        response = self.client.get(self.url + '?search={}'.format(query))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [it['username'] for it in response.data['results']]
+
+    def test_search_by_prefix(self):
+        other = self.generate_user('john_smith')
+        other.fullname = 'Johnny Walker'
+        other.save()
+
+        self.assertEqual(self.search('JOHN'), ['john_smith'])
+        self.assertEqual(self.search('smi'), ['john_smith'])
+        self.assertEqual(self.search('walk'), ['john_smith'])
+        self.assertEqual(self.search('johnny walk'), ['john_smith'])
+        self.assertEqual(self.search('johnny smyth'), [])
+
+        other.username = 'jack'
+        other.save()
+
+        self.assertEqual(self.search('john_'), [])
+        self.assertEqual(self.search('jac'), ['jack'])
+
+        other.delete()
+        self.assertEqual(self.search('jac'), [])
+
     # TODO: Write test
     def test_search_feeds(self):
         page_size = 25
@@ -707,7 +732,6 @@ class TestUserSearchOrder(BaseTestCase):
             {'username': 'test_aaf', 'posts': 1}
         ]
 
-        r = redis.StrictRedis(host='localhost', port=6379, db=0)
         for u in self.users:
             user = self.generate_user(username=u['username'])
 
@@ -742,6 +766,16 @@ class TestUserSearchOrder(BaseTestCase):
 
             self.assertEqual(user['username'], res['username'])
 
+    def test_username_search_order(self):
+        """Should find users by username prefix ordered by username"""
+        url = reverse_lazy('usernames-list') + '?search=test_aa'
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        usernames = [it['username'] for it in response.data['results']]
+        self.assertEqual(usernames, ['test_aaa', 'test_aab', 'test_aac', 'test_aad', 'test_aae', 'test_aaf'])
+
 
 class TestAnonymousPost(BaseTestCase):
     def setUp(self):
@@ -1,5 +1,4 @@
 import itertools
-import redis
 
 from notifications.models import FollowRequest
 from posts.serializers import PreviewPostSerializer
@@ -9,8 +8,6 @@ from posts.models import Post
 
 from typing import List, Set, Dict, Iterable
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
-
 
 def filter_followee_users(user: User, user_ids: list or set):
     if not user.is_authenticated():
@@ -5,15 +5,18 @@ from django.db import IntegrityError
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import authenticate
 from push_notifications.api.rest_framework import APNSDeviceSerializer, APNSDeviceViewSet
-from rest_framework import viewsets, mixins, permissions, generics, filters, status, views
+from rest_framework import viewsets, mixins, permissions, generics, status, views
 from rest_framework.decorators import list_route, detail_route
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
+from rest_framework.settings import api_settings
 
+from core.pagination import KeysetPagination
 from core.views import ExtendableModelMixin
 from core.utils import get_or_none
 from notifications.models import FollowRequest, Notification
 from reports.serializers import ReportSerializer
+from users import search
 from users.models import User, UserSettings, Follower, BlockedUsers
 from users.serializers import (RegisterUserSerializer, PublicUserSerializer,
                                ProfilePublicSerializer, ProfileUserSerializer,
@@ -168,7 +171,7 @@ class UserViewSet(ExtendableModelMixin,
         return Response()
 
     # TODO: Make test
-    def _extend_follow_response(self, page):
+    def _extend_follow_response(self, page, paginator: KeysetPagination, count: int):
         context = self.get_serializer_context()
         serializer = FollowersSerializer(page, many=True, context=context)
         data = serializer.data
@@ -178,30 +181,31 @@ class UserViewSet(ExtendableModelMixin,
 
         attach_recent_posts_to_users(data, self.request)
 
-        return self.get_paginated_response(data)
+        return paginator.get_paginated_response(data, count=count)
 
     @detail_route(['get'])
     def followers(self, request, pk=None):
         user = get_object_or_404(User, pk=pk)
 
         qs = Follower.objects.filter(followee=user).prefetch_related('follower')
-        qs = qs.order_by('follower__username')
 
-        page = self.paginate_queryset(qs)
+        paginator = KeysetPagination('follower__username')
+        page = paginator.paginate_queryset(qs, request, self)
         page = [it.follower for it in page]
 
-        return self._extend_follow_response(page)
+        return self._extend_follow_response(page, paginator, user.followers_count())
 
     @detail_route(['get'])
     def following(self, request, pk=None):
         user = get_object_or_404(User, pk=pk)
 
         qs = Follower.objects.filter(follower=user).prefetch_related('followee')
-        qs = qs.order_by('followee__username')
-        page = self.paginate_queryset(qs)
+
+        paginator = KeysetPagination('followee__username')
+        page = paginator.paginate_queryset(qs, request, self)
         page = [it.followee for it in page]
 
-        return self._extend_follow_response(page)
+        return self._extend_follow_response(page, paginator, user.following_count())
 
     @detail_route(['put'])
     def block(self, request, pk=None):
@@ -346,15 +350,29 @@ class UserChangePhoneView(generics.UpdateAPIView):
         return self.request.user
 
 
-class UserSearchView(ExtendableModelMixin,
+class UserSearchMixin(object):
+    """Finds users of list by prefixes in users.search index instead of SearchFilter"""
+    search_param = api_settings.SEARCH_PARAM
+
+    def filter_queryset(self, queryset):
+        terms = search.parse_terms(self.request.query_params.get(self.search_param, ''))
+        if self.action != 'list' or not terms:
+            return super().filter_queryset(queryset)
+
+        search.fill_index()
+        return self.get_search_result(terms)
+
+    def get_search_result(self, terms):
+        return search.SearchResult(terms)
+
+
+class UserSearchView(UserSearchMixin,
+                     ExtendableModelMixin,
                      viewsets.ReadOnlyModelViewSet):
     # TODO: take into account a followers
     queryset = User.objects.all().order_by('-search_range', 'username')
     serializer_class = PublicUserSerializer
 
-    filter_backends = (filters.SearchFilter,)
-    search_fields = ('username', 'fullname',)
-
     def extend_response_data(self, data):
         mark_followee(data, self.request.user)
         mark_requested(data, self.request.user)
@@ -392,13 +410,14 @@ class UserSearchView(ExtendableModelMixin,
         })
 
 
-class UsernameSearchView(viewsets.ReadOnlyModelViewSet):
+class UsernameSearchView(UserSearchMixin,
+                         viewsets.ReadOnlyModelViewSet):
     queryset = User.objects.all()
     permissions = (permissions.IsAuthenticated,)
     serializer_class = UsernameSerializer
 
-    filter_backends = (filters.SearchFilter,)
-    search_fields = ('username',)
+    def get_search_result(self, terms):
+        return search.UsernameSearchResult(terms)
 
 
 def _clear_auth_data(user: User, registration_id: str or None, send_push: bool):